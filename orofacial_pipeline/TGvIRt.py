@@ -1,11 +1,21 @@
 import sys
+import warnings
 import os
 
+import numpy as np
 import datajoint as dj
 from . import wanglab as lab
 from . import reference
+from .blob_cache import CachedBlobs
+from .lazy_schema import LazySchema
+from .spike_codec import sampled_times
+from . import spike_sorting
+from . import spikes
+from . import stimulation
+from . import waveforms
+from . import raw
 
-schema = dj.schema(dj.config.get('database.prefix', '') + 'tgvirt')
+schema = LazySchema('tgvirt')
 
 @schema
 class Session(dj.Manual):
@@ -32,7 +42,7 @@ class CueType(dj.Lookup):
 
 
 @schema
-class WhiskerBehavior(dj.Imported):
+class WhiskerBehavior(CachedBlobs, dj.Imported):
     definition = """
     -> Session
     ---
@@ -41,6 +51,7 @@ class WhiskerBehavior(dj.Imported):
     frame_times   : longblob   # (s)
     retract_times   : longblob  # (s)    
     protract_times  : longblob  # (s)
+    blobs_md5=null : char(32)  # MD5 of the serialized blobs, set on insert
     """
 
 
@@ -48,7 +59,7 @@ class WhiskerBehavior(dj.Imported):
 class OptoStim(dj.Manual):
     definition = """  # Optogenetic stimulation information for the sesssion
     -> Session
-    -> TargetRegion
+    -> lab.TargetRegion
     site_number   : tinyint  #  optogenetic site number  
     ---
     description : varchar(255)   # optogenetic site description
@@ -77,7 +88,7 @@ class Ephys(dj.Manual):
     -> Session
     -> lab.Rig
     -> lab.Probe
-    -> TargetRegion
+    -> lab.TargetRegion
     ---
     # posterior :  decimal(3,2)   # (mm) #useless
     # lateral  :  decimal(3,2)   # (mm) #useless
@@ -106,16 +117,26 @@ class SpikeSorting(dj.Imported):
     definition = """
     -> Ephys
     -> reference.SpikeSortingMethod
+    ---
+    sampling_rate=null : double  # (Hz) sampling rate of the sorted spike times
     """
 
+    def make(self, key):
+        folder, probe = (Session * Ephys & key).fetch1('session_folder', 'probe_name')
+        if spike_sorting.find_sorting(folder, key['spike_sort_method'], hint=probe) is None:
+            return
+        sorting = spike_sorting.load_sorting(folder, key['spike_sort_method'], hint=probe)
+        self.insert1(dict(key, sampling_rate=sorting.sampling_rate))
+
 
 @schema
-class Unit(dj.Imported):
+class Unit(CachedBlobs, dj.Imported):
     definition = """  #  Resultant unit(s) from spike-sorting routine
     -> SpikeSorting
     unit  : smallint   # single unit number in recording
     ---
-    spike_times : longblob  # (s) with respect to the start-time of the Ephys recording session
+    spike_times : <sampled_times>  # (s) with respect to the start-time of the Ephys recording session
+    blobs_md5=null : char(32)  # MD5 of the serialized blobs, set on insert
     """
         
     class CellType(dj.Part):
@@ -125,13 +146,60 @@ class Unit(dj.Imported):
         -> reference.CellType
         """
         
-    class Waveform(dj.Part):
+    class Waveform(CachedBlobs, dj.Part):
         definition = """  # spike waveform of this unit manifested at a given electrode
         -> master
         -> lab.Probe.Electrode
         ---
         waveform : longblob   # uV 
+        blobs_md5=null : char(32)  # MD5 of the serialized blobs, set on insert
+        """
+
+    class PackedWaveform(CachedBlobs, dj.Part):
+        definition = """  # spike waveforms of this unit on all its electrodes, one row per unit
+        -> master
+        ---
+        electrodes : longblob  # electrode of each row of waveforms, in lab.Probe.Electrode
+        shank_ids  : longblob  # shank_id of each row of waveforms
+        waveforms  : longblob  # (electrodes x samples) float32, uV
+        blobs_md5=null : char(32)  # MD5 of the serialized blobs, set on insert
+        """
+
+    def make(self, key):
+        folder, probe = (Session * Ephys & key).fetch1('session_folder', 'probe_name')
+        sorting = spike_sorting.load_sorting(folder, key['spike_sort_method'], hint=probe)
+        electrodes = {}
+        if sorting.channels is not None:
+            sites = raw.sorting_channel_map(folder, (lab.Rig & key).fetch1('recording_system'),
+                                            sorting.folder, hint=probe)
+            if sites is None:
+                raise dj.DataJointError('No channel map for the sorting in {}'.format(sorting.folder))
+            electrodes = raw.electrode_keys(sites, (lab.Probe.Electrode & key).fetch('KEY'))
+        packed = (lab.Probe & key).fetch1('probe_type') == 'neuropixel'
+        spike_sorting.insert_units(self, key, sorting, electrodes, packed=packed)
+
+    def fetch_packed(self, samples=False, batch_size=500):
         """
+        Spike trains of all units in this query as one contiguous buffer with
+        offsets and a key table (spikes.SpikeTrains), in float64 seconds or,
+        if samples, int64 sample indices at the sorting's sampling rate.
+        """
+        if samples:
+            return spikes.fetch_packed(self * SpikeSorting.proj('sampling_rate'),
+                                       batch_size=batch_size, rate_attribute='sampling_rate')
+        return spikes.fetch_packed(self, batch_size=batch_size)
+
+    def fetch_waveforms(self, stacked=False):
+        """
+        Waveforms of the units in this query from Waveform and PackedWaveform
+        alike: as Unit.Waveform rows (dicts), or if stacked as
+        (unit_ids, electrode_ids, units x electrodes x samples array).
+        """
+        return waveforms.fetch_stacked(self) if stacked else waveforms.fetch_rows(self)
+
+    def source_files(self, key):
+        folder, probe = (Session * Ephys & key).fetch1('session_folder', 'probe_name')
+        return spike_sorting.source_files(folder, key['spike_sort_method'], hint=probe)
 
 
 @schema
@@ -166,3 +234,132 @@ class Trial(dj.Imported):
         -> master 
         -> Unit
         """
+
+
+@schema
+class TrialSpikeIndex(dj.Computed):
+    definition = """  # location of every unit's spikes within each trial of the session
+    -> SpikeSorting
+    ---
+    trials : longblob   # trial numbers, in the order of the trial_offsets rows
+    """
+
+    class UnitOffsets(dj.Part):
+        definition = """
+        -> master
+        -> Unit
+        ---
+        trial_offsets : longblob  # (trials x 2) int64, spikes in trial i are spike_times[start:stop]
+        """
+
+    @property
+    def key_source(self):
+        return SpikeSorting & Trial
+
+    def make(self, key):
+        trials, start_times, stop_times = (Trial & key).fetch(
+            'trial', 'start_time', 'stop_time', order_by='trial')
+        units, trains = (Unit & key).fetch('KEY', 'spike_times', order_by='unit')
+        buffer, offsets = spikes.pack(trains)
+        index = spikes.window_offsets(buffer, offsets, start_times, stop_times)
+        self.insert1(dict(key, trials=trials))
+        self.UnitOffsets.insert(dict(unit, trial_offsets=unit_index)
+                                for unit, unit_index in zip(units, index))
+
+    def fetch_trial_spikes(self, key, align=True):
+        """
+        Spikes of every unit of the sorting `key` split by trial.
+
+        Returns (trials, units, trial_spikes) where trial_spikes[u][t] holds the
+        spike times of units[u] in trials[t], relative to the trial start if align.
+        """
+        trials = (self & key).fetch1('trials')
+        units, trains, index = (Unit * self.UnitOffsets & key).fetch(
+            'KEY', 'spike_times', 'trial_offsets', order_by='unit')
+        start_times = dict(zip(*(Trial & key).fetch('trial', 'start_time')))
+        shifts = np.array([start_times[t] for t in trials]) if align else np.zeros(len(trials))
+        trial_spikes = [[train[start:stop] - shift for (start, stop), shift in zip(unit_index, shifts)]
+                        for train, unit_index in zip(trains, index)]
+        return trials, units, trial_spikes
+
+
+@schema
+class PhototagResponse(dj.Computed):
+    definition = """  # responses of all units of a sorting to the light pulses of an optogenetic site
+    -> SpikeSorting
+    -> OptoStim
+    ---
+    pulse_count       : int
+    response_window   : float  # (s) after pulse onset
+    baseline_duration : float  # (s) before each train, for SALT
+    """
+
+    class UnitResponse(dj.Part):
+        definition = """
+        -> master
+        -> Unit
+        ---
+        reliability  : float  # fraction of pulses followed by a spike within the response window
+        latency=null : float  # (s) median first-spike latency
+        jitter=null  : float  # (s) standard deviation of the first-spike latency
+        salt_p       : float  # SALT p-value
+        salt_i       : float  # SALT difference in Jensen-Shannon distance from baseline
+        """
+
+    response_window = 0.01
+    baseline_duration = 1.
+
+    @property
+    def key_source(self):
+        return SpikeSorting * OptoStim & Trial.Stim
+
+    def make(self, key):
+        # Trial.Stim holds train onsets; pulses follow the site's first stimulation sequence
+        train_onsets = np.sort((Trial.Stim & key).fetch('stim_time').astype(np.float64))
+        params = (OptoStim.StimParam & key).fetch(as_dict=True, order_by='stim_number', limit=1)
+        param = params[0] if params else dict(pulse_duration=0, pulse_frequency=0, pulse_per_train=1)
+        pulse_onsets, _, _ = stimulation.expand_pulse_trains(
+            train_onsets, param['pulse_duration'] / 1000, param['pulse_frequency'], param['pulse_per_train'])
+
+        units, trains = (Unit & key).fetch('KEY', 'spike_times', order_by='unit')
+        buffer, offsets = spikes.pack(trains)
+        latency = stimulation.first_spike_latencies(buffer, offsets, pulse_onsets, self.response_window)
+        p, i = stimulation.salt(buffer, offsets, pulse_onsets, train_onsets,
+                                self.response_window, self.baseline_duration)
+        responded = ~np.isnan(latency)
+        reliability = responded.mean(axis=1)
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore', RuntimeWarning)
+            median, jitter = np.nanmedian(latency, axis=1), np.nanstd(latency, axis=1)
+
+        self.insert1(dict(key, pulse_count=len(pulse_onsets), response_window=self.response_window,
+                          baseline_duration=self.baseline_duration))
+        self.UnitResponse.insert(
+            dict(key, **unit, reliability=reliability[u],
+                 latency=median[u] if responded[u].any() else None,
+                 jitter=jitter[u] if responded[u].sum() > 1 else None,
+                 salt_p=p[u], salt_i=i[u])
+            for u, unit in enumerate(units))
+
+    def tagged(self, p_value=0.01, min_reliability=0.2):
+        """UnitResponse rows of units counted as light responsive."""
+        return self.UnitResponse & self & 'salt_p < {} and reliability >= {}'.format(p_value, min_reliability)
+
+    def fill_phototag(self, p_value=0.01, min_reliability=0.2):
+        """
+        Insert a Phototag row for every result in this query that has none:
+        responses 'Yes' if any unit is tagged, with the peak electrodes of the
+        tagged units as responsive_channels when they fit, else 'No'.
+        """
+        for key in (self - Phototag).fetch('KEY'):
+            tagged = (Unit & self.tagged(p_value, min_reliability) & key).proj()
+            channels = None
+            if tagged:
+                unit_ids, electrode_ids, array = (Unit & tagged).fetch_waveforms(stacked=True)
+                if array.size:
+                    peak = np.ptp(array, axis=2).argmax(axis=1)
+                    channels = ','.join(str(e) for e in np.unique(electrode_ids[peak, 0]))
+                    channels = channels if len(channels) <= 30 else None
+            Phototag.insert1(dict((Ephys * OptoStim & key).fetch1('KEY'),
+                                  responses='Yes' if tagged else 'No', responsive_channels=channels),
+                           skip_duplicates=True)
@@ -0,0 +1 @@
+from .lazy_schema import activate
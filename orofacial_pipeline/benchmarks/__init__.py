@@ -0,0 +1,5 @@
+"""
+Scale benchmarks of ingest and queries on synthetic sessions, run against
+a test database under a schema prefix, or offline on the files of one
+session (see run.py).
+"""
@@ -0,0 +1,115 @@
+"""
+Filling the schemas with synthetic sessions through the ingest path of
+real data: each session's raw files (whisker tracking, phy output) are
+written to its session folder and the Imported tables read them through
+populate(); trial tables, which have no make(), are inserted directly.
+"""
+import datetime
+import hashlib
+import os
+import uuid
+
+import numpy as np
+
+from .. import wanglab as lab
+from .. import wl_whisker_experiment as experiment
+from .. import wl_ephys as ephys
+from . import synthetic
+
+LAB, USER, RIG, PROBE, REGION, TASK = 'bench', 'bench', 'bench_rig', 'bench_np1', 'vIRt', 'bench'
+N_CHANNELS = 384
+TRIAL_EVENTS = (('sample', 'pole', 0.5, 1.), ('delay', 'start', 1.5, 1.), ('go', 'audio_cue', 2.5, 0.1))
+
+
+def insert_fixtures(n_studies):
+    """Lab, studies, user, rig, task and a Neuropixels 1.0 probe with its first bank as electrode config."""
+    lab.Lab.insert1((LAB, 'synthetic'), skip_duplicates=True)
+    lab.Study.insert([('bench{}'.format(i), 'synthetic benchmark study', LAB) for i in range(n_studies)],
+                     skip_duplicates=True)
+    lab.User.insert1((USER, 'Benchmark'), skip_duplicates=True)
+    lab.Rig.insert1(dict(rig_name=RIG, recording_system='SpikeGLX'), skip_duplicates=True)
+    lab.TargetRegion.insert1(dict(brain_region=REGION), skip_duplicates=True)
+    experiment.Task.insert1((TASK, 'synthetic whisking task'), skip_duplicates=True)
+    experiment.TaskProtocol.insert1((TASK, 1, 'synthetic whisking task'), skip_duplicates=True)
+
+    electrodes, shanks, x, y = synthetic.neuropixel_electrodes()
+    lab.Probe.insert1(dict(probe_name=PROBE, probe_type='neuropixel', channel_counts=N_CHANNELS,
+                           shank_counts=1), skip_duplicates=True)
+    lab.Probe.Electrode.insert((dict(probe_name=PROBE, electrode=e, shank_id=s, x_coord=xe, y_coord=ye, z_coord=0.)
+                                for e, s, xe, ye in zip(electrodes.tolist(), shanks.tolist(), x, y)),
+                               skip_duplicates=True)
+    config = dict(probe_name=PROBE, electrode_config_name='bank0')
+    config_hash = uuid.UUID(hashlib.md5(np.arange(N_CHANNELS).tobytes()).hexdigest())
+    lab.ElectrodeConfig.insert1(dict(config, electrode_config_hash=str(config_hash)), skip_duplicates=True)
+    lab.ElectrodeConfig.ElectrodeGroup.insert1(dict(config, electrode_group=0), skip_duplicates=True)
+    lab.ElectrodeConfig.Electrode.insert((dict(config, electrode_group=0, electrode=e, shank_id=0)
+                                          for e in range(N_CHANNELS)), skip_duplicates=True)
+
+
+def insert_session(subject_id, session, study, folder):
+    """The subject (if new), session and ephys rows of one session; returns the session key."""
+    lab.Subject.insert1(dict(subject_id=subject_id, user_name=USER, species='Mus musculus',
+                             location='bench', project_use='benchmark'), skip_duplicates=True)
+    key = dict(subject_id=subject_id, session=session)
+    experiment.Session.insert1(dict(key, study=study, user_name=USER, rig_name=RIG, recording_type='acute',
+                                    session_date=datetime.date(2024, 1, 1) + datetime.timedelta(days=session),
+                                    session_folder=folder))
+    ephys.Ephys.insert1(dict(key, rig_name=RIG, probe_name=PROBE, brain_region=REGION,
+                             recording_marker='stereotaxic'))
+    return key
+
+
+def write_session_files(folder, duration, n_units, frame_rate, rng):
+    """Whisker tracking and phy output of one session; returns the number of spikes."""
+    os.makedirs(folder, exist_ok=True)
+    frame_times, angle = synthetic.whisker_angle(duration, frame_rate, rng)
+    np.save(os.path.join(folder, 'whisker_angle.npy'), angle)
+    np.save(os.path.join(folder, 'frame_times.npy'), frame_times)
+    samples, clusters = synthetic.spike_trains(n_units, duration, rng)
+    synthetic.write_phy(os.path.join(folder, 'sorting'), samples, clusters,
+                        synthetic.templates(n_units, N_CHANNELS, rng), rng=rng)
+    return len(samples)
+
+
+def insert_trials(key, starts, stops):
+    experiment.SessionTrial.insert(
+        (dict(key, trial=trial, trial_uid=key['subject_id'] * 10 ** 6 + key['session'] * 10 ** 4 + trial,
+              start_time=round(start, 4), stop_time=round(stop, 4), trial_type='whisking')
+         for trial, (start, stop) in enumerate(zip(starts.tolist(), stops.tolist()), 1)),
+        allow_direct_insert=True)
+
+
+def insert_behavior_trials(key, n_trials, rng):
+    instructions = rng.choice(['go', 'nogo'], n_trials)
+    hit = rng.random(n_trials) < 0.7
+    outcomes = np.where(instructions == 'go', np.where(hit, 'hit', 'miss'),
+                        np.where(hit, 'correct rejection', 'false alarm'))
+    experiment.BehaviorTrial.insert(
+        (dict(key, trial=trial, task=TASK, task_protocol=1, trial_instruction=instruction,
+              early_response='no early', outcome=outcome)
+         for trial, instruction, outcome in zip(range(1, n_trials + 1), instructions.tolist(), outcomes.tolist())),
+        allow_direct_insert=True)
+
+
+def insert_trial_events(key, n_trials):
+    experiment.TrialEvent.insert(
+        (dict(key, trial=trial, trial_event_id=i, trial_event_type=event_type, cue_type=cue_type,
+              trial_event_time=time, duration=duration)
+         for trial in range(1, n_trials + 1)
+         for i, (event_type, cue_type, time, duration) in enumerate(TRIAL_EVENTS, 1)),
+        allow_direct_insert=True)
+
+
+def session_stages(key, starts, stops, rng):
+    """(table name, table, ingest callable) of the ingest steps of a session, in order."""
+    sorting = dict(key, spike_sort_method='KS')
+    return [
+        ('SessionTrial', experiment.SessionTrial, lambda: insert_trials(key, starts, stops)),
+        ('BehaviorTrial', experiment.BehaviorTrial, lambda: insert_behavior_trials(key, len(starts), rng)),
+        ('TrialEvent', experiment.TrialEvent, lambda: insert_trial_events(key, len(starts))),
+        ('WhiskerBehavior', experiment.WhiskerBehavior, lambda: experiment.WhiskerBehavior.populate(key)),
+        ('ActionEvent', experiment.ActionEvent, lambda: experiment.ActionEvent.populate(key)),
+        ('SessionEvents', experiment.SessionEvents, lambda: experiment.SessionEvents().pack(key, 'ActionEvent')),
+        ('SpikeSorting', ephys.SpikeSorting, lambda: ephys.SpikeSorting.populate(sorting)),
+        ('Unit', ephys.Unit, lambda: ephys.Unit.populate(sorting)),
+    ]
@@ -0,0 +1,122 @@
+"""
+Query workloads of the benchmark: the fetches analyses do most, each a
+function of a context dict (study name, session key, sorting key) that
+returns the number of rows (or events, spikes) it read.  The offline
+workloads time the computations behind the ingest stages and queries on
+the files of one session, without a database.
+"""
+import os
+
+import numpy as np
+
+from .. import wl_whisker_experiment as experiment
+from .. import wl_ephys as ephys
+from .. import spike_sorting
+from .. import spikes
+from .. import whisker
+
+
+def units_per_study(context):
+    return len((ephys.Unit & (experiment.Session & {'study': context['study']})).fetch('KEY'))
+
+
+def unit_counts(context):
+    counts = experiment.Session.aggr(ephys.Unit, n_units='count(*)').fetch('n_units')
+    return len(counts)
+
+
+def trials_per_study(context):
+    trials = (experiment.SessionTrial * experiment.BehaviorTrial
+              & (experiment.Session & {'study': context['study']}))
+    return len(trials.fetch('start_time', 'stop_time', 'outcome')[0])
+
+
+def session_spike_trains(context):
+    trains = (ephys.Unit & context['sorting']).fetch_packed()
+    return len(trains.buffer)
+
+
+def trial_aligned_spikes(context):
+    trains = (ephys.Unit & context['sorting']).fetch_packed()
+    starts, stops = (experiment.SessionTrial & context['session']).fetch('start_time', 'stop_time',
+                                                                          order_by='trial')
+    index, _, _ = spikes.window_spikes(trains.buffer, trains.offsets,
+                                       starts.astype(np.float64), stops.astype(np.float64))
+    return len(index)
+
+
+def whisker_traces(context):
+    angle, frame_times = (experiment.WhiskerBehavior & context['session']).fetch1('angle', 'frame_times')
+    return len(angle)
+
+
+def whisker_traces_cached(context):
+    angle, frame_times = (experiment.WhiskerBehavior & context['session']).fetch_cached('angle', 'frame_times')
+    return len(angle[0])
+
+
+def action_events(context):
+    return len((experiment.ActionEvent & context['session']).fetch('action_event_time'))
+
+
+def action_events_columnar(context):
+    events = experiment.SessionEvents().fetch_events(context['session'], 'ActionEvent', as_dict=False)
+    return len(events['action_event_time'])
+
+
+def protractions_by_outcome(context):
+    events = (experiment.ActionEvent * experiment.BehaviorTrial & context['session']
+              & {'action_event_type': 'protraction'})
+    return len(events.fetch('outcome', 'action_event_time')[0])
+
+
+def packed_waveforms(context):
+    unit_ids, _, stack = (ephys.Unit & context['sorting']).fetch_waveforms(stacked=True)
+    return len(unit_ids)
+
+
+WORKLOADS = (units_per_study, unit_counts, trials_per_study, session_spike_trains, trial_aligned_spikes,
+             whisker_traces, whisker_traces_cached, action_events, action_events_columnar,
+             protractions_by_outcome, packed_waveforms)
+
+
+# ---- offline: context of session folder, trial starts and stops, kinematics and packed spike trains ----
+
+def whisker_files(folder):
+    """Whisker angle and frame times of a session folder (ingest.write_session_files), as memory maps."""
+    return (np.load(os.path.join(folder, 'whisker_angle.npy'), mmap_mode='r'),
+            np.load(os.path.join(folder, 'frame_times.npy'), mmap_mode='r'))
+
+
+def offline_context(folder, starts, stops):
+    angle, frame_times = whisker_files(folder)
+    sorting = spike_sorting.load_sorting(folder, 'KS')
+    trains = spikes.pack([samples / sorting.sampling_rate for _, samples, _ in sorting.units()])
+    return dict(folder=folder, starts=starts, stops=stops, trains=trains,
+                kinematics=whisker.kinematics(angle, frame_times))
+
+
+def whisker_kinematics(context):
+    angle, frame_times = whisker_files(context['folder'])
+    return len(whisker.kinematics(angle, frame_times)['phase'])
+
+
+def whisk_events(context):
+    angle, frame_times = whisker_files(context['folder'])
+    kinematics = context['kinematics']
+    events = whisker.detect_whisk_events(kinematics['phase'], kinematics['amplitude'], angle,
+                                         1 / np.median(np.diff(frame_times)))
+    return sum(len(frames) for frames in events.values())
+
+
+def sorter_units(context):
+    sorting = spike_sorting.load_sorting(context['folder'], 'KS')
+    return sum(len(samples) for _, samples, _ in sorting.units())
+
+
+def trial_windows(context):
+    index, _, _ = spikes.window_spikes(*context['trains'], context['starts'], context['stops'])
+    return len(index)
+
+
+OFFLINE_WORKLOADS = (whisker_kinematics, whisk_events, sorter_units, trial_windows)
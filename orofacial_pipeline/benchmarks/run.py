@@ -0,0 +1,264 @@
+"""
+Scale benchmark of the pipeline against a test database.
+
+Synthetic sessions at one of SCALES are ingested into schemas named
+<prefix><name> (never the unprefixed production schemas), timing every
+ingest stage, then every workload of queries.WORKLOADS is timed (first,
+min and median of several runs) and its peak Python allocation measured.
+Results are written as JSON with the commit, versions and host, and two
+result files can be compared for regressions.  --offline times only the
+computations of queries.OFFLINE_WORKLOADS on the files of one session,
+with no database server.
+
+    python -m orofacial_pipeline.benchmarks.run --scale medium --prefix bench_ --reset --output medium.json
+    python -m orofacial_pipeline.benchmarks.run --compare baseline.json medium.json
+    python -m orofacial_pipeline.benchmarks.run --scale medium --offline
+"""
+import argparse
+import collections
+import datetime
+import json
+import os
+import platform
+import resource
+import shutil
+import subprocess
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+import datajoint as dj
+
+from .. import lazy_schema
+from ..lazy_schema import activate
+from .. import wl_whisker_experiment as experiment
+from .. import wl_ephys as ephys
+from . import ingest
+from . import queries
+from . import synthetic
+
+# trials are about 4 s long with about 1 s between them; sessions must stay under
+# 9999 s, the range of the decimal(8, 4) trial times
+SCALES = {
+    'small': dict(subjects=2, sessions=2, trials=200, units=50, frame_rate=500., studies=1),
+    'medium': dict(subjects=4, sessions=3, trials=1000, units=300, frame_rate=500., studies=2),
+    'large': dict(subjects=8, sessions=5, trials=1600, units=400, frame_rate=1000., studies=4),
+}
+TRIAL_DURATION, INTER_TRIAL = 4., 1.
+
+ROW_COUNTS = (experiment.Session, experiment.SessionTrial, experiment.TrialEvent, experiment.ActionEvent,
+              experiment.WhiskerBehavior, ephys.Unit, ephys.Unit.PackedWaveform)
+
+
+def reset(prefix):
+    """Drop the existing schemas <prefix><name> of the imported modules, dependents first."""
+    if not prefix:
+        raise ValueError('Refusing to drop unprefixed schemas')
+    existing = set(dj.list_schemas())
+    for schema in reversed(lazy_schema._registry):
+        if prefix + schema.name in existing:
+            dj.Schema(prefix + schema.name, create_schema=False).drop(force=True)
+
+
+def _max_rss():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024  # kilobytes on Linux
+
+
+def ingest_sessions(parameters, data, rng):
+    """Ingest all sessions at `parameters`; returns the stage summaries and the session keys."""
+    ingest.insert_fixtures(parameters['studies'])
+    stages = collections.OrderedDict()
+
+    def timed(name, table, key, run):
+        start = time.perf_counter()
+        run()
+        seconds = time.perf_counter() - start
+        stage = stages.setdefault(name, dict(rows=0, seconds=0.))
+        stage['rows'] += len(table & key) if table is not None else 0
+        stage['seconds'] += seconds
+        stage['max_rss'] = _max_rss()
+
+    keys = []
+    for subject in range(parameters['subjects']):
+        for session in range(parameters['sessions']):
+            key = dict(subject_id=subject + 1, session=session + 1)
+            keys.append(key)
+            if experiment.Session & key:
+                continue  # ingested by an earlier run; --reset to start over
+            folder = os.path.join(data, 'subject{subject_id}'.format(**key), 'session{session}'.format(**key))
+            starts, stops = synthetic.trial_times(parameters['trials'], TRIAL_DURATION, INTER_TRIAL, rng)
+            stage = stages.setdefault('files', dict(rows=0, seconds=0.))
+            start = time.perf_counter()
+            stage['rows'] += ingest.write_session_files(folder, stops[-1] + 1., parameters['units'],
+                                                        parameters['frame_rate'], rng)
+            stage['seconds'] += time.perf_counter() - start
+            timed('Session', experiment.Session, key, lambda: ingest.insert_session(
+                key['subject_id'], key['session'], 'bench{}'.format(subject % parameters['studies']), folder))
+            for name, table, run in ingest.session_stages(key, starts, stops, rng):
+                timed(name, table, key, run)
+
+    for stage in stages.values():
+        stage['rows_per_second'] = stage['rows'] / stage['seconds'] if stage['seconds'] else None
+    return stages, keys
+
+
+def measure(workload, context, repeats=5):
+    """Timings (s) of `repeats` runs of workload, then its peak Python allocation in one more run."""
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        rows = workload(context)
+        times.append(time.perf_counter() - start)
+    tracemalloc.start()
+    try:
+        workload(context)
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    return dict(rows=rows, first=times[0], min=min(times), median=float(np.median(times)), peak_bytes=peak)
+
+
+def _git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=os.path.dirname(__file__),
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(scale='small', prefix='bench_', data=None, repeats=5, reset_schemas=False, seed=0):
+    """
+    Ingest the sessions of `scale` into the schemas <prefix><name> and time
+    the query workloads.  Synthetic files go to `data` (default a temporary
+    folder, removed afterwards).  Returns the results as a dict.
+    """
+    if not prefix:
+        raise ValueError('The benchmark must run under a schema prefix, e.g. bench_')
+    parameters = SCALES[scale]
+    if reset_schemas:
+        reset(prefix)
+    activate(prefix)
+
+    temporary = data is None
+    data = data or tempfile.mkdtemp(prefix='orofacial_bench_')
+    cache = os.path.join(data, 'blob_cache')
+    shutil.rmtree(cache, ignore_errors=True)  # the first cached fetch is a cold one
+    dj.config['custom'] = dict(dj.config.get('custom') or {}, **{'blob_cache.location': cache})
+    started = datetime.datetime.now().isoformat(timespec='seconds')
+    try:
+        stages, keys = ingest_sessions(parameters, data, np.random.default_rng(seed))
+        context = dict(study='bench0', session=keys[0], sorting=dict(keys[0], spike_sort_method='KS'))
+        results = collections.OrderedDict(
+            (workload.__name__, measure(workload, context, repeats)) for workload in queries.WORKLOADS)
+    finally:
+        if temporary:
+            shutil.rmtree(data, ignore_errors=True)
+
+    return dict(
+        scale=scale, mode='database', parameters=parameters, started=started, commit=_git_commit(),
+        host=platform.node(),
+        versions=dict(python=platform.python_version(), numpy=np.__version__, datajoint=dj.__version__,
+                      mysql=dj.conn().query('SELECT VERSION()').fetchone()[0]),
+        database_host=dj.config['database.host'], prefix=prefix, repeats=repeats,
+        ingest=stages, queries=results,
+        row_counts={table.__name__: len(table()) for table in ROW_COUNTS})
+
+
+def offline(scale='small', data=None, repeats=5, seed=0):
+    """
+    Write the files of one session of `scale` to `data` (default a temporary
+    folder, removed afterwards) and time the workloads of
+    queries.OFFLINE_WORKLOADS on them.  Needs no database.  Returns the
+    results as a dict.
+    """
+    parameters = SCALES[scale]
+    rng = np.random.default_rng(seed)
+    temporary = data is None
+    data = data or tempfile.mkdtemp(prefix='orofacial_bench_')
+    started = datetime.datetime.now().isoformat(timespec='seconds')
+    try:
+        starts, stops = synthetic.trial_times(parameters['trials'], TRIAL_DURATION, INTER_TRIAL, rng)
+        start = time.perf_counter()
+        n_spikes = ingest.write_session_files(data, stops[-1] + 1., parameters['units'],
+                                              parameters['frame_rate'], rng)
+        seconds = time.perf_counter() - start
+        stages = dict(files=dict(rows=n_spikes, seconds=seconds, rows_per_second=n_spikes / seconds,
+                                 max_rss=_max_rss()))
+        context = queries.offline_context(data, starts, stops)
+        results = collections.OrderedDict(
+            (workload.__name__, measure(workload, context, repeats)) for workload in queries.OFFLINE_WORKLOADS)
+    finally:
+        if temporary:
+            shutil.rmtree(data, ignore_errors=True)
+
+    return dict(
+        scale=scale, mode='offline', parameters=parameters, started=started, commit=_git_commit(),
+        host=platform.node(), versions=dict(python=platform.python_version(), numpy=np.__version__),
+        repeats=repeats, ingest=stages, queries=results)
+
+
+def compare(baseline, current, tolerance=0.2):
+    """
+    Regressions of `current` against `baseline` results (dicts or JSON file
+    paths) beyond `tolerance`: lower ingest rates, higher query median times
+    or peak memory.  Returns a list of messages, empty if there are none.
+    """
+    baseline, current = [json.load(open(r)) if isinstance(r, str) else r for r in (baseline, current)]
+    if baseline['scale'] != current['scale']:
+        raise ValueError('Cannot compare scale {} with {}'.format(baseline['scale'], current['scale']))
+    modes = [r.get('mode', 'database') for r in (baseline, current)]
+    if modes[0] != modes[1]:
+        raise ValueError('Cannot compare {} results with {} results'.format(*modes))
+    regressions = []
+    for name, stage in current['ingest'].items():
+        old, new = baseline['ingest'].get(name, {}).get('rows_per_second'), stage['rows_per_second']
+        if old and new is not None and new < old * (1 - tolerance):
+            regressions.append('ingest {}: {:.0f} rows/s, was {:.0f}'.format(name, new, old))
+    for name, result in current['queries'].items():
+        old = baseline['queries'].get(name)
+        if old is None:
+            continue
+        if result['median'] > old['median'] * (1 + tolerance):
+            regressions.append('{}: median {:.4f} s, was {:.4f} s'.format(name, result['median'], old['median']))
+        if result['peak_bytes'] > old['peak_bytes'] * (1 + tolerance):
+            regressions.append('{}: peak {} bytes, was {}'.format(name, result['peak_bytes'], old['peak_bytes']))
+    return regressions
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the orofacial pipeline on synthetic sessions')
+    parser.add_argument('--scale', choices=list(SCALES), default='small')
+    parser.add_argument('--prefix', default='bench_', help='schema prefix of the benchmark schemas')
+    parser.add_argument('--host', default=None, help='database host, default dj.config database.host')
+    parser.add_argument('--data', default=None, help='folder for the synthetic files, kept after the run')
+    parser.add_argument('--repeats', type=int, default=5)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--reset', action='store_true', help='drop the benchmark schemas first')
+    parser.add_argument('--output', default=None, help='results file, default benchmark_<scale>.json')
+    parser.add_argument('--compare', nargs=2, metavar=('BASELINE', 'CURRENT'),
+                        help='report regressions of CURRENT against BASELINE results and exit')
+    parser.add_argument('--tolerance', type=float, default=0.2)
+    parser.add_argument('--offline', action='store_true',
+                        help='time the computations on the files of one session, without a database')
+    args = parser.parse_args()
+
+    if args.compare:
+        regressions = compare(*args.compare, tolerance=args.tolerance)
+        print('\n'.join(regressions) or 'no regressions')
+        raise SystemExit(1 if regressions else 0)
+
+    if args.offline:
+        results = offline(args.scale, args.data, args.repeats, args.seed)
+    else:
+        if args.host:
+            dj.config['database.host'] = args.host
+        results = run(args.scale, args.prefix, args.data, args.repeats, args.reset, args.seed)
+    output = args.output or 'benchmark_{}{}.json'.format(args.scale, '_offline' if args.offline else '')
+    with open(output, 'w') as f:
+        json.dump(results, f, indent=2, default=str)
+    for name, stage in results['ingest'].items():
+        print('{:<16} {:>12} rows {:>10.1f} s'.format(name, stage['rows'], stage['seconds']))
+    for name, result in results['queries'].items():
+        print('{:<24} {:>10} rows  median {:.4f} s  peak {:.1f} MB'.format(
+            name, result['rows'], result['median'], result['peak_bytes'] / 1024 ** 2))
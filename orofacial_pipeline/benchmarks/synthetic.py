@@ -0,0 +1,103 @@
+"""
+Synthetic raw data with the shapes and statistics of real sessions: trial
+sequences, whisker angle traces with whisking bouts, Neuropixels probe
+geometry and spike sorter (phy) output of Poisson units.  Pure numpy, no
+database.
+"""
+import os
+
+import numpy as np
+
+
+def trial_times(n_trials, trial_duration, inter_trial, rng):
+    """Start and stop times (s) of n_trials consecutive trials with jittered durations and intervals."""
+    durations = trial_duration * rng.uniform(0.9, 1.1, n_trials)
+    intervals = inter_trial * rng.uniform(0.5, 1.5, n_trials)
+    starts = 1. + np.concatenate([[0.], np.cumsum(durations + intervals)[:-1]])
+    return starts, starts + durations
+
+
+def whisker_angle(duration, frame_rate, rng, whisking_fraction=0.6, bout_duration=2.):
+    """
+    Frame times (s, float64) and whisker angle (degrees, float32) of bouts
+    of whisking at 8-15 Hz and 5-30 degrees amplitude, about bout_duration s
+    long, between periods of rest, with a drifting midpoint and tracking
+    noise.
+    """
+    n_frames = int(duration * frame_rate)
+    frame_times = np.arange(n_frames) / frame_rate + rng.normal(0, 0.02 / frame_rate, n_frames)
+    rest_duration = bout_duration * (1 - whisking_fraction) / whisking_fraction
+    n_bouts = int(2 * duration / (bout_duration + rest_duration)) + 10
+    segments = np.column_stack([rng.exponential(bout_duration, n_bouts),
+                                rng.exponential(rest_duration, n_bouts)]).ravel()
+    segment = np.minimum(np.searchsorted(np.cumsum(segments) * frame_rate, np.arange(n_frames), side='right'),
+                         len(segments) - 1)
+    whisking = segment % 2 == 0
+    frequency = rng.uniform(8., 15., len(segments))[segment]
+    amplitude = np.where(whisking, rng.uniform(5., 30., len(segments))[segment], 0.5)
+    # smooth bout onsets and offsets over 50 ms
+    window = max(int(0.05 * frame_rate), 1)
+    amplitude = np.convolve(amplitude, np.ones(window) / window, mode='same')
+    phase = 2 * np.pi * np.cumsum(frequency) / frame_rate
+    midpoint = 80. + 10. * np.sin(2 * np.pi * 0.02 * frame_times + rng.uniform(0, 2 * np.pi))
+    angle = midpoint + amplitude * np.cos(phase) + rng.normal(0., 0.3, n_frames)
+    return frame_times, angle.astype(np.float32)
+
+
+def spike_trains(n_units, duration, rng, sampling_rate=30000., refractory=0.0015):
+    """
+    Spike sample indices and cluster of every spike of n_units Poisson units
+    at lognormal firing rates (median 4 Hz, at most 60 Hz) with a refractory
+    period, sorted in time like a sorter's output.
+    """
+    rates = np.minimum(rng.lognormal(np.log(4.), 1., n_units), 60.)
+    counts = rng.poisson(rates * duration)
+    clusters = np.repeat(np.arange(n_units, dtype=np.int32), counts)
+    times = rng.uniform(0., duration, counts.sum())
+    order = np.lexsort((times, clusters))
+    times, clusters = times[order], clusters[order]
+    keep = np.concatenate([[True], (np.diff(times) >= refractory) | (clusters[1:] != clusters[:-1])])
+    samples = np.rint(times[keep] * sampling_rate).astype(np.uint64)
+    order = np.argsort(samples, kind='stable')
+    return samples[order], clusters[keep][order]
+
+
+def neuropixel_electrodes(n_electrodes=960):
+    """Electrode number, shank id and x, y coordinates (um) of the sites of a Neuropixels 1.0 probe."""
+    electrodes = np.arange(n_electrodes)
+    x = np.array([43., 11., 59., 27.])[electrodes % 4]
+    y = 20. * (electrodes // 2)
+    return electrodes, np.zeros(n_electrodes, dtype=np.int64), x, y
+
+
+def templates(n_units, n_channels, rng, n_samples=82, spread=12):
+    """
+    (units x samples x channels) float32 spike templates (uV): a trough and
+    a later, slower peak of unit-specific width on a peak channel, decaying
+    over the spread channels on each side and zero beyond.
+    """
+    t = np.arange(n_samples) - n_samples // 3
+    width = rng.uniform(3., 10., n_units)[:, None]
+    shape = -np.exp(-(t / (0.4 * width)) ** 2) + 0.4 * np.exp(-((t - width) / width) ** 2)
+    distance = np.abs(np.arange(n_channels)[None, :] - rng.integers(0, n_channels, n_units)[:, None])
+    gain = rng.uniform(50., 300., n_units)[:, None] * np.exp(-3. * distance / spread) * (distance <= spread)
+    return (shape[:, :, None] * gain[:, None, :]).astype(np.float32)
+
+
+def write_phy(folder, samples, clusters, unit_templates, sampling_rate=30000., noise_fraction=0.1, rng=None):
+    """Write a phy export (as KiloSort leaves it) of the spikes and templates to folder."""
+    rng = rng or np.random.default_rng()
+    os.makedirs(folder, exist_ok=True)
+    n_units, _, n_channels = unit_templates.shape
+    np.save(os.path.join(folder, 'spike_times.npy'), samples)
+    np.save(os.path.join(folder, 'spike_clusters.npy'), clusters)
+    np.save(os.path.join(folder, 'spike_templates.npy'), clusters)
+    np.save(os.path.join(folder, 'templates.npy'), unit_templates)
+    np.save(os.path.join(folder, 'channel_map.npy'), np.arange(n_channels, dtype=np.int32))
+    np.save(os.path.join(folder, 'amplitudes.npy'), rng.gamma(20., 1 / 20., len(samples)).astype(np.float32))
+    labels = rng.choice(['good', 'mua', 'noise'], n_units, p=[0.6, 0.4 - noise_fraction, noise_fraction])
+    with open(os.path.join(folder, 'cluster_group.tsv'), 'w') as f:
+        f.write('cluster_id\tgroup\n' + ''.join('{}\t{}\n'.format(c, l) for c, l in enumerate(labels)))
+    with open(os.path.join(folder, 'params.py'), 'w') as f:
+        f.write("dat_path = 'recording.ap.bin'\nn_channels_dat = {}\ndtype = 'int16'\noffset = 0\n"
+                "sample_rate = {}\nhp_filtered = True\n".format(n_channels + 1, sampling_rate))
@@ -0,0 +1,233 @@
+"""
+Local read-through cache for longblob attributes.
+
+Tables with the CachedBlobs mixin store, in a blobs_md5 attribute, the MD5
+of the serialized blobs of every row, computed by the client as the row is
+inserted.  Blobs are stored on local disk under the table name and a hash
+of the row's primary key and blobs_md5, so a cache hit transfers only the
+32-character checksums and the server never reads the blobs.  A
+re-populated row gets a new checksum and is fetched again; entries of
+deleted or replaced rows are never hit again and fall out through LRU
+eviction (or prune()).  Rows without a checksum (inserted from a query or
+before the attribute was added, see migrate.add_blob_hashes) are fetched
+without the cache.
+
+insert() serializes the blobs once, hashes those bytes and hands them to
+datajoint as they are (dj.blob.bypass_serialization), so an insert packs
+every blob once, as a plain table does.
+
+Settings are read from dj.config['custom']:
+    'blob_cache.location'   : cache folder (default ~/.cache/orofacial_pipeline/blobs)
+    'blob_cache.size_limit' : bytes kept on disk before eviction (default 20 GB)
+"""
+import collections.abc
+import contextlib
+import hashlib
+import os
+import tempfile
+
+import numpy as np
+import datajoint as dj
+
+
+HASH_ATTRIBUTE = 'blobs_md5'
+
+
+def pack_blobs(heading, row):
+    """
+    row (a dict) with its blob attributes serialized as datajoint stores
+    them, and their MD5: of each blob's name and bytes, in heading order.
+    """
+    row, md5 = dict(row), hashlib.md5()
+    for name in heading.secondary_attributes:
+        attr = heading[name]
+        if attr.is_blob and name in row:
+            if row[name] is not None:
+                row[name] = dj.blob.pack(attr.adapter.put(row[name]) if attr.adapter else row[name])
+            md5.update(name.encode())
+            md5.update(row[name] or b'')
+    return row, md5.hexdigest()
+
+
+def blob_hash(heading, row):
+    """MD5 of the blob attributes of row (a dict) in heading order, as datajoint serializes them."""
+    return pack_blobs(heading, row)[1]
+
+
+@contextlib.contextmanager
+def _packed():
+    # blobs are inserted as serialized by pack_blobs; adapters pass bytes through unchanged
+    dj.blob.bypass_serialization = True
+    try:
+        yield
+    finally:
+        dj.blob.bypass_serialization = False
+
+
+class BlobCache:
+
+    def __init__(self, location=None, size_limit=None):
+        settings = dj.config.get('custom') or {}
+        self.location = location or settings.get('blob_cache.location') or os.path.join(
+            os.path.expanduser('~'), '.cache', 'orofacial_pipeline', 'blobs')
+        self.size_limit = size_limit or settings.get('blob_cache.size_limit', 20 * 1024 ** 3)
+        self._size = None  # bytes on disk, counted on the first write and kept up to date after
+
+    def _folder(self, rel):
+        return os.path.join(self.location, rel.full_table_name.replace('`', '').replace('.', os.sep))
+
+    @staticmethod
+    def _name(attr, key, checksum):
+        return hashlib.sha1(repr((attr, sorted(key.items()), checksum)).encode()).hexdigest()
+
+    def fetch(self, rel, *attrs, order_by=None):
+        """
+        Same as rel.fetch(*attrs, order_by=order_by), reading blob attributes
+        through the cache.
+        """
+        if HASH_ATTRIBUTE not in rel.heading.names:
+            return rel.fetch(*attrs, order_by=order_by)
+        blobs = [a for a in attrs if a != 'KEY' and rel.heading[a].is_blob]
+        others = [a for a in attrs if a != 'KEY' and a not in blobs]
+        rows = rel.proj(*others, HASH_ATTRIBUTE).fetch(as_dict=True, order_by=order_by)
+        keys = [{k: row[k] for k in rel.primary_key} for row in rows]
+
+        folder = self._folder(rel)
+        os.makedirs(folder, exist_ok=True)
+        values = {'KEY': keys}
+        for attr in blobs:
+            paths = [os.path.join(folder, self._name(attr, key, row[HASH_ATTRIBUTE]))
+                     if row[HASH_ATTRIBUTE] else None for key, row in zip(keys, rows)]
+            result = np.empty(len(rows), dtype=object)
+            missing = []
+            for i, path in enumerate(paths):
+                if path is None:
+                    missing.append(i)
+                    continue
+                try:
+                    with open(path, 'rb') as f:
+                        result[i] = dj.blob.unpack(f.read())
+                    os.utime(path)  # mark as recently used
+                except FileNotFoundError:
+                    missing.append(i)
+            if missing:
+                fetched = {_hashable({k: row[k] for k in rel.primary_key}): row[attr]
+                           for row in (rel & [keys[i] for i in missing]).proj(attr).fetch(as_dict=True)}
+                written = 0
+                for i in missing:
+                    result[i] = fetched[_hashable(keys[i])]
+                    if paths[i] is not None:
+                        written += self._write(paths[i], dj.blob.pack(result[i]))
+                self._grow(written)
+            values[attr] = result
+
+        for attr in others:
+            values[attr] = np.array([row[attr] for row in rows])
+        return values[attrs[0]] if len(attrs) == 1 else [values[a] for a in attrs]
+
+    @staticmethod
+    def _write(path, data):
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path))
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        os.replace(tmp, path)
+        return len(data)
+
+    def _grow(self, nbytes):
+        # the running total is counted once per process; other processes' writes
+        # are picked up by the next eviction, which recounts
+        if self._size is None:
+            self._size = sum(stat.st_size for _, stat in self._entries())
+        else:
+            self._size += nbytes
+        if self._size > self.size_limit:
+            self.evict()
+
+    def _entries(self, folder=None):
+        for root, _, files in os.walk(folder or self.location):
+            for name in files:
+                path = os.path.join(root, name)
+                try:
+                    yield path, os.stat(path)
+                except FileNotFoundError:  # evicted by another process
+                    pass
+
+    def evict(self):
+        """Remove least recently used entries until the cache fits its size limit."""
+        entries = sorted(self._entries(), key=lambda e: e[1].st_mtime)
+        total = sum(stat.st_size for _, stat in entries)
+        for path, stat in entries:
+            if total <= self.size_limit:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= stat.st_size
+        self._size = total
+
+    def prune(self, rel, *attrs):
+        """Drop the entries of rel's table that no longer match a row in the database."""
+        table = rel.__class__()
+        attrs = attrs or [a for a in table.heading.secondary_attributes if table.heading[a].is_blob]
+        rows = table.proj(HASH_ATTRIBUTE).fetch(as_dict=True)
+        current = {self._name(a, {k: row[k] for k in table.primary_key}, row[HASH_ATTRIBUTE])
+                   for row in rows for a in attrs}
+        for path, _ in self._entries(self._folder(table)):
+            if os.path.basename(path) not in current:
+                os.remove(path)
+
+
+def _hashable(key):
+    return tuple(sorted(key.items()))
+
+
+_cache = None
+
+
+def get_cache():
+    global _cache
+    if _cache is None:
+        _cache = BlobCache()
+    return _cache
+
+
+class CachedBlobs:
+    """
+    Table mixin adding fetch_cached(), a drop-in for fetch() of blob
+    attributes.  The table declares a last attribute
+        blobs_md5=null : char(32)  # MD5 of the serialized blobs, set on insert
+    which insert() and update1() fill in.
+    """
+
+    def insert(self, rows, **kwargs):
+        if HASH_ATTRIBUTE not in self.heading.names or isinstance(rows, dj.expression.QueryExpression):
+            return super().insert(rows, **kwargs)
+        # rows are packed before the bypass, which would also skip unpacking in fetches made by a generator
+        rows = [self._hashed(row) for row in rows]
+        with _packed():
+            return super().insert(rows, **kwargs)
+
+    def _hashed(self, row):
+        if isinstance(row, np.void):
+            row = dict(zip(row.dtype.names, row.tolist()))
+        elif not isinstance(row, collections.abc.Mapping):
+            row = dict(zip(self.heading.names, row))
+        row, checksum = pack_blobs(self.heading, row)
+        if row.get(HASH_ATTRIBUTE) is None:
+            row[HASH_ATTRIBUTE] = checksum
+        return row
+
+    def update1(self, row):
+        if HASH_ATTRIBUTE not in self.heading.names or not any(
+                a in self.heading.names and self.heading[a].is_blob for a in row):
+            return super().update1(row)
+        key = {k: row[k] for k in self.primary_key}
+        previous = (self & key).fetch1(HASH_ATTRIBUTE) or ''
+        row, checksum = pack_blobs(self.heading, row)
+        row[HASH_ATTRIBUTE] = hashlib.md5((previous + checksum).encode()).hexdigest()
+        with _packed():
+            return super().update1(row)
+
+    def fetch_cached(self, *attrs, order_by=None):
+        return get_cache().fetch(self, *attrs, order_by=order_by)
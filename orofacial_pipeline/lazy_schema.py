@@ -0,0 +1,89 @@
+"""
+Deferred activation of the pipeline schemas.
+
+Modules declare their tables on a LazySchema, which binds nothing to the
+database when the module is imported: imports open no connection and work
+on offline nodes.  The schemas are bound to databases <prefix><name> by
+activate(), or on the first query of any of their tables, with the prefix
+from dj.config['database.prefix'].
+
+Schemas are registered as their modules are imported, so a module's
+schema always comes after those of the modules it imports, and
+activating a schema first activates every schema registered before it.
+
+Activation also enables DataJoint's adapted attribute types (opt-in in
+datajoint < 0.14 through DJ_SUPPORT_ADAPTED_TYPES), which the spike_times
+attributes use; without them those attributes would be fetched undecoded.
+"""
+import inspect
+import os
+
+import datajoint as dj
+
+_registry = []
+_activating = []
+
+
+class _Activate:
+    # stands in for the class attributes schema activation sets on a table
+    # class, and activates the schema on first access
+    def __init__(self, schema, name):
+        self.schema, self.name = schema, name
+
+    def __get__(self, instance, owner):
+        _activate_through(self.schema)
+        value = vars(owner).get(self.name, self)
+        if value is self:
+            raise dj.DataJointError('{} was not declared by the activation of schema {}'.format(
+                owner.__name__, self.schema.database))
+        return value
+
+
+class LazySchema(dj.Schema):
+    """A dj.Schema named `name` (without prefix), activated when first used."""
+
+    def __init__(self, name, **kwargs):
+        super().__init__(**kwargs)
+        self.name = name
+        _registry.append(self)
+
+    def __call__(self, cls, *, context=None):
+        context = context or self.context or inspect.currentframe().f_back.f_locals
+        super().__call__(cls, context=context)
+        if not self.is_activated():
+            for table in [cls] + [getattr(cls, name) for name in dir(cls) if name[0].isupper()]:
+                if inspect.isclass(table) and issubclass(table, dj.user_tables.UserTable):
+                    for attr in ('database', '_connection', '_heading'):
+                        setattr(table, attr, _Activate(self, attr))
+        return cls
+
+
+def _activate_through(schema, connection=None):
+    if _activating:
+        raise dj.DataJointError('Schema {} was used while activating {}; schemas are activated '
+                                'in the order their modules are imported'.format(schema.name, _activating[0]))
+    prefix = dj.config.get('database.prefix', '')
+    os.environ['DJ_SUPPORT_ADAPTED_TYPES'] = 'TRUE'
+    for pending in _registry[:_registry.index(schema) + 1]:
+        if not pending.is_activated():
+            _activating.append(pending.name)
+            try:
+                pending.activate(prefix + pending.name, connection=connection)
+            except Exception:
+                pending.database = None  # retried on the next use
+                raise
+            finally:
+                _activating.clear()
+
+
+def activate(prefix=None, connection=None):
+    """
+    Activate the schemas of all imported modules, in dependency order, as
+    <prefix><name>.  prefix (default dj.config['database.prefix']) is stored
+    in dj.config['database.prefix'], which worker processes inherit with
+    the config.
+    """
+    if prefix is not None:
+        dj.config['database.prefix'] = prefix
+    if _registry:
+        _activate_through(_registry[-1], connection)
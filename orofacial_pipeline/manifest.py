@@ -0,0 +1,210 @@
+"""
+Ingestion manifest: the source files each Imported table read for each key.
+
+Tables opt in by defining source_files(key), returning the paths make(key)
+reads.  scan() compares the files on disk against the manifest using only
+os.stat, and hashes a file only when its size or mtime changed, so a sweep
+over many sessions touches file contents only where data actually changed.
+
+    changed, missing = manifest.scan(wl_ephys.Unit)
+    manifest.reingest(wl_ephys.Unit, changed)
+
+Keys whose source files can no longer be found or read (deleted or moved)
+are reported as missing rather than changed, and are left as they are.
+
+A re-ingest deletes and populates again everything computed from the old
+files: the descendants of the table, and the tables whose make() reads it
+without a foreign key, which declare it in their derived_from property
+(e.g. ActionEvent from WhiskerBehavior).
+"""
+import hashlib
+import importlib
+import inspect
+import os
+
+import datajoint as dj
+import networkx as nx
+from datajoint.hash import key_hash
+from datajoint.utils import get_master
+from .lazy_schema import LazySchema
+from .populate import MODULES, _has_make
+
+schema = LazySchema('ingest_manifest')
+
+
+@schema
+class SourceFile(dj.Manual):
+    definition = """  # source file read by an Imported table for one of its keys
+    table_name  : varchar(255)  # full table name
+    key_hash    : char(32)      # hash of the populated key
+    file_path   : varchar(255)
+    ---
+    key         : longblob      # the populated key
+    file_size   : bigint        # (bytes)
+    file_mtime  : double        # (s) modification time
+    file_hash   : char(32)      # MD5 of the file contents
+    """
+
+
+def file_hash(path, chunk_size=1 << 22):
+    hashed = hashlib.md5()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            hashed.update(chunk)
+    return hashed.hexdigest()
+
+
+def record(table, key):
+    """Store the current state of the source files of table for key."""
+    key = {k: key[k] for k in table.key_source.primary_key}
+    entry = dict(table_name=table.full_table_name, key_hash=key_hash(key))
+    rows = []
+    for path in table.source_files(key):
+        stat = os.stat(path)
+        rows.append(dict(entry, file_path=path, key=key, file_size=stat.st_size,
+                         file_mtime=stat.st_mtime, file_hash=file_hash(path)))
+    with SourceFile.connection.transaction:
+        (SourceFile & entry).delete_quick()
+        SourceFile.insert(rows)
+
+
+def _changed(table, key, files):
+    # whether the source files of key differ from the recorded files
+    paths = table.source_files(key)
+    if set(paths) != set(files):
+        return True
+    for path in paths:
+        stat, row = os.stat(path), files[path]
+        if (stat.st_size, stat.st_mtime) == (row['file_size'], row['file_mtime']):
+            continue
+        if stat.st_size != row['file_size'] or file_hash(path) != row['file_hash']:
+            return True
+        # touched but identical: remember the new mtime to avoid hashing it again
+        SourceFile.update1(dict(row, file_mtime=stat.st_mtime))
+    return False
+
+
+def scan(table, *restrictions):
+    """
+    Keys of table (restricted by restrictions) whose source files were added,
+    removed or changed since they were recorded.  Populated keys without
+    manifest entries are recorded as they are now.
+
+    :return: (changed, missing): the changed keys, and (key, error message)
+        of the keys whose source files could not be found or read
+    """
+    table = table()
+    recorded = {}
+    for row in (SourceFile & {'table_name': table.full_table_name}).fetch(as_dict=True):
+        recorded.setdefault(row['key_hash'], {})[row['file_path']] = row
+
+    changed, missing = [], []
+    for key in (table.key_source & table.proj() & dj.AndList(restrictions)).fetch('KEY'):
+        files = recorded.get(key_hash(key))
+        try:
+            if files is None:
+                record(table, key)
+            elif _changed(table, key, files):
+                changed.append(key)
+        except (OSError, ValueError) as error:  # e.g. a deleted or moved file, an ambiguous folder
+            missing.append((key, str(error)))
+    return changed, missing
+
+
+def _tables(modules):
+    # full table name -> class, of the tables and part tables of modules
+    tables = {}
+    for module_name in modules:
+        module = importlib.import_module(__package__ + '.' + module_name)
+        for cls in vars(module).values():
+            if inspect.isclass(cls) and cls.__module__ == module.__name__:
+                for c in [cls] + [getattr(cls, n) for n in dir(cls) if n[0].isupper()]:
+                    if inspect.isclass(c) and issubclass(c, dj.user_tables.UserTable):
+                        tables[c.full_table_name] = c
+    return tables
+
+
+def _descendants(dependencies, name):
+    return {n for n in dependencies.descendants(name) if not n.isdigit()}
+
+
+def affected_tables(table, modules=MODULES):
+    """
+    The tables a re-ingest of table deletes and populates again, in
+    topological order: the auto-populated parent that table.key_source
+    iterates over (e.g. SpikeSorting for Unit) or else table itself, their
+    descendants, and the tables derived_from any of these with their
+    descendants.  Returns (classes, names) where names are the descendants
+    that populate cannot fill (e.g. TGvIRt.Trial.UnitInTrial).
+    """
+    tables = _tables(modules)
+    dependencies = table.connection.dependencies
+    dependencies.load()
+    root = table.full_table_name
+    parents = table.parents(primary=True)
+    if len(parents) == 1 and parents[0] in tables and _has_make(tables[parents[0]]) and (
+            set(table.key_source.primary_key) == set(tables[parents[0]].primary_key)):
+        root = parents[0]
+
+    affected = _descendants(dependencies, root)
+    derived = {name: {t.full_table_name for t in cls().derived_from} for name, cls in tables.items()
+               if hasattr(cls, 'derived_from')}
+    while True:
+        new = {name for name, sources in derived.items() if sources & affected and name not in affected}
+        if not new:
+            break
+        for name in new:
+            affected |= _descendants(dependencies, name)
+
+    masters = {get_master(name) or name for name in affected}
+    populated = {name for name in masters if name in tables and _has_make(tables[name])}
+    blocked = sorted(name for name in affected if (get_master(name) or name) not in populated)
+    order = {name: i for i, name in enumerate(nx.topological_sort(dependencies))}
+    return [tables[name] for name in sorted(populated, key=order.get)], blocked
+
+
+def _restriction(table, key):
+    restriction = {k: v for k, v in key.items() if k in table.heading.names}
+    if not restriction:
+        raise dj.DataJointError('{} has none of the attributes of {}'.format(table.full_table_name, key))
+    return restriction
+
+
+def reingest(table, keys, modules=MODULES):
+    """
+    Delete keys (of table.key_source) with everything computed from them
+    (affected_tables), populate them again and record their source files.
+    Deletes go from the most downstream table up, at the master level, so
+    no part table is deleted without its master.  Raises DataJointError,
+    before deleting anything, if a key has rows in a descendant that
+    populate cannot fill.
+    """
+    tables, blocked = affected_tables(table, modules)
+    table = table()
+    keys = list(keys)
+    for name in blocked:
+        blocked_table = dj.FreeTable(table.connection, name)
+        if any(blocked_table & _restriction(blocked_table, key) for key in keys):
+            raise dj.DataJointError('Re-ingesting {} would delete rows of {}, which populate cannot '
+                                    'restore'.format(table.__class__.__name__, name))
+    for key in keys:
+        with table.connection.transaction:
+            for affected in reversed(tables):
+                (affected().target & _restriction(affected, key)).delete(transaction=False, safemode=False)
+        for affected in tables:
+            affected.populate(_restriction(affected, key))
+        if table & key:
+            record(table, key)
+
+
+def sweep(tables, *restrictions):
+    """
+    Scan and re-ingest every table; returns (re-ingested keys, missing keys
+    with error messages) per table.
+    """
+    result = {}
+    for table in tables:
+        keys, missing = scan(table, *restrictions)
+        reingest(table, keys)
+        result[table.__name__] = keys, missing
+    return result
@@ -0,0 +1,119 @@
+"""
+Migrations of databases declared by earlier versions of the pipeline.
+
+DataJoint declares a table once and never alters it, so changes to a
+definition reach an existing database only through these functions.  Each
+checks the current columns first and does nothing once applied.  Run them
+after activation, in a process that has not queried the tables yet (table
+headings are read once per process):
+
+    from orofacial_pipeline import activate, migrate
+    activate()
+    migrate.migrate()
+"""
+import importlib
+import inspect
+
+import datajoint as dj
+
+from . import wanglab as lab
+from .blob_cache import CachedBlobs, HASH_ATTRIBUTE
+
+MODULES = ('wl_whisker_experiment', 'wl_ephys', 'TGvIRt')
+
+
+def _columns(table):
+    # column name -> MySQL column type, from the server rather than the cached heading
+    return dict(table.connection.query(
+        'SELECT column_name, column_type FROM information_schema.columns '
+        'WHERE table_schema = %s AND table_name = %s ORDER BY ordinal_position',
+        args=(table.database, table.table_name)).fetchall())
+
+
+def cached_tables(modules=MODULES):
+    """The tables (and part tables) of modules with the CachedBlobs mixin."""
+    tables = []
+    for module_name in modules:
+        module = importlib.import_module(__package__ + '.' + module_name)
+        for name, cls in vars(module).items():
+            if inspect.isclass(cls) and cls.__module__ == module.__name__:
+                tables.extend(c for c in [cls] + [getattr(cls, n) for n in dir(cls) if n[0].isupper()]
+                              if inspect.isclass(c) and issubclass(c, CachedBlobs))
+    return tables
+
+
+def add_blob_hashes(modules=MODULES):
+    """
+    Add the blobs_md5 attribute of the CachedBlobs tables and fill it for
+    existing rows.  The backfill hashes on the server, once, with the
+    formula of blob_cache.blob_hash (MD5 of each blob's name and stored
+    bytes, in column order), so a row gets the checksum its insert would
+    have given it.
+    """
+    for table in cached_tables(modules):
+        columns = _columns(table)
+        if HASH_ATTRIBUTE not in columns:
+            table.connection.query(
+                'ALTER TABLE {} ADD COLUMN `{}` char(32) DEFAULT NULL '
+                'COMMENT "MD5 of the serialized blobs, set on insert"'.format(
+                    table.full_table_name, HASH_ATTRIBUTE))
+        blobs = [name for name, column_type in columns.items() if column_type.endswith('blob')]
+        table.connection.query('UPDATE {} SET `{}` = MD5(CONCAT({})) WHERE `{}` IS NULL'.format(
+            table.full_table_name, HASH_ATTRIBUTE,
+            ', '.join('"{0}", COALESCE(`{0}`, "")'.format(b) for b in blobs), HASH_ATTRIBUTE))
+
+
+def double_sampling_rates(modules=MODULES):
+    """
+    Store SpikeSorting.sampling_rate as double, declared float (single
+    precision) before.  Rates already stored keep their single precision
+    value, exact for whole-Hz rates such as 30000.
+    """
+    for module_name in modules:
+        module = importlib.import_module(__package__ + '.' + module_name)
+        table = getattr(module, 'SpikeSorting', None)
+        if table is not None and _columns(table()).get('sampling_rate') == 'float':
+            table.connection.query(
+                'ALTER TABLE {} MODIFY `sampling_rate` double DEFAULT NULL '
+                'COMMENT "(Hz) sampling rate of the sorted spike times"'.format(table.full_table_name))
+
+
+def widen_channel_counts():
+    """Store lab.Probe.channel_counts as smallint, declared tinyint (at most 127) before."""
+    if _columns(lab.Probe()).get('channel_counts', '').startswith('tinyint'):
+        lab.Probe.connection.query(
+            'ALTER TABLE {} MODIFY `channel_counts` smallint NOT NULL '
+            'COMMENT "number of channels in the probe"'.format(lab.Probe.full_table_name))
+
+
+def sampled_spike_times(modules=MODULES):
+    """
+    Declare Unit.spike_times as <sampled_times>, a plain longblob before.
+    DataJoint reads the adapted type from the column comment; stored arrays
+    are fetched as they are and new sortings are stored delta-encoded.
+    """
+    if not dj.errors._support_adapted_types():
+        raise dj.DataJointError('Adapted types are disabled: activate the schemas before migrating, '
+                                'or set {}=TRUE'.format(dj.errors.ADAPTED_TYPE_SWITCH))
+    for module_name in modules:
+        module = importlib.import_module(__package__ + '.' + module_name)
+        table = getattr(module, 'Unit', None)
+        if table is None:
+            continue
+        comment, = table.connection.query(
+            'SELECT column_comment FROM information_schema.columns '
+            'WHERE table_schema = %s AND table_name = %s AND column_name = "spike_times"',
+            args=(table.database, table.table_name)).fetchone()
+        if not comment.startswith(':<sampled_times>:'):
+            table.connection.query(
+                'ALTER TABLE {} MODIFY `spike_times` longblob NOT NULL '
+                'COMMENT ":<sampled_times>:(s) with respect to the start-time of the Ephys recording '
+                'session"'.format(table.full_table_name))
+
+
+def migrate(modules=MODULES):
+    """Apply all migrations, in order."""
+    add_blob_hashes(modules)
+    double_sampling_rates(modules)
+    widen_channel_counts()
+    sampled_spike_times(modules)
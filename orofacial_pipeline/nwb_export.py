@@ -0,0 +1,322 @@
+"""
+Export of whole sessions to NWB files (pynwb) for sharing.
+
+Every dataset is written from a lazy iterator: its source, one blob or one
+column of one table, is fetched only when the writer reaches it, written in
+compressed chunks and released, so memory is bounded by the largest single
+array rather than by the session.  The spike times of all units are first
+collected a batch of units at a time into a temporary memory-mapped file
+and written from there as one ragged (indexed) column.  Times are on the
+behavior clock where ClockModel knows the device clock.
+
+    paths = nwb_export.export_sessions(experiment.Session & 'subject_id = 1', '/data/nwb', processes=8)
+    problems = nwb_export.verify_export(session_key, paths[0][1])
+"""
+import datetime
+import multiprocessing as mp
+import os
+import tempfile
+
+import h5py
+import numpy as np
+import datajoint as dj
+from hdmf.backends.hdf5 import H5DataIO
+from hdmf.common import ElementIdentifiers, VectorData, VectorIndex
+from hdmf.data_utils import AbstractDataChunkIterator, DataChunk
+from pynwb import NWBFile, NWBHDF5IO, TimeSeries
+from pynwb.epoch import TimeIntervals
+from pynwb.file import Subject
+from pynwb.misc import Units
+
+from . import wanglab as lab
+from . import wl_whisker_experiment as experiment
+from . import wl_ephys as ephys
+from .populate import _init_worker
+
+
+class _LazyArray(AbstractDataChunkIterator):
+    """Rows of the array returned by load(), loaded on first use and yielded chunk_rows at a time."""
+
+    def __init__(self, load, dtype, length=None, chunk_rows=1 << 18):
+        self._load, self._dtype, self._length, self._chunk_rows = load, np.dtype(dtype), length, chunk_rows
+        self._array, self._start = None, 0
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self._array is None:
+            self._array = self._load()
+        if self._start >= len(self._array):
+            self._array = np.zeros(0, self._dtype)  # release the source
+            raise StopIteration
+        stop = min(self._start + self._chunk_rows, len(self._array))
+        chunk = DataChunk(np.asarray(self._array[self._start:stop], dtype=self._dtype),
+                          np.s_[self._start:stop])
+        self._start = stop
+        return chunk
+
+    def __len__(self):
+        return self._length
+
+    def recommended_chunk_shape(self):
+        return (max(min(self._chunk_rows, self._length or self._chunk_rows), 1),)
+
+    def recommended_data_shape(self):
+        return (0,)
+
+    @property
+    def dtype(self):
+        return self._dtype
+
+    @property
+    def maxshape(self):
+        return (self._length,)
+
+
+def _dataset(load, dtype, length=None):
+    return H5DataIO(_LazyArray(load, dtype, length), compression='gzip', compression_opts=4, shuffle=True)
+
+
+def _column(name, description, query, attribute, dtype, length):
+    return VectorData(name=name, description=description, data=_dataset(
+        lambda: query.fetch(attribute, order_by=query.primary_key), dtype, length))
+
+
+def _to_behavior_clock(key, device):
+    if experiment.ClockModel & key & {'clock_device': device}:
+        return lambda times: experiment.ClockModel().convert(key, times, device)
+    return lambda times: np.asarray(times, dtype=np.float64)
+
+
+# ---- parts of a session ----
+
+_TRIAL_COLUMNS = ('trial_type', 'trial_instruction', 'outcome', 'early_response', 'task_protocol')
+
+
+def _trial_rows(key):
+    # SessionTrial rows in trial order, with the BehaviorTrial attributes of the trials that have them
+    behavior = {row['trial']: row for row in (experiment.BehaviorTrial & key).fetch(as_dict=True)}
+    return [dict(behavior.get(trial['trial'], {}), **trial)
+            for trial in (experiment.SessionTrial & key).fetch(as_dict=True, order_by='trial')]
+
+
+def _add_trials(nwbfile, trials):
+    nwbfile.add_trial_column('trial', 'trial number in the session')
+    for column in _TRIAL_COLUMNS:
+        nwbfile.add_trial_column(column, column.replace('_', ' '))
+    for row in trials:
+        nwbfile.add_trial(start_time=float(row['start_time']), stop_time=float(row['stop_time']),
+                          trial=row['trial'], **{c: str(row.get(c) or '') for c in _TRIAL_COLUMNS})
+
+
+def _add_events(nwbfile, key):
+    # per-trial events of each event table, in session time
+    tables = (
+        ('trial_events', 'task events', experiment.TrialEvent,
+         'trial_event_time', 'trial_event_time + duration', ('trial_event_type', 'cue_type')),
+        ('action_events', 'whisking events', experiment.ActionEvent,
+         'action_event_time', 'action_event_time', ('action_event_type',)),
+        ('photostim_events', 'photostimulation trains', experiment.PhotostimEvent,
+         'photostim_event_time', 'photostim_event_time', ('photo_stim', 'power')),
+        ('electrical_stim_events', 'electrical stimulation trains', experiment.ElectricalStimTrialEvent,
+         'elecstim_event_time', 'elecstim_event_time', ('elec_stim', 'current')))
+    for name, description, table, start, stop, attributes in tables:
+        query = (table * experiment.SessionTrial & key).proj(
+            *attributes, start_time='start_time + {}'.format(start), stop_time='start_time + {}'.format(stop))
+        n = len(query)
+        if not n:
+            continue
+        columns = [_column('start_time', 'start (s)', query, 'start_time', np.float64, n),
+                   _column('stop_time', 'stop (s)', query, 'stop_time', np.float64, n),
+                   _column('trial', 'trial number', query, 'trial', np.int32, n)]
+        for attribute in attributes:
+            string = table.heading[attribute].string
+            columns.append(_column(attribute, attribute.replace('_', ' '), query, attribute,
+                                   h5py.string_dtype() if string else np.float64, n))
+        nwbfile.add_time_intervals(TimeIntervals(
+            name=name, description=description, columns=columns,
+            id=ElementIdentifiers(name='id', data=np.arange(n))))
+
+
+def _add_stim_pulses(nwbfile, key):
+    for part, stim, level, unit in ((experiment.StimPulses.PhotoStimPulses, 'photo_stim', 'power', 'mW'),
+                                    (experiment.StimPulses.ElecStimPulses, 'elec_stim', 'current', 'uA')):
+        stims, onsets, offsets, levels = (part & key).fetch(stim, 'onsets', 'offsets', level, order_by=stim)
+        if not len(stims):
+            continue
+        n = sum(len(o) for o in onsets)
+        nwbfile.add_time_intervals(TimeIntervals(
+            name=part.__name__, description='individual stimulation pulses', id=ElementIdentifiers(
+                name='id', data=np.arange(n)), columns=[
+                VectorData(name='start_time', description='pulse onset (s)', data=np.concatenate(onsets)),
+                VectorData(name='stop_time', description='pulse offset (s)', data=np.concatenate(offsets)),
+                VectorData(name=stim, description='stimulus', data=np.repeat(stims, [len(o) for o in onsets])),
+                VectorData(name=level, description='({})'.format(unit), data=np.concatenate(levels))]))
+
+
+def _add_whisker(nwbfile, key):
+    query = experiment.WhiskerBehavior & key
+    if not query:
+        return
+    convert = _to_behavior_clock(key, 'video')
+    module = nwbfile.create_processing_module('behavior', 'whisker tracking')
+    timestamps = _dataset(lambda: convert(query.fetch1('frame_times')), np.float64)
+    for name, unit in (('angle', 'degrees'), ('amplitude', 'degrees'), ('midpoint', 'degrees'),
+                       ('phase', 'radians'), ('velocity', 'degrees/s')):
+        series = TimeSeries(name=name, unit=unit, timestamps=timestamps,
+                            data=_dataset(lambda name=name: query.fetch1(name), np.float32))
+        module.add(series)
+        timestamps = series  # the other series share the timestamps of the first
+
+
+def _write_spike_times(keys, trains, folder):
+    """
+    Write spike trains (an iterable of arrays in seconds, one per unit key)
+    to a temporary float64 file.  Returns (path, unit keys, offsets).
+    """
+    counts = []
+    with tempfile.NamedTemporaryFile(dir=folder, suffix='.spikes', delete=False) as f:
+        for train in trains:
+            train = np.ravel(train).astype(np.float64)
+            f.write(train.tobytes())
+            counts.append(train.size)
+    offsets = np.zeros(len(keys) + 1, dtype=np.int64)
+    np.cumsum(counts, out=offsets[1:])
+    return f.name, keys, offsets
+
+
+def _spike_times_file(units, key, folder, batch_size=200):
+    """
+    Write the spike times of every unit in `units` to a temporary float64 file,
+    a batch of units at a time.  Returns (path, unit keys, offsets).
+    """
+    convert = _to_behavior_clock(key, 'ephys')
+    keys = units.fetch('KEY', order_by=units.primary_key)
+
+    def trains():
+        for start in range(0, len(keys), batch_size):
+            for train in (units & keys[start:start + batch_size]).fetch('spike_times', order_by=units.primary_key):
+                yield convert(np.ravel(train))
+
+    return _write_spike_times(keys, trains(), folder)
+
+
+def _cell_types(key):
+    return dict(((row['spike_sort_method'], row['unit']), row['cell_type'])
+                for row in (ephys.Unit.CellType & key).fetch(as_dict=True))
+
+
+def _add_units(nwbfile, spike_file, cell_types):
+    """Units table of spike_file (see _write_spike_times); cell_types: (method, unit) -> cell type."""
+    path, keys, offsets = spike_file
+    n_spikes = int(offsets[-1])
+    spike_times = VectorData(name='spike_times', description='spike times (s)', data=_dataset(
+        lambda: np.memmap(path, dtype=np.float64, mode='r', shape=(n_spikes,)) if n_spikes
+        else np.zeros(0), np.float64, n_spikes))
+    nwbfile.units = Units(
+        name='units', description='sorted units', id=ElementIdentifiers(name='id', data=np.arange(len(keys))),
+        columns=[  # the index goes before the column it indexes
+            VectorIndex(name='spike_times_index', data=offsets[1:], target=spike_times), spike_times,
+            VectorData(name='unit', description='unit number in the sorting', data=[k['unit'] for k in keys]),
+            VectorData(name='spike_sort_method', description='spike sorting method',
+                       data=[k['spike_sort_method'] for k in keys]),
+            VectorData(name='cell_type', description='cell type', data=[
+                cell_types.get((k['spike_sort_method'], k['unit']), '') for k in keys])],
+        colnames=['spike_times', 'unit', 'spike_sort_method', 'cell_type'])
+
+
+# ---- sessions ----
+
+def session_file_name(key):
+    return 'sub-{subject_id}_ses-{session}.nwb'.format(**key)
+
+
+def export_session(key, folder):
+    """Write the session `key` to folder/session_file_name(key) and return its path."""
+    session = (experiment.Session & key).fetch1()
+    key = {k: session[k] for k in experiment.Session.primary_key}
+    subject = (lab.Subject & key).fetch1()
+    nwbfile = NWBFile(
+        session_description=session['session_notes'] or 'session {session} of subject {subject_id}'.format(**key),
+        identifier='{}_{}'.format(experiment.schema.database, session_file_name(key)[:-4]),
+        session_start_time=datetime.datetime.combine(session['session_date'], datetime.time()).astimezone(),
+        experimenter=(lab.User & session).fetch1('full_name') or session['user_name'],
+        lab='Wang lab', experiment_description=session['recording_type'],
+        subject=Subject(subject_id=str(subject['subject_id']), species=subject['species'], sex=subject['sex'],
+                        date_of_birth=(datetime.datetime.combine(subject['date_of_birth'], datetime.time())
+                                       .astimezone() if subject['date_of_birth'] else None)))
+
+    os.makedirs(folder, exist_ok=True)
+    path = os.path.join(folder, session_file_name(key))
+    spike_file = _spike_times_file(ephys.Unit & key, key, folder)
+    try:
+        _add_trials(nwbfile, _trial_rows(key))
+        _add_events(nwbfile, key)
+        _add_stim_pulses(nwbfile, key)
+        _add_whisker(nwbfile, key)
+        if len(spike_file[1]):
+            _add_units(nwbfile, spike_file, _cell_types(key))
+        with NWBHDF5IO(path, 'w') as io:
+            io.write(nwbfile)
+    finally:
+        os.remove(spike_file[0])
+    return path
+
+
+def _export_worker(args):
+    key, folder = args
+    try:
+        return key, export_session(key, folder), None
+    except Exception as error:
+        return key, None, '{}: {}'.format(type(error).__name__, error)
+
+
+def export_sessions(sessions, folder, processes=None):
+    """
+    Export every session of the query `sessions` in worker processes, each
+    with its own database connection.  Returns a list of (key, path, error).
+    """
+    keys = (experiment.Session & sessions).fetch('KEY')
+    processes = min(processes or os.cpu_count(), max(len(keys), 1))
+    with mp.get_context('spawn').Pool(processes, _init_worker, (dict(dj.config),)) as pool:
+        return list(pool.imap_unordered(_export_worker, [(key, folder) for key in keys]))
+
+
+def verify_export(key, path, batch_size=200):
+    """
+    Compare an exported file with the database: trials, whisker traces and the
+    spike times of every unit.  Returns a list of differences, empty if none.
+    """
+    problems = []
+    with NWBHDF5IO(path, 'r') as io:
+        nwbfile = io.read()
+        start_times = (experiment.SessionTrial & key).fetch('start_time', order_by='trial').astype(np.float64)
+        if nwbfile.trials is None and len(start_times) or nwbfile.trials is not None and not np.allclose(
+                nwbfile.trials['start_time'][:], start_times):
+            problems.append('trial start times differ')
+
+        if experiment.WhiskerBehavior & key:
+            behavior = nwbfile.processing['behavior']
+            for name in ('angle', 'amplitude', 'midpoint', 'phase', 'velocity'):
+                stored = np.asarray((experiment.WhiskerBehavior & key).fetch1(name), dtype=np.float32)
+                if not np.array_equal(behavior[name].data[:], stored):
+                    problems.append('whisker {} differs'.format(name))
+            frame_times = _to_behavior_clock(key, 'video')((experiment.WhiskerBehavior & key).fetch1('frame_times'))
+            if not np.array_equal(behavior['angle'].timestamps[:], frame_times):
+                problems.append('frame times differ')
+
+        units = ephys.Unit & key
+        keys = units.fetch('KEY', order_by=units.primary_key)
+        if len(keys) != (0 if nwbfile.units is None else len(nwbfile.units)):
+            problems.append('{} units in the database, {} in the file'.format(
+                len(keys), 0 if nwbfile.units is None else len(nwbfile.units)))
+            return problems
+        convert = _to_behavior_clock(key, 'ephys')
+        for start in range(0, len(keys), batch_size):
+            trains = (units & keys[start:start + batch_size]).fetch('spike_times', order_by=units.primary_key)
+            for i, train in enumerate(trains, start):
+                if (nwbfile.units['unit'][i] != keys[i]['unit']
+                        or not np.array_equal(nwbfile.units['spike_times'][i], convert(np.ravel(train)))):
+                    problems.append('spike times of unit {unit} ({spike_sort_method}) differ'.format(**keys[i]))
+    return problems
@@ -0,0 +1,99 @@
+"""
+Parallel populate driver for the auto-populated tables of the pipeline.
+
+Tables are populated in dependency order.  Each table is handed to a pool of
+worker processes, each with its own database connection, which claim keys
+through the schema's jobs table (populate(reserve_jobs=True)), so several
+workers, on this machine or on other nodes, never make the same key twice.
+
+Schemas are activated in the parent (auto_tables() reads the table names)
+before the pool starts; workers import the modules without a connection and
+inherit the schema prefix with the config.
+
+    python -m orofacial_pipeline.populate --processes 16 --prefix test_ wl_ephys TGvIRt
+"""
+import argparse
+import importlib
+import inspect
+import multiprocessing as mp
+import os
+
+import datajoint as dj
+import networkx as nx
+
+from .lazy_schema import activate
+
+MODULES = ('wl_whisker_experiment', 'wl_ephys', 'TGvIRt')
+
+
+def _has_make(cls):
+    return any('make' in vars(c) for c in cls.__mro__
+               if not c.__module__.startswith('datajoint'))
+
+
+def auto_tables(modules=MODULES):
+    """
+    List (module_name, class_name) of the Imported and Computed tables with a
+    make() in `modules`, sorted so that every table comes after its parents.
+    """
+    tables = []
+    for module_name in modules:
+        module = importlib.import_module(__package__ + '.' + module_name)
+        for name, cls in vars(module).items():
+            if (inspect.isclass(cls) and cls.__module__ == module.__name__
+                    and issubclass(cls, (dj.Imported, dj.Computed)) and _has_make(cls)):
+                tables.append((module_name, name, cls.full_table_name))
+
+    dependencies = dj.conn().dependencies
+    dependencies.load()
+    order = {node: i for i, node in enumerate(nx.topological_sort(dependencies))}
+    return [(module_name, name) for module_name, name, full_name
+            in sorted(tables, key=lambda t: order[t[2]])]
+
+
+def _init_worker(config):
+    dj.config.update(config)
+    dj.conn(reset=True)  # one connection per worker process
+
+
+def _populate_worker(args):
+    module_name, table_name, restrictions, populate_kwargs = args
+    table = getattr(importlib.import_module(__package__ + '.' + module_name), table_name)
+    errors = table().populate(*restrictions, reserve_jobs=True, order='random',
+                              suppress_errors=True, **populate_kwargs)
+    return [(key, str(error)) for key, error in errors or []]
+
+
+def populate(*restrictions, modules=MODULES, tables=None, processes=None, **populate_kwargs):
+    """
+    Populate `tables` (default: all auto-populated tables of `modules`) in
+    dependency order with `processes` worker processes per table.
+
+    :param restrictions: restrictions passed on to each table's populate()
+    :param tables: optional list of (module_name, class_name) to populate
+    :param processes: number of worker processes, default: number of cores
+    :return: dict mapping 'module.Table' to the list of (key, error message)
+    """
+    tables = tables or auto_tables(modules)
+    processes = processes or os.cpu_count()
+    errors = {}
+    # spawned workers start with a clean interpreter and never share the parent's socket
+    with mp.get_context('spawn').Pool(processes, _init_worker, (dict(dj.config),)) as pool:
+        for module_name, table_name in tables:
+            jobs = [(module_name, table_name, restrictions, populate_kwargs)] * processes
+            table_errors = [e for result in pool.imap_unordered(_populate_worker, jobs)
+                            for e in result]
+            if table_errors:
+                errors['{}.{}'.format(module_name, table_name)] = table_errors
+    return errors
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Populate the orofacial pipeline in parallel')
+    parser.add_argument('modules', nargs='*', default=MODULES)
+    parser.add_argument('--processes', type=int, default=None)
+    parser.add_argument('--prefix', default=None, help='schema prefix, default dj.config database.prefix')
+    args = parser.parse_args()
+    activate(args.prefix)
+    for table, table_errors in populate(modules=args.modules, processes=args.processes).items():
+        print('{}: {} errors'.format(table, len(table_errors)))
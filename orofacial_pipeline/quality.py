@@ -0,0 +1,112 @@
+"""
+Unit quality metrics, computed for all units of a sorting at once.
+
+Per-spike values (spike times, amplitudes) are passed packed as in
+spikes.pack: one buffer plus the offsets of each unit.
+"""
+import numpy as np
+
+from . import spikes
+from .spike_sorting import split_by_cluster
+
+
+def _reduce(ufunc, buffer, offsets, empty):
+    result = np.full(len(offsets) - 1, empty, dtype=np.float64)
+    nonempty = np.diff(offsets) > 0
+    if nonempty.any():
+        result[nonempty] = ufunc.reduceat(buffer, offsets[:-1][nonempty])
+    return result
+
+
+def isi_violations(buffer, offsets, refractory_period=0.0015):
+    """Fraction of each unit's inter-spike intervals shorter than refractory_period (s)."""
+    unit = spikes.unit_index(offsets)
+    short = (unit[1:] == unit[:-1]) & (np.diff(buffer) < refractory_period)
+    violations = np.bincount(unit[1:][short], minlength=len(offsets) - 1)
+    return violations / np.maximum(np.diff(offsets) - 1, 1)
+
+
+def presence_ratio(buffer, offsets, start, stop, bin_size=60.):
+    """Fraction of bin_size (s) bins between start and stop with at least one spike."""
+    n_units = len(offsets) - 1
+    n_bins = max(int(np.ceil((stop - start) / bin_size)), 1)
+    bins = np.clip(((buffer - start) / bin_size).astype(np.int64), 0, n_bins - 1)
+    occupied = np.bincount(spikes.unit_index(offsets) * n_bins + bins,
+                           minlength=n_units * n_bins).reshape(n_units, n_bins) > 0
+    return occupied.mean(axis=1)
+
+
+def amplitude_cutoff(amplitudes, offsets, n_bins=500, smoothing=3):
+    """
+    Estimated fraction of spikes missing below the detection threshold: the
+    amplitude distribution of each unit is folded about its peak and the tail
+    above the point matching the lowest-amplitude density is taken as the
+    missing fraction (Hill et al. 2011, J Neurosci), capped at 0.5.
+    """
+    from scipy.ndimage import gaussian_filter1d
+    n_units = len(offsets) - 1
+    lo = _reduce(np.minimum, amplitudes, offsets, 0)
+    hi = _reduce(np.maximum, amplitudes, offsets, 1)
+    unit = spikes.unit_index(offsets)
+    scale = (amplitudes - lo[unit]) / np.maximum(hi - lo, 1e-12)[unit]
+    bins = np.minimum((scale * n_bins).astype(np.int64), n_bins - 1)
+    hist = np.bincount(unit * n_bins + bins, minlength=n_units * n_bins).reshape(n_units, n_bins)
+    pdf = gaussian_filter1d(hist.astype(np.float64), smoothing, axis=1)
+    pdf /= np.maximum(pdf.sum(axis=1, keepdims=True), 1e-12)
+
+    peak = pdf.argmax(axis=1)
+    distance = np.abs(pdf - pdf[:, :1])
+    distance[np.arange(n_bins)[None, :] < peak[:, None]] = np.inf
+    fold = distance.argmin(axis=1)
+    tail = np.cumsum(pdf[:, ::-1], axis=1)[:, ::-1]
+    cutoff = np.minimum(tail[np.arange(n_units), fold], 0.5)
+    cutoff[np.diff(offsets) == 0] = np.nan
+    return cutoff
+
+
+def isolation_distance(features, own):
+    """
+    Mahalanobis isolation distance (Schmitzer-Torbert et al. 2005) of the
+    spikes flagged by `own` among all rows of features (spikes x dimensions);
+    nan if there are fewer other spikes than own spikes.
+    """
+    own_features, others = features[own], features[~own]
+    n = len(own_features)
+    if n <= features.shape[1] or len(others) < n:
+        return np.nan
+    deviation = others - own_features.mean(axis=0)
+    inverse = np.linalg.pinv(np.cov(own_features, rowvar=False))
+    d2 = np.einsum('ij,jk,ik->i', deviation, inverse, deviation)
+    return float(np.sqrt(np.partition(d2, n - 1)[n - 1]))
+
+
+def isolation_distances(units, spike_clusters, spike_templates, pc_features, pc_feature_ind,
+                        n_channels=4, max_spikes=20000, seed=0):
+    """
+    Isolation distance of each unit (cluster id) in phy PC feature space, on
+    the n_channels best channels of the unit's main template.  Other spikes
+    count if their template has features on all those channels.
+    """
+    rng = np.random.default_rng(seed)
+    clusters = np.asarray(spike_clusters).ravel()
+    templates = np.asarray(spike_templates).ravel()
+    channel_index = np.asarray(pc_feature_ind)
+    by_cluster = dict(split_by_cluster(clusters))
+    by_template = dict(split_by_cluster(templates))
+
+    result = np.full(len(units), np.nan)
+    for i, unit in enumerate(units):
+        if unit not in by_cluster:
+            continue
+        channels = channel_index[np.bincount(templates[by_cluster[unit]]).argmax(), :n_channels]
+        match = channel_index[:, :, None] == channels[None, None, :]  # templates x pc channels x channels
+        position = match.argmax(axis=1)
+        candidates = np.concatenate([by_template[t] for t in np.flatnonzero(match.any(axis=1).all(axis=1))
+                                     if t in by_template])
+        if candidates.size > max_spikes:
+            candidates = np.sort(rng.choice(candidates, max_spikes, replace=False))
+        features = np.take_along_axis(np.asarray(pc_features[candidates]),
+                                      position[templates[candidates]][:, None, :], axis=2)
+        result[i] = isolation_distance(features.reshape(candidates.size, -1),
+                                       clusters[candidates] == unit)
+    return result
@@ -0,0 +1,266 @@
+"""
+Memory-mapped access to raw continuous ephys recordings, keyed by
+lab.Rig.recording_system, and chunked LFP extraction.
+
+Recordings are opened as (samples x channels) memory maps, so windows of
+channels and time are read without loading the file.  LFP is low-passed
+with an FIR kernel and decimated block by block; blocks overlap by half a
+kernel, so the result does not depend on the block size and memory is
+bounded by it.
+"""
+import collections
+import glob
+import os
+import re
+
+import numpy as np
+
+from .spike_sorting import _read_params
+
+RawFile = collections.namedtuple('RawFile', ('path', 'file_format', 'dtype', 'n_channels',
+                                             'sampling_rate', 'bit_volts', 'header_bytes'))
+RawFile.__doc__ = """A raw recording: interleaved samples of n_channels after header_bytes."""
+
+
+# ---- readers ----
+
+def read_blackrock(path):
+    """Header of a Blackrock NEURALCD (.ns5/.ns6) file holding one data packet."""
+    with open(path, 'rb') as f:
+        header = f.read(314)
+        if header[:8] != b'NEURALCD':
+            raise ValueError('{} is not a NEURALCD file'.format(path))
+        header_bytes, period, clock, n_channels = (int(np.frombuffer(header, '<u4', 1, offset)[0])
+                                                   for offset in (10, 286, 290, 310))
+        extended = np.frombuffer(f.read(66 * n_channels), dtype=np.dtype([
+            ('type', 'S2'), ('electrode', '<u2'), ('label', 'S16'), ('connector', 'u1'), ('pin', 'u1'),
+            ('min_digital', '<i2'), ('max_digital', '<i2'), ('min_analog', '<i2'), ('max_analog', '<i2'),
+            ('units', 'S16'), ('filters', 'S20')]))
+        f.seek(header_bytes)
+        # file spec 3.x has 64-bit packet timestamps
+        packet_bytes = 13 if header[8] >= 3 else 9
+        packet = f.read(packet_bytes)
+    n_samples = int(np.frombuffer(packet, '<u4', 1, packet_bytes - 4)[0])
+    if header_bytes + packet_bytes + 2 * n_channels * n_samples != os.path.getsize(path):
+        raise ValueError('{} holds several data packets, which are not supported'.format(path))
+    scale = ((extended['max_analog'].astype(np.float64) - extended['min_analog'])
+             / (extended['max_digital'].astype(np.float64) - extended['min_digital']))
+    scale *= np.where(extended['units'] == b'mV', 1000., 1.)
+    return RawFile(path, 'blackrock', 'int16', n_channels, clock / period,
+                   float(np.median(scale)), header_bytes + packet_bytes)
+
+
+def _read_meta(path):
+    with open(path) as f:
+        return dict(line.strip().split('=', 1) for line in f if '=' in line)
+
+
+def read_spikeglx(path):
+    """A SpikeGLX .bin file from its .meta file."""
+    meta = _read_meta(path)
+    probe = meta.get('typeThis') == 'imec'
+    rate = float(meta['imSampRate' if probe else 'niSampRate'])
+    max_int = float(meta.get('imMaxInt', 512 if probe else 32768))
+    # neuropixels 1.0 AP gain of 500 unless the imro table says otherwise
+    gain = 500.
+    imro = re.findall(r'\(([^()]*)\)', meta.get('~imroTbl', ''))
+    if len(imro) > 1 and len(imro[1].split()) >= 4:
+        gain = float(imro[1].split()[3])
+    bit_volts = float(meta.get('imAiRangeMax' if probe else 'niAiRangeMax', 0.6)) / max_int / gain * 1e6
+    return RawFile(path[:-len('.meta')] + '.bin', 'spikeglx', 'int16', int(meta['nSavedChans']),
+                   rate, bit_volts, 0)
+
+
+def read_phy_binary(path, bit_volts=0.195):
+    """The raw binary file a phy params.py points to (e.g. Intan or Open Ephys .dat)."""
+    folder = os.path.dirname(path)
+    params = _read_params(folder)
+    dat_path = params['dat_path']
+    dat_path = dat_path[0] if isinstance(dat_path, (list, tuple)) else dat_path
+    return RawFile(os.path.join(folder, dat_path), 'binary', np.dtype(params.get('dtype', 'int16')).name,
+                   int(params['n_channels_dat']), float(params['sample_rate']), bit_volts,
+                   int(params.get('offset', 0)))
+
+
+_readers = {
+    'Blackrock': ('*.ns6', read_blackrock),
+    'SpikeGLX': ('*.ap.meta', read_spikeglx),
+    'Intan': ('params.py', read_phy_binary),
+    'OpenEphys': ('params.py', read_phy_binary),
+}
+
+
+def find_raw(folder, recording_system, hint=None):
+    """RawFile of the recording in folder, or None; hint selects among several matches."""
+    if recording_system not in _readers:
+        raise NotImplementedError('Raw recordings of {} are not supported'.format(recording_system))
+    pattern, reader = _readers[recording_system]
+    found = sorted(glob.glob(os.path.join(folder, '**', pattern), recursive=True))
+    if hint is not None and len(found) > 1:
+        found = [f for f in found if hint in f] or found
+    return reader(found[0]) if found else None
+
+
+# ---- channel maps ----
+
+def _blackrock_channel_map(raw):
+    with open(raw.path, 'rb') as f:
+        f.seek(314)
+        extended = np.frombuffer(f.read(66 * raw.n_channels), dtype=[('type', 'S2'), ('electrode', '<u2'),
+                                                                    ('rest', 'V62')])
+    # electrode ids count from 1; ids above 128 are analog inputs
+    return {channel: (None, int(e) - 1) for channel, e in enumerate(extended['electrode']) if 0 < e <= 128}
+
+
+def _saved_channels(meta):
+    subset = meta.get('snsSaveChanSubset', 'all')
+    if subset == 'all':
+        return list(range(int(meta['nSavedChans'])))
+    channels = []
+    for part in subset.split(','):
+        lo, _, hi = part.partition(':')
+        channels.extend(range(int(lo), int(hi or lo) + 1))
+    return channels
+
+
+def _spikeglx_channel_map(raw):
+    meta = _read_meta(raw.path[:-len('.bin')] + '.meta')
+    imro = re.findall(r'\(([^()]*)\)', meta.get('~imroTbl', ''))
+    if not imro:
+        return None  # an NI-DAQ recording
+    probe_type = int(imro[0].split(',')[0])
+    sites = []
+    for entry in imro[1:]:
+        fields = [int(v) for v in entry.split()]
+        if probe_type in (21, 2003, 2004):  # 2.0 single shank: chan bank_mask refid electrode
+            sites.append((0, fields[3]))
+        elif probe_type in (24, 2013, 2014):  # 2.0 four shanks: chan shank bank refid electrode
+            sites.append((fields[1], fields[4]))
+        else:  # 1.0: chan bank refid apgain lfgain
+            sites.append((0, fields[1] * 384 + fields[0]))
+    n_ap, n_lf = (int(n) for n in meta['snsApLfSy'].split(',')[:2])
+    # acquisition channels are AP, then LF, then sync; the file holds the saved subset
+    return {channel: sites[c if c < n_ap else c - n_ap]
+            for channel, c in enumerate(_saved_channels(meta)) if c < n_ap + n_lf}
+
+
+def phy_channel_map(folder):
+    """
+    The channel map of a phy folder, channel -> (shank_id, electrode).
+    channel_map.npy holds the recording channel of each row of the
+    templates, which records the site of the same number (the probe's
+    default map, as KiloSort is given it); channel_shanks.npy, if present,
+    the shank of each row.
+    """
+    channels = np.load(os.path.join(folder, 'channel_map.npy')).ravel()
+    shanks_path = os.path.join(folder, 'channel_shanks.npy')
+    shanks = np.load(shanks_path).ravel() if os.path.exists(shanks_path) else np.zeros(len(channels), int)
+    return {int(c): (int(s), int(c)) for c, s in zip(channels, shanks)}
+
+
+def channel_map(raw, folder=None):
+    """
+    The probe site recorded on each channel of a RawFile, as a dict
+    channel -> (shank_id, electrode), from the channel map the recording
+    carries: the extended headers of a Blackrock file (shank_id None), the
+    IMRO table of a SpikeGLX file, or the channel_map.npy of the phy folder
+    (default the folder of the file) for binary files.  Channels without a
+    site (sync, analog inputs) are left out.  None if there is no map.
+    """
+    if raw.file_format == 'blackrock':
+        return _blackrock_channel_map(raw)
+    if raw.file_format == 'spikeglx':
+        return _spikeglx_channel_map(raw)
+    folder = folder or os.path.dirname(raw.path)
+    if os.path.exists(os.path.join(folder, 'channel_map.npy')):
+        return phy_channel_map(folder)
+    return None
+
+
+def sorting_channel_map(folder, recording_system, sorting_folder, hint=None):
+    """
+    The channel map of the raw recording in folder (see channel_map), or
+    if it has none that of the phy output in sorting_folder; None if
+    neither has one.
+    """
+    recording = find_raw(folder, recording_system, hint) if recording_system in _readers else None
+    sites = channel_map(recording) if recording is not None else None
+    if sites is None and os.path.exists(os.path.join(sorting_folder, 'channel_map.npy')):
+        sites = phy_channel_map(sorting_folder)
+    return sites
+
+
+def electrode_keys(sites, electrodes):
+    """
+    The lab.Probe.Electrode key of each channel of a channel map, from the
+    keys of the probe's electrodes; a site without shank_id (Blackrock)
+    matches its electrode if only one shank has it.  Channels whose site
+    is not found are left out.
+    """
+    index = {}
+    for electrode in electrodes:
+        for site in ((electrode['shank_id'], electrode['electrode']), (None, electrode['electrode'])):
+            index.setdefault(site, []).append(electrode)
+    return {channel: index[site][0] for channel, site in sites.items() if len(index.get(site, ())) == 1}
+
+
+# ---- access ----
+
+def open_memmap(raw):
+    """Read-only (samples x channels) memory map of a RawFile."""
+    itemsize = np.dtype(raw.dtype).itemsize
+    n_samples = (os.path.getsize(raw.path) - raw.header_bytes) // (itemsize * raw.n_channels)
+    return np.memmap(raw.path, dtype=raw.dtype, mode='r', offset=raw.header_bytes,
+                     shape=(n_samples, raw.n_channels))
+
+
+def read_window(raw, channels=None, start=None, stop=None, scale=True):
+    """
+    Samples start:stop (indices) of channels (indices, default all) as a
+    (samples x channels) array, float32 uV if scale else the stored integers.
+    """
+    data = open_memmap(raw)[start:stop]
+    data = data if channels is None else data[:, np.asarray(channels)]
+    return data.astype(np.float32) * np.float32(raw.bit_volts) if scale else np.asarray(data)
+
+
+# ---- LFP ----
+
+def lfp_kernel(sampling_rate, lfp_rate=1000., cutoff=300., half_length=8):
+    """
+    Low-pass FIR kernel and integer decimation factor from sampling_rate to
+    about lfp_rate; the kernel spans half_length output samples each side.
+    """
+    from scipy import signal
+    factor = max(int(round(sampling_rate / lfp_rate)), 1)
+    return signal.firwin(2 * half_length * factor + 1, cutoff, fs=sampling_rate), factor
+
+
+def decimate(raw, channels, start, stop, kernel, factor, block_size=60000):
+    """
+    LFP samples start:stop (indices at the decimated rate) of channels as a
+    float32 (samples x channels) array in uV, computed block_size input
+    samples at a time.
+    """
+    from scipy import signal
+    data = open_memmap(raw)
+    pad = len(kernel) // 2
+    half = pad // factor
+    channels = np.asarray(channels)
+    result = np.empty((stop - start, len(channels)), dtype=np.float32)
+    out_block = max(block_size // factor, 1)
+    for out_start in range(start, stop, out_block):
+        out_stop = min(out_start + out_block, stop)
+        lo, hi = out_start * factor - pad, (out_stop - 1) * factor + pad + 1
+        seg_lo, seg_hi = max(lo, 0), min(hi, len(data))
+        seg = data[seg_lo:seg_hi][:, channels].astype(np.float32)
+        seg = np.pad(seg, ((seg_lo - lo, hi - seg_hi), (0, 0)), mode='reflect')
+        # output n of upfirdn is centered on segment sample n * factor - pad
+        filtered = signal.upfirdn(kernel, seg, down=factor, axis=0)
+        result[out_start - start:out_stop - start] = filtered[2 * half:2 * half + out_stop - out_start]
+    return result * np.float32(raw.bit_volts)
+
+
+def decimate_job(job):
+    """decimate(*job), for process pools."""
+    return decimate(*job)
@@ -1,6 +1,7 @@
 import datajoint as dj
+from .lazy_schema import LazySchema
 
-schema = dj.schema(dj.config.get('database.prefix', '') + 'reference')
+schema = LazySchema('reference')
 
 
 @schema
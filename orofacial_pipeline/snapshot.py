@@ -0,0 +1,601 @@
+"""
+Read-only snapshots of the pipeline schemas in Arrow files, for analysis
+away from the database server or without one.
+
+dump() writes every table of the snapshot modules under
+<folder>/<module>/<Table[.Part]>/, one file per session for tables keyed by
+subject_id and session (per subject for tables keyed by subject_id only).
+Longblobs of numeric arrays become list columns, with a '<name>.shape'
+column for n-d arrays; other blobs are kept as packed bytes.  Files are
+uncompressed Arrow IPC, which is memory-mapped on read, or Parquet for
+transfer.
+
+Snapshot opens such a folder and answers the usual restrict / join / fetch
+queries: dict restrictions select the session files to open, and rows of
+an unfiltered file are handed out as views into the memory map.
+
+    snapshot.dump('/data/snapshot', [{'subject_id': 12}, {'subject_id': 13}])
+
+    snap = snapshot.Snapshot('/data/snapshot')
+    units = snap.wl_ephys.Unit & session_key
+    spike_times, waveforms = (units * snap.wl_ephys.Unit.Waveform).fetch('spike_times', 'waveform')
+
+    python -m orofacial_pipeline.snapshot /data/snapshot --subjects 12 13
+"""
+import argparse
+import datetime
+import decimal
+import glob
+import importlib
+import inspect
+import itertools
+import json
+import os
+import uuid
+
+import numpy as np
+import datajoint as dj
+
+MODULES = ('wanglab', 'reference', 'TGvIRt', 'wl_whisker_experiment', 'wl_ephys')
+PARTITION_BY = ('subject_id', 'session')
+
+
+# ---- dump ----
+
+def snapshot_tables(modules=MODULES):
+    """List ('module.Table' or 'module.Table.Part', class) of the tables of `modules`."""
+    tables = []
+    for module_name in modules:
+        module = importlib.import_module(__package__ + '.' + module_name)
+        for name, cls in vars(module).items():
+            if (inspect.isclass(cls) and cls.__module__ == module.__name__
+                    and issubclass(cls, (dj.Manual, dj.Lookup, dj.Imported, dj.Computed))):
+                tables.append(('{}.{}'.format(module_name, name), cls))
+                tables.extend(('{}.{}.{}'.format(module_name, name, part_name), part)
+                              for part_name, part in vars(cls).items()
+                              if inspect.isclass(part) and issubclass(part, dj.Part))
+    return tables
+
+
+def _arrow_type(attr):
+    import pyarrow as pa
+    # None for blobs, which are typed from their content
+    if attr.is_blob or attr.adapter:
+        return None
+    if attr.dtype is not object:
+        return pa.from_numpy_dtype(np.dtype(attr.dtype))
+    sql_type = attr.type.lower()
+    if attr.numeric:
+        return pa.float64() if sql_type.startswith(('decimal', 'numeric')) else pa.int64()
+    if sql_type == 'date':
+        return pa.date32()
+    if sql_type.startswith(('datetime', 'timestamp')):
+        return pa.timestamp('us')
+    if sql_type.startswith('time'):
+        return pa.duration('us')
+    return pa.string()
+
+
+def _scalar(value):
+    if isinstance(value, decimal.Decimal):
+        return float(value)
+    return str(value) if isinstance(value, uuid.UUID) else value
+
+
+def _blob_columns(name, values):
+    import pyarrow as pa
+    # numeric arrays -> large list column (+ shape column), anything else -> packed blobs
+    present = [np.asarray(v) for v in values if v is not None]
+    if not present or any(v.dtype.kind not in 'biuf' for v in present):
+        return {name: pa.array([None if v is None else dj.blob.pack(v) for v in values], pa.large_binary())}
+    is_null = np.array([v is None for v in values])
+    counts = np.zeros(len(values), dtype=np.int64)
+    counts[~is_null] = [v.size for v in present]
+    offsets = np.zeros(len(values) + 1, dtype=np.int64)
+    np.cumsum(counts, out=offsets[1:])
+    flat = np.concatenate([v.ravel() for v in present]).astype(
+        np.result_type(*{v.dtype for v in present}), copy=False)
+    columns = {name: pa.LargeListArray.from_arrays(pa.array(offsets), pa.array(flat), mask=pa.array(is_null))}
+    if any(v.ndim != 1 for v in present):
+        shapes = iter(v.shape for v in present)
+        columns[name + '.shape'] = pa.array([None if null else list(next(shapes)) for null in is_null],
+                                            pa.list_(pa.int64()))
+    return columns
+
+
+def _record_batch(heading, rows):
+    import pyarrow as pa
+    columns = {}
+    for name, attr in heading.attributes.items():
+        arrow_type, values = _arrow_type(attr), rows[name]
+        if arrow_type is None:
+            columns.update(_blob_columns(name, list(values)))
+        elif values.dtype != object:
+            columns[name] = pa.array(values, arrow_type)
+        else:
+            columns[name] = pa.array([_scalar(v) for v in values], arrow_type)
+    return pa.RecordBatch.from_pydict(columns)
+
+
+def _partition_folder(folder, partition_by, values):
+    return os.path.join(folder, *('{}={}'.format(a, v) for a, v in zip(partition_by, values)))
+
+
+def _write_partition(query, folder, file_format, batch_rows):
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+    # a new file is started whenever blob columns change type between batches
+    os.makedirs(folder, exist_ok=True)
+    written, writer, schema = [], None, None
+    for offset in itertools.count(0, batch_rows):
+        rows = query.fetch(order_by=query.primary_key, limit=batch_rows, offset=offset)
+        if not len(rows):
+            break
+        batch = _record_batch(query.heading, rows)
+        if writer is None or batch.schema != schema:
+            if writer is not None:
+                writer.close()
+            schema = batch.schema
+            path = os.path.join(folder, 'part-{:04d}.{}.tmp'.format(len(written), file_format))
+            writer = (pq.ParquetWriter(path, schema, compression='zstd') if file_format == 'parquet'
+                      else pa.ipc.new_file(path, schema))
+            written.append(path)
+        writer.write_table(pa.Table.from_batches([batch]))
+        if len(rows) < batch_rows:
+            break
+    if writer is not None:
+        writer.close()
+    # swap the partition's files only once all of them are written
+    for old in glob.glob(os.path.join(folder, 'part-*')):
+        if not old.endswith('.tmp'):
+            os.remove(old)
+    for path in written:
+        os.replace(path, path[:-len('.tmp')])
+    return bool(written)
+
+
+def dump_table(table, folder, *restrictions, file_format='arrow', batch_rows=10000):
+    """
+    Write the rows of table under folder, one folder per partition of the
+    restrictions (replacing what it held) and rows fetched batch_rows at a
+    time; returns the list of partition values written.
+    """
+    query = table
+    for restriction in restrictions:
+        query = query & restriction
+    partition_by = [a for a in PARTITION_BY if a in table.primary_key]
+    if not partition_by:
+        _write_partition(query, folder, file_format, batch_rows)
+        return []
+    partitions = (dj.U(*partition_by) & query).fetch(*partition_by, order_by=partition_by)
+    written = []
+    for values in zip(*partitions):
+        values = tuple(int(v) for v in values)
+        if _write_partition(query & dict(zip(partition_by, values)),
+                            _partition_folder(folder, partition_by, values), file_format, batch_rows):
+            written.append(values)
+    return written
+
+
+def dump(folder, *restrictions, modules=MODULES, file_format='arrow', batch_rows=10000):
+    """
+    Dump the tables of `modules` to a snapshot in folder.
+
+    Restrictions select the partitions (sessions or subjects) to write and
+    should select them whole; partitions already in the snapshot are kept
+    unless written again.  Tables without subject_id are always written
+    whole.
+
+    :param file_format: 'arrow' (IPC, memory-mapped on read) or 'parquet'
+    :return: the snapshot manifest
+    """
+    manifest_path = os.path.join(folder, 'manifest.json')
+    manifest = {'tables': {}}
+    if os.path.exists(manifest_path):
+        with open(manifest_path) as f:
+            manifest = json.load(f)
+    for name, cls in snapshot_tables(modules):
+        table = cls()
+        path = os.path.join(*name.split('.', 1))
+        partition_by = [a for a in PARTITION_BY if a in table.primary_key]
+        written = dump_table(table, os.path.join(folder, path), *(restrictions if partition_by else ()),
+                             file_format=file_format, batch_rows=batch_rows)
+        previous = manifest['tables'].get(name, {}).get('partitions', []) if restrictions else []
+        manifest['tables'][name] = dict(
+            path=path, full_table_name=table.full_table_name, primary_key=table.primary_key,
+            attributes=table.heading.names, partition_by=partition_by,
+            blobs=[a.name for a in table.heading.attributes.values() if _arrow_type(a) is None],
+            partitions=sorted({tuple(p) for p in previous} | set(written)))
+    manifest.update(created=datetime.datetime.now().isoformat(timespec='seconds'),
+                    host=dj.config['database.host'], prefix=dj.config.get('database.prefix', ''))
+    with open(manifest_path + '.tmp', 'w') as f:
+        json.dump(manifest, f, indent=1)
+    os.replace(manifest_path + '.tmp', manifest_path)
+    return manifest
+
+
+# ---- read ----
+
+def _value_array(values):
+    array = np.empty(len(values), dtype=object)
+    for i, value in enumerate(values):
+        array[i] = value
+    return array
+
+
+def _values(table, name):
+    import pyarrow as pa
+    # column of an Arrow table as fetch() returns it
+    column = table[name]
+    if pa.types.is_large_list(column.type):
+        values = []
+        for chunk in column.chunks:
+            offsets = chunk.offsets.to_numpy()
+            flat = chunk.values.to_numpy(zero_copy_only=False)
+            valid = chunk.is_valid().to_numpy(zero_copy_only=False)
+            values.extend(flat[offsets[i]:offsets[i + 1]] if valid[i] else None for i in range(len(chunk)))
+        if name + '.shape' in table.column_names:
+            values = [v if v is None or s is None else v.reshape(s)
+                      for v, s in zip(values, table[name + '.shape'].to_pylist())]
+        return _value_array(values)
+    if pa.types.is_large_binary(column.type):
+        return _value_array([None if b is None else dj.blob.unpack(b) for b in column.to_pylist()])
+    if pa.types.is_temporal(column.type):
+        return _value_array(column.to_pylist())
+    return column.to_numpy()
+
+
+def _join_keys(left, right):
+    import pyarrow as pa
+    return [c for c in left.column_names if c in right.column_names
+            and not pa.types.is_large_list(left.schema.field(c).type)
+            and not pa.types.is_large_binary(left.schema.field(c).type) and not c.endswith('.shape')]
+
+
+def _match(left, right, join_type):
+    import pyarrow as pa
+    # (left index, right index) of the rows of a join on the common attributes
+    common = _join_keys(left, right)
+    if not common:
+        return (np.repeat(np.arange(left.num_rows), right.num_rows),
+                np.tile(np.arange(right.num_rows), left.num_rows))
+    if not left.num_rows or not right.num_rows:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+    keys = pa.table([left[c] for c in common] + [pa.array(np.arange(left.num_rows))],
+                    names=common + ['__left'])
+    other = pa.table([right[c].cast(left[c].type) for c in common] + [pa.array(np.arange(right.num_rows))],
+                     names=common + ['__right'])
+    joined = keys.join(other, common, join_type=join_type)
+    if join_type == 'left semi':
+        return np.sort(joined['__left'].to_numpy()), None
+    joined = joined.sort_by([('__left', 'ascending'), ('__right', 'ascending')])
+    return joined['__left'].to_numpy(), joined['__right'].to_numpy()
+
+
+def _join(left, right):
+    left_index, right_index = _match(left, right, 'inner')
+    result = left.take(left_index)
+    for name in right.column_names:
+        if name not in left.column_names:
+            result = result.append_column(right.schema.field(name), right[name].take(right_index))
+    return result
+
+
+def _mask(table, restriction):
+    import pyarrow as pa
+    import pyarrow.compute as pc
+    if isinstance(restriction, dict):
+        mask = np.ones(table.num_rows, dtype=bool)
+        for attr, value in restriction.items():
+            if attr in table.column_names:
+                column = table[attr]
+                value = pa.scalar(value.item() if isinstance(value, np.generic) else _scalar(value))
+                value = value if value.type == column.type else value.cast(column.type)
+                mask &= pc.fill_null(pc.equal(column, value), False).to_numpy(zero_copy_only=False)
+        return mask
+    if isinstance(restriction, (list, tuple)):
+        return np.logical_or.reduce([_mask(table, r) for r in restriction] +
+                                    [np.zeros(table.num_rows, dtype=bool)])
+    if isinstance(restriction, Query):
+        mask = np.zeros(table.num_rows, dtype=bool)
+        mask[_match(table, restriction.to_arrow(), 'left semi')[0]] = True
+        return mask
+    if isinstance(restriction, pc.Expression):
+        rows = pa.table({'__row': np.arange(table.num_rows)})
+        for name in table.column_names:
+            rows = rows.append_column(name, table[name])
+        mask = np.zeros(table.num_rows, dtype=bool)
+        mask[rows.filter(restriction)['__row'].to_numpy()] = True
+        return mask
+    raise TypeError('Snapshots are restricted by dicts, lists, snapshot queries or pyarrow.compute '
+                    'expressions, not {}'.format(type(restriction).__name__))
+
+
+def _restrict(table, restriction, negate=False):
+    import pyarrow as pa
+    mask = _mask(table, restriction)
+    mask = ~mask if negate else mask
+    # unfiltered tables stay views into the memory map
+    return table if mask.all() else table.filter(pa.array(mask))
+
+
+def _partition_values(restrictions):
+    # allowed values of the partition attributes under the (and-ed) restrictions
+    allowed = {}
+    for negate, restriction in restrictions:
+        dicts = ([restriction] if isinstance(restriction, dict) else list(restriction)
+                 if isinstance(restriction, (list, tuple)) else [])
+        if negate or not dicts or not all(isinstance(r, dict) for r in dicts):
+            continue
+        for attr in PARTITION_BY:
+            if all(attr in r for r in dicts):
+                values = {int(r[attr]) for r in dicts}
+                allowed[attr] = allowed[attr] & values if attr in allowed else values
+    return allowed
+
+
+def _concat(tables, blobs):
+    import pyarrow as pa
+    # files of a table may hold a blob as lists of different types, or packed
+    if not tables:
+        return None
+    for name in blobs:
+        types = {t.schema.field(name).type for t in tables}
+        if len(types) < 2:
+            continue
+        if all(pa.types.is_large_list(t) for t in types):
+            value_type = pa.from_numpy_dtype(np.result_type(*(t.value_type.to_pandas_dtype() for t in types)))
+            tables = [t.set_column(t.column_names.index(name), name, t[name].cast(pa.large_list(value_type)))
+                      for t in tables]
+        else:
+            tables = [t if pa.types.is_large_binary(t.schema.field(name).type) else t.set_column(
+                t.column_names.index(name), pa.field(name, pa.large_binary()),
+                pa.array([None if v is None else dj.blob.pack(v) for v in _values(t, name)], pa.large_binary()))
+                for t in tables]
+    return pa.concat_tables(tables, promote_options='default')
+
+
+class Snapshot:
+    """
+    Read-only queries over a dump() folder, which need no database
+    connection.  Tables are snapshot.module.Table[.Part] or
+    snapshot['module.Table.Part'].
+    """
+
+    def __init__(self, folder):
+        self.folder = folder
+        with open(os.path.join(folder, 'manifest.json')) as f:
+            self.manifest = json.load(f)
+        self._files = {}
+
+    @property
+    def tables(self):
+        return list(self.manifest['tables'])
+
+    def __getitem__(self, name):
+        if name not in self.manifest['tables']:
+            raise KeyError('{} is not in the snapshot {}'.format(name, self.folder))
+        return Query(self, (name,))
+
+    def __getattr__(self, name):
+        if not name.startswith('_') and name != 'manifest' and any(
+                table.split('.')[0] == name for table in self.manifest['tables']):
+            return _Module(self, name)
+        raise AttributeError(name)
+
+    def _open(self, path):
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+        if path.endswith('.parquet'):
+            return pq.read_table(path, memory_map=True)
+        if path not in self._files:
+            self._files[path] = pa.ipc.open_file(pa.memory_map(path)).read_all()
+        return self._files[path]
+
+    def read(self, name, partition_values=None):
+        """Arrow table of the rows of table name in the partitions with the allowed partition_values."""
+        import pyarrow as pa
+        info = self.manifest['tables'][name]
+        folder = os.path.join(self.folder, info['path'])
+        folders = [folder]
+        if info['partition_by']:
+            allowed = partition_values or {}
+            folders = [_partition_folder(folder, info['partition_by'], values) for values in info['partitions']
+                       if all(v in allowed.get(a, (v,)) for a, v in zip(info['partition_by'], values))]
+        table = _concat([self._open(path) for f in folders
+                         for path in sorted(glob.glob(os.path.join(f, 'part-*')))
+                         if not path.endswith('.tmp')], info['blobs'])
+        if table is None:
+            table = pa.table({a: pa.nulls(0) for a in info['attributes']})
+        return table
+
+
+class _Module:
+
+    def __init__(self, snapshot, name):
+        self._snapshot, self._name = snapshot, name
+
+    def __getattr__(self, name):
+        try:
+            return self._snapshot['{}.{}'.format(self._name, name)]
+        except KeyError:
+            raise AttributeError(name)
+
+    def __dir__(self):
+        return [t.split('.')[1] for t in self._snapshot.tables if t.split('.')[0] == self._name]
+
+
+class Query:
+    """
+    A query over a Snapshot: a natural join of tables or queries, restricted
+    with & and -, and projected with proj(), fetched like a datajoint query.
+    """
+
+    def __init__(self, snapshot, sources, restrictions=(), projection=None):
+        self._snapshot, self._sources = snapshot, tuple(sources)
+        self._restrictions, self._projection = tuple(restrictions), projection
+
+    def __getattr__(self, name):
+        # part tables of a bare table
+        if (not name.startswith('_') and len(self._sources) == 1 and isinstance(self._sources[0], str)
+                and not self._restrictions and self._projection is None):
+            part = '{}.{}'.format(self._sources[0], name)
+            if part in self._snapshot.manifest['tables']:
+                return Query(self._snapshot, (part,))
+        raise AttributeError(name)
+
+    def __repr__(self):
+        return '<snapshot query of {} ({} restrictions)>'.format(
+            ' * '.join(s if isinstance(s, str) else 'subquery' for s in self._sources), len(self._restrictions))
+
+    def _source_heading(self, source):
+        if isinstance(source, Query):
+            return source.primary_key, source.heading
+        info = self._snapshot.manifest['tables'][source]
+        return info['primary_key'], info['attributes']
+
+    def _joined_heading(self):
+        primary_key, heading = [], []
+        for source in self._sources:
+            source_key, source_heading = self._source_heading(source)
+            primary_key += [a for a in source_key if a not in primary_key]
+            heading += [a for a in source_heading if a not in heading]
+        return primary_key, heading
+
+    @property
+    def primary_key(self):
+        primary_key, _ = self._joined_heading()
+        if self._projection is None:
+            return primary_key
+        renamed = {old: new for new, old in self._projection}
+        return [renamed.get(a, a) for a in primary_key]
+
+    @property
+    def heading(self):
+        """Attribute names."""
+        return self._joined_heading()[1] if self._projection is None else [new for new, _ in self._projection]
+
+    def _closed(self):
+        # restrictions and joins apply after a projection
+        return Query(self._snapshot, (self,)) if self._projection is not None else self
+
+    def __and__(self, restriction):
+        query = self._closed()
+        return Query(self._snapshot, query._sources, query._restrictions + ((False, restriction),))
+
+    def __sub__(self, restriction):
+        query = self._closed()
+        return Query(self._snapshot, query._sources, query._restrictions + ((True, restriction),))
+
+    def __mul__(self, other):
+        left, right = self._closed(), other._closed()
+        if left._restrictions or right._restrictions:
+            return Query(self._snapshot, (left, right))
+        return Query(self._snapshot, left._sources + right._sources)
+
+    def proj(self, *attributes, **renamed):
+        """The primary key, attributes and new=old renamed attributes."""
+        query = self._closed()
+        projection = [(a, a) for a in query.primary_key if a not in renamed.values()]
+        projection += [(new, old) for new, old in renamed.items()]
+        projection += [(a, a) for a in attributes if a not in query.primary_key]
+        return Query(self._snapshot, query._sources, query._restrictions, projection)
+
+    def _partition_values(self):
+        # also those of joined and restricting queries, which share the attributes they carry
+        allowed = _partition_values(self._restrictions)
+        queries = [s for s in self._sources if isinstance(s, Query)]
+        queries += [r for negate, r in self._restrictions if not negate and isinstance(r, Query)]
+        for query in queries:
+            if query._projection is None:
+                for attr, values in query._partition_values().items():
+                    allowed[attr] = allowed[attr] & values if attr in allowed else values
+        return allowed
+
+    def to_arrow(self):
+        """The result as an Arrow table."""
+        return self._evaluate({})
+
+    def _evaluate(self, outer_values):
+        import pyarrow as pa
+        partition_values = self._partition_values()
+        for attr, values in outer_values.items():
+            partition_values[attr] = partition_values[attr] & values if attr in partition_values else values
+        result = None
+        for source in self._sources:
+            if isinstance(source, Query):
+                table = source._evaluate(partition_values if source._projection is None else {})
+            else:
+                table = self._snapshot.read(source, partition_values)
+                # equality restrictions also hold for every joined table carrying their attributes
+                for negate, restriction in self._restrictions:
+                    if not negate and isinstance(restriction, dict) and len(self._sources) > 1:
+                        table = _restrict(table, restriction)
+            result = table if result is None else _join(result, table)
+        for negate, restriction in self._restrictions:
+            result = _restrict(result, restriction, negate)
+        if self._projection is not None:
+            columns = [(new + suffix, old + suffix) for new, old in self._projection for suffix in ('', '.shape')
+                       if old + suffix in result.column_names]
+            result = pa.table([result[old] for _, old in columns], names=[new for new, _ in columns])
+        return result
+
+    def __len__(self):
+        return self.to_arrow().num_rows
+
+    def __bool__(self):
+        return len(self) > 0
+
+    def fetch(self, *attrs, as_dict=False, order_by=None, limit=None, offset=None):
+        """
+        Same as datajoint fetch(): a record array (or list of dicts) of all
+        attributes, or the values of attrs, 'KEY' for the primary keys.
+        Numeric blobs are read-only views into the snapshot files.
+        """
+        table = self.to_arrow()
+        if order_by is not None:
+            order_by = [order_by] if isinstance(order_by, str) else order_by
+            order_by = [a for o in order_by for a in (self.primary_key if o == 'KEY' else [o])]
+            table = table.sort_by([(o.split()[0], 'descending' if o.upper().endswith(' DESC') else 'ascending')
+                                   for o in order_by])
+        if limit is not None or offset:
+            table = table.slice(offset or 0, limit)
+
+        def values(attr):
+            if attr == 'KEY':
+                return [dict(zip(self.primary_key, row))
+                        for row in zip(*(table[a].to_pylist() for a in self.primary_key))]
+            return _values(table, attr)
+
+        names = list(attrs) or self.heading
+        columns = [values(a) for a in names]
+        if as_dict:
+            return [dict(zip(names, row)) for row in zip(*columns)]
+        if attrs:
+            return columns[0] if len(columns) == 1 else columns
+        rows = np.empty(table.num_rows, dtype=[(n, c.dtype) for n, c in zip(names, columns)])
+        for name, column in zip(names, columns):
+            rows[name] = column
+        return rows
+
+    def fetch1(self, *attrs):
+        """The one row of the query as a dict, or the values of attrs."""
+        rows = self.fetch(*attrs, as_dict=True)
+        if len(rows) != 1:
+            raise dj.DataJointError('fetch1 should only return one tuple. %d tuples found' % len(rows))
+        row = rows[0]
+        if not attrs:
+            return row
+        return row[attrs[0]] if len(attrs) == 1 else tuple(row[a] for a in attrs)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Dump the pipeline schemas to an Arrow snapshot')
+    parser.add_argument('folder')
+    parser.add_argument('modules', nargs='*', default=MODULES)
+    parser.add_argument('--subjects', type=int, nargs='*', help='dump only these subjects')
+    parser.add_argument('--format', choices=('arrow', 'parquet'), default='arrow')
+    args = parser.parse_args()
+    restrictions = [[{'subject_id': s} for s in args.subjects]] if args.subjects else []
+    manifest = dump(args.folder, *restrictions, modules=args.modules, file_format=args.format)
+    print('{} tables written to {}'.format(len(manifest['tables']), args.folder))
@@ -0,0 +1,62 @@
+"""
+Compact storage for spike times that come from a sampling clock.
+
+Spike times inserted as SampledSpikeTimes(samples, sampling_rate) are stored
+as the first sample index plus the successive differences in the narrowest
+integer type that holds them; the blob is then compressed by DataJoint.
+On fetch they are decoded to float64 seconds, samples / sampling_rate, which
+is exactly what was inserted.  Plain arrays are stored and returned as is.
+
+Adapted attribute types are opt-in in datajoint < 0.14; lazy_schema enables
+them when the schemas are activated.
+"""
+import collections
+
+import numpy as np
+import datajoint as dj
+
+SampledSpikeTimes = collections.namedtuple('SampledSpikeTimes', ('samples', 'sampling_rate'))
+
+_delta_types = (np.uint8, np.int8, np.uint16, np.int16, np.uint32, np.int32, np.int64)
+
+
+def encode(samples, sampling_rate):
+    samples = np.asarray(samples, dtype=np.int64).ravel()
+    deltas = np.diff(samples)
+    if deltas.size:
+        lo, hi = deltas.min(), deltas.max()
+        dtype = next(t for t in _delta_types if np.iinfo(t).min <= lo and hi <= np.iinfo(t).max)
+        deltas = deltas.astype(dtype)
+    return {'codec': 'delta', 'sampling_rate': float(sampling_rate), 'count': samples.size,
+            'first': int(samples[0]) if samples.size else 0, 'deltas': deltas}
+
+
+def decode_samples(value):
+    samples = np.empty(value['count'], dtype=np.int64)
+    if samples.size:
+        samples[0] = value['first']
+        np.cumsum(value['deltas'], dtype=np.int64, out=samples[1:])
+        samples[1:] += value['first']
+    return samples
+
+
+def decode(value):
+    """Spike times in seconds from a stored value, encoded or not."""
+    if isinstance(value, dict) and value.get('codec') == 'delta':
+        return decode_samples(value) / value['sampling_rate']
+    return value
+
+
+class SampledTimesAdapter(dj.AttributeAdapter):
+    attribute_type = 'longblob'
+
+    def put(self, obj):
+        if isinstance(obj, SampledSpikeTimes):
+            return encode(obj.samples, obj.sampling_rate)
+        return obj
+
+    def get(self, value):
+        return decode(value)
+
+
+sampled_times = SampledTimesAdapter()
@@ -0,0 +1,344 @@
+"""
+Readers for spike sorter outputs, keyed by reference.SpikeSortingMethod.
+
+Large arrays are opened as memory maps and split per cluster with stable
+sorts over batches of clusters, so that memory is bounded by the batch size
+rather than by the length of the recording.
+"""
+import os
+import glob
+import csv
+
+import numpy as np
+
+from .spike_codec import SampledSpikeTimes
+
+
+class Sorting:
+    """
+    Output of one spike sorting run.
+
+    spike_samples and spike_clusters may be memory maps; units() yields
+    (cluster_id, spike_samples, spike_index) one cluster at a time.
+    """
+
+    def __init__(self, folder, sampling_rate, spike_samples, spike_clusters,
+                 labels=None, waveforms=None, channels=None, extras=None):
+        self.folder = folder
+        self.sampling_rate = float(sampling_rate)
+        self.spike_samples = spike_samples
+        self.spike_clusters = spike_clusters
+        self.labels = labels or {}  # cluster_id -> curation label (good/mua/noise)
+        self._waveforms = waveforms  # callable: (cluster_id, spike_index) -> (samples x channels)
+        self.channels = channels  # recording channel of each waveform column
+        self.extras = extras or {}  # other per-spike arrays, e.g. phy amplitudes and pc_features
+
+    def units(self, exclude=('noise',)):
+        for cluster, index in split_by_cluster(self.spike_clusters):
+            if self.labels.get(cluster) in exclude:
+                continue
+            samples = np.asarray(self.spike_samples[index], dtype=np.int64).ravel()
+            if samples.size > 1 and np.any(samples[1:] < samples[:-1]):
+                order = np.argsort(samples, kind='stable')
+                samples, index = samples[order], index[order]
+            yield cluster, samples, index
+
+    def waveform(self, cluster, index):
+        if self._waveforms is None:
+            return None
+        return self._waveforms(cluster, index)
+
+
+def split_by_cluster(spike_clusters, max_spikes=2 ** 26, chunk_size=2 ** 24):
+    """
+    Yield (cluster_id, spike_index) for each cluster, in ascending cluster
+    order, spike_index in recording order.
+
+    Clusters are taken in batches of about max_spikes spikes (a larger
+    cluster makes a batch of its own) and each batch is split with one
+    stable argsort, so memory grows with max(max_spikes, largest cluster)
+    rather than with the recording.  spike_clusters (e.g. a memory map) is
+    read chunk_size spikes at a time, once to count and once per batch.
+    """
+    clusters = np.asarray(spike_clusters).reshape(-1)
+    chunks = [slice(start, start + chunk_size) for start in range(0, clusters.size, chunk_size)]
+    counted = [np.unique(clusters[chunk], return_counts=True) for chunk in chunks]
+    if not counted:
+        return
+    ids, inverse = np.unique(np.concatenate([c[0] for c in counted]), return_inverse=True)
+    counts = np.bincount(inverse, np.concatenate([c[1] for c in counted])).astype(np.int64)
+
+    batches, size = [[]], 0
+    for cluster, count in zip(ids.tolist(), counts.tolist()):
+        if size and size + count > max_spikes:
+            batches.append([])
+            size = 0
+        batches[-1].append(cluster)
+        size += count
+
+    for batch in batches:
+        lo, hi = batch[0], batch[-1]
+        if len(batches) == 1:
+            index, values = None, np.asarray(clusters)
+        else:
+            index, values = [], []
+            for chunk in chunks:
+                values_chunk = np.asarray(clusters[chunk])
+                inside = np.flatnonzero((values_chunk >= lo) & (values_chunk <= hi))
+                index.append(inside + chunk.start)
+                values.append(values_chunk[inside])
+            index, values = np.concatenate(index), np.concatenate(values)
+        order = np.argsort(values, kind='stable')
+        values = values[order]
+        if index is not None:
+            order = index[order]
+        starts = np.flatnonzero(np.concatenate([[True], values[1:] != values[:-1]]))
+        stops = np.append(starts[1:], order.size)
+        for start, stop in zip(starts, stops):
+            yield int(values[start]), order[start:stop]
+
+
+# ---- phy (KiloSort, SpykingCircus and JRclust exports) ----
+
+def _read_params(folder):
+    params = {}
+    with open(os.path.join(folder, 'params.py')) as f:
+        exec(f.read(), {}, params)
+    return params
+
+
+_PHY_FILES = ('params.py', 'spike_times.npy', 'spike_templates.npy', 'spike_clusters.npy', 'templates.npy',
+              'whitening_mat_inv.npy', 'channel_map.npy', 'amplitudes.npy', 'pc_features.npy',
+              'pc_feature_ind.npy')
+
+
+def _labels_file(folder):
+    for name in ('cluster_group.tsv', 'cluster_KSLabel.tsv'):
+        path = os.path.join(folder, name)
+        if os.path.exists(path):
+            return path
+    return None
+
+
+def _read_labels(folder):
+    path = _labels_file(folder)
+    if path is None:
+        return {}
+    with open(path) as f:
+        rows = list(csv.reader(f, delimiter='\t'))
+    return {int(r[0]): r[1] for r in rows[1:] if len(r) > 1}
+
+
+def _phy_files(folder):
+    files = [os.path.join(folder, name) for name in _PHY_FILES] + [_labels_file(folder)]
+    return [path for path in files if path is not None and os.path.exists(path)]
+
+
+def load_phy(folder):
+    def npy(name):
+        path = os.path.join(folder, name)
+        return np.load(path, mmap_mode='r') if os.path.exists(path) else None
+
+    spike_samples = npy('spike_times.npy')
+    spike_templates = npy('spike_templates.npy')
+    spike_clusters = npy('spike_clusters.npy')
+    if spike_clusters is None:
+        spike_clusters = spike_templates
+
+    templates = npy('templates.npy')  # templates x samples x channels, whitened
+    winv = npy('whitening_mat_inv.npy')
+
+    def waveforms(cluster, index):
+        # template most used by the spikes of this cluster, back in unwhitened space
+        if spike_templates is None:
+            template = cluster
+        else:
+            template = np.bincount(np.asarray(spike_templates[index]).ravel()).argmax()
+        if template >= templates.shape[0]:
+            return None
+        wf = np.asarray(templates[template], dtype=np.float32)
+        return wf @ winv.astype(np.float32) if winv is not None else wf
+
+    return Sorting(folder, _read_params(folder)['sample_rate'], spike_samples, spike_clusters,
+                   labels=_read_labels(folder),
+                   waveforms=waveforms if templates is not None else None,
+                   channels=npy('channel_map.npy'),
+                   extras={name: npy(name + '.npy') for name in
+                           ('amplitudes', 'pc_features', 'pc_feature_ind', 'spike_templates')
+                           if os.path.exists(os.path.join(folder, name + '.npy'))})
+
+
+# ---- JRclust (v4 *_res.mat) ----
+
+def _loadmat(path, names):
+    try:
+        import h5py
+        with h5py.File(path, 'r') as f:  # v7.3 files are HDF5
+            return {n: np.array(f[n]).T for n in names if n in f}
+    except (ImportError, OSError):
+        from scipy.io import loadmat
+        mat = loadmat(path, variable_names=names)
+        return {n: mat[n] for n in names if n in mat}
+
+
+def _jrclust_files(folder):
+    return [sorted(glob.glob(os.path.join(folder, '*_res.mat')))[0],
+            sorted(glob.glob(os.path.join(folder, '*.prm')))[0]]
+
+
+def load_jrclust(folder):
+    res_file, prm_file = _jrclust_files(folder)
+    params = {}
+    with open(prm_file) as f:
+        for line in f:
+            name, _, value = line.partition('=')
+            params[name.strip()] = value.split('%')[0].strip().rstrip(';')
+
+    mat = _loadmat(res_file, ['spikeTimes', 'spikeClusters', 'meanWfGlobal'])
+    # JRclust is 1-based (samples and clusters); cluster <= 0 is noise
+    spike_samples = mat['spikeTimes'].ravel().astype(np.int64) - 1
+    spike_clusters = mat['spikeClusters'].ravel().astype(np.int64)
+    labels = {int(c): 'noise' for c in np.unique(spike_clusters) if c <= 0}
+    mean_wf = mat.get('meanWfGlobal')  # samples x sites x clusters
+
+    def waveforms(cluster, index):
+        return np.asarray(mean_wf[:, :, cluster - 1], dtype=np.float32)
+
+    return Sorting(folder, float(params['sampleRate']), spike_samples, spike_clusters,
+                   labels=labels,
+                   waveforms=waveforms if mean_wf is not None else None,
+                   channels=np.arange(mean_wf.shape[1]) if mean_wf is not None else None)
+
+
+# ---- SpykingCircus native output (*.result.hdf5) ----
+
+def _spyking_circus_files(folder):
+    return [sorted(glob.glob(os.path.join(folder, '*.result.hdf5')))[0],
+            sorted(glob.glob(os.path.join(folder, '*.params')))[0]]
+
+
+def load_spyking_circus(folder):
+    import h5py
+
+    result_file, params_file = _spyking_circus_files(folder)
+    rate = None
+    with open(params_file) as f:
+        for line in f:
+            name, _, value = line.partition('=')
+            if name.strip() == 'sampling_rate':
+                rate = float(value.split('#')[0])
+
+    # spikes are already stored per template, so build the flat arrays lazily
+    with h5py.File(result_file, 'r') as f:
+        names = sorted(f['spiketimes'], key=lambda n: int(n.split('_')[-1]))
+        counts = [f['spiketimes'][n].shape[0] for n in names]
+        spike_samples = np.empty(sum(counts), dtype=np.int64)
+        spike_clusters = np.repeat(np.arange(len(names)), counts)
+        for name, start, count in zip(names, np.cumsum([0] + counts[:-1]), counts):
+            f['spiketimes'][name].read_direct(spike_samples, dest_sel=np.s_[start:start + count])
+
+    return Sorting(folder, rate, spike_samples, spike_clusters)
+
+
+# files identifying the output of each method, in order of preference
+_readers = {
+    'KS': [('spike_times.npy', load_phy)],
+    'SC': [('spike_times.npy', load_phy), ('*.result.hdf5', load_spyking_circus)],
+    'JRC': [('spike_times.npy', load_phy), ('*_res.mat', load_jrclust)],
+    'MS': [('spike_times.npy', load_phy)],
+    'KK': [('spike_times.npy', load_phy)],
+}
+
+# files each reader reads from the output folder
+_reader_files = {load_phy: _phy_files, load_jrclust: _jrclust_files, load_spyking_circus: _spyking_circus_files}
+
+
+def find_sorting(folder, method, hint=None):
+    """
+    Locate the output of spike sorting `method` in `folder` or its subfolders.
+    When several outputs are found, the one whose path contains `hint`
+    (e.g. the probe name) is used.  Returns None if nothing is found.
+    """
+    for pattern, reader in _readers.get(method, []):
+        found = sorted(os.path.dirname(p) for p in
+                       glob.glob(os.path.join(folder, '**', pattern), recursive=True))
+        if hint is not None and len(found) > 1:
+            found = [p for p in found if hint in p] or found
+        if len(found) > 1:
+            raise ValueError('Ambiguous {} outputs in {}: {}'.format(method, folder, found))
+        if found:
+            return found[0], reader
+    return None
+
+
+def load_sorting(folder, method, hint=None):
+    found = find_sorting(folder, method, hint)
+    if found is None:
+        raise FileNotFoundError('No {} output found in {}'.format(method, folder))
+    path, reader = found
+    return reader(path)
+
+
+def source_files(folder, method, hint=None):
+    """
+    The files the reader of `method` reads from its output folder (see
+    find_sorting); raw recordings, logs and other files next to them are
+    not included.
+    """
+    found = find_sorting(folder, method, hint)
+    if found is None:
+        return []
+    path, reader = found
+    return sorted(_reader_files[reader](path))
+
+
+def insert_units(unit_table, key, sorting, electrodes, packed=False, max_bytes=64 * 1024 ** 2):
+    """
+    Insert every unit of `sorting` under the SpikeSorting `key` into `unit_table`
+    along with its CellType and Waveform parts.  Rows are sent in multi-row
+    batches of roughly max_bytes, so only one batch of spike trains is held in
+    memory and the whole sorting goes in within the caller's transaction.
+
+    electrodes: dict recording channel -> lab.Probe.Electrode key (see
+    raw.electrode_keys).  Waveforms are left out if the sorting does not
+    say which channel each waveform column was recorded on.
+    packed: insert waveforms as one PackedWaveform row per unit instead of
+    one Waveform row per electrode (for high channel count probes).
+    """
+    units, cell_types, waveforms = [], [], []
+    waveform_table = unit_table.PackedWaveform if packed else unit_table.Waveform
+    if sorting.channels is not None:
+        unmapped = sorted(set(int(channel) for channel in sorting.channels) - set(electrodes))
+        if unmapped:
+            raise ValueError('Channels {} of {} have no electrode in the channel map'.format(
+                unmapped, sorting.folder))
+        channels = [electrodes[int(channel)] for channel in sorting.channels]
+        electrode_ids = np.array([e['electrode'] for e in channels])
+        shank_ids = np.array([e['shank_id'] for e in channels])
+
+    def flush():
+        unit_table.insert(units)
+        unit_table.CellType.insert(cell_types)
+        waveform_table.insert(waveforms)
+        for rows in (units, cell_types, waveforms):
+            rows.clear()
+
+    size = 0
+    for cluster, samples, index in sorting.units():
+        unit_key = dict(key, unit=cluster)
+        units.append(dict(unit_key, spike_times=SampledSpikeTimes(samples, sorting.sampling_rate)))
+        cell_types.append(dict(unit_key, cell_type='not classified'))
+        size += samples.nbytes
+        wf = sorting.waveform(cluster, index) if sorting.channels is not None else None
+        if wf is not None and packed:
+            waveforms.append(dict(unit_key, electrodes=electrode_ids, shank_ids=shank_ids,
+                                  waveforms=np.ascontiguousarray(wf.T, dtype=np.float32)))
+            size += wf.nbytes
+        elif wf is not None:
+            for column, electrode in enumerate(channels):
+                waveforms.append(dict(unit_key, **electrode, waveform=wf[:, column]))
+            size += wf.nbytes
+        if size >= max_bytes:
+            flush()
+            size = 0
+    flush()
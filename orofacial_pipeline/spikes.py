@@ -0,0 +1,157 @@
+"""
+Vectorized operations on ragged sets of spike trains.
+
+A set of spike trains is held as one contiguous buffer plus an offsets array
+(CSR layout): the spikes of unit i are buffer[offsets[i]:offsets[i + 1]],
+each train sorted in time.
+"""
+import collections
+
+import numpy as np
+
+
+SpikeTrains = collections.namedtuple('SpikeTrains', ('buffer', 'offsets', 'keys'))
+SpikeTrains.__doc__ = """
+Packed spike trains: the spikes of keys[i] are buffer[offsets[i]:offsets[i + 1]].
+keys is a structured array of the units' primary keys.
+"""
+
+
+def pack(trains, dtype=np.float64):
+    """Concatenate a sequence of spike trains into (buffer, offsets)."""
+    counts = np.fromiter((len(t) for t in trains), dtype=np.int64, count=len(trains))
+    offsets = np.zeros(len(trains) + 1, dtype=np.int64)
+    np.cumsum(counts, out=offsets[1:])
+    buffer = np.empty(offsets[-1], dtype=dtype)
+    for train, start, stop in zip(trains, offsets[:-1], offsets[1:]):
+        buffer[start:stop] = train
+    return buffer, offsets
+
+
+def unpack(buffer, offsets):
+    """Views of the individual trains in buffer."""
+    return [buffer[start:stop] for start, stop in zip(offsets[:-1], offsets[1:])]
+
+
+def unit_index(offsets):
+    """Unit index of every spike in the buffer."""
+    return np.repeat(np.arange(len(offsets) - 1), np.diff(offsets))
+
+
+def expand(starts, counts):
+    """Concatenation of arange(start, start + count) for every start, count."""
+    counts = np.asarray(counts, dtype=np.int64).ravel()
+    total = counts.sum()
+    shift = np.repeat(np.asarray(starts, dtype=np.int64).ravel() - np.cumsum(counts) + counts, counts)
+    return shift + np.arange(total)
+
+
+def window_offsets(buffer, offsets, lo, hi):
+    """
+    Locate the spikes of every unit inside every window [lo, hi).
+
+    Returns an int64 array (n_units x n_windows x 2) of (start, stop) indices
+    into each unit's own train, so that the spikes of unit u in window w are
+    train_u[start:stop].
+
+    When the windows do not overlap (e.g. trials), all spikes of all units are
+    binned against the sorted window boundaries in a single searchsorted pass.
+    Otherwise each unit is searched separately.
+    """
+    lo, hi = np.asarray(lo, dtype=np.float64).ravel(), np.asarray(hi, dtype=np.float64).ravel()
+    n_units, n_windows = len(offsets) - 1, lo.size
+    result = np.zeros((n_units, n_windows, 2), dtype=np.int64)
+    if not n_units or not n_windows:
+        return result
+
+    order = np.argsort(lo, kind='stable')
+    bounds = np.column_stack([lo[order], hi[order]]).ravel()
+    if np.all(np.diff(bounds) >= 0):
+        # bin b = number of bounds <= t: odd bins are inside window (b - 1) // 2
+        n_bins = bounds.size + 1
+        bins = np.searchsorted(bounds, buffer, side='right')
+        counts = np.bincount(unit_index(offsets) * n_bins + bins,
+                             minlength=n_units * n_bins).reshape(n_units, n_bins)
+        before = np.cumsum(counts, axis=1)
+        result[:, order, 0] = before[:, 0:-1:2]
+        result[:, order, 1] = before[:, 1::2]
+    else:
+        for u, (start, stop) in enumerate(zip(offsets[:-1], offsets[1:])):
+            train = buffer[start:stop]
+            result[u, :, 0] = np.searchsorted(train, lo)
+            result[u, :, 1] = np.searchsorted(train, hi)
+    return result
+
+
+def window_spikes(buffer, offsets, lo, hi):
+    """
+    All (spike, window) memberships for windows [lo, hi).
+
+    Returns (spike_index, unit, window): spike_index indexes into buffer, and
+    spikes that fall in several overlapping windows are listed once per window.
+    """
+    index = window_offsets(buffer, offsets, lo, hi)
+    n_units, n_windows = index.shape[:2]
+    counts = (index[:, :, 1] - index[:, :, 0]).ravel()
+    starts = (index[:, :, 0] + offsets[:-1, None]).ravel()
+    units = np.repeat(np.repeat(np.arange(n_units), n_windows), counts)
+    windows = np.repeat(np.tile(np.arange(n_windows), n_units), counts)
+    return expand(starts, counts), units, windows
+
+
+def fetch_packed(units, attribute='spike_times', batch_size=500, rate_attribute=None):
+    """
+    Fetch the spike trains of every row of the query `units` into SpikeTrains,
+    in primary key order, batch_size rows per query.
+
+    If rate_attribute names a sampling rate attribute of `units`, spike times
+    are returned as int64 sample indices instead of float64 seconds.
+    """
+    primary_key = units.primary_key
+    keys = units.proj().fetch(order_by=primary_key)
+    chunks, counts = [], []
+    for start in range(0, len(keys), batch_size):
+        batch = [dict(zip(keys.dtype.names, row)) for row in keys[start:start + batch_size].tolist()]
+        if rate_attribute is None:
+            trains = (units & batch).fetch(attribute, order_by=primary_key)
+            trains = [np.asarray(t, dtype=np.float64).ravel() for t in trains]
+        else:
+            trains, rates = (units & batch).fetch(attribute, rate_attribute, order_by=primary_key)
+            trains = [np.rint(np.asarray(t).ravel() * rate).astype(np.int64) for t, rate in zip(trains, rates)]
+        counts.extend(len(t) for t in trains)
+        if trains:
+            chunks.append(np.concatenate(trains))
+    offsets = np.zeros(len(counts) + 1, dtype=np.int64)
+    np.cumsum(counts, out=offsets[1:])
+    dtype = np.float64 if rate_attribute is None else np.int64
+    buffer = np.concatenate(chunks) if chunks else np.zeros(0, dtype=dtype)
+    return SpikeTrains(buffer, offsets, keys)
+
+
+def bin_counts(buffer, offsets, edges):
+    """
+    Spike counts of every unit in the bins between sorted edges, as a sparse
+    (bins x units) matrix in CSR form (data, indices, indptr), data uint16
+    counts and indices int32 units.  Spikes outside the edges are dropped.
+    """
+    n_units, n_bins = len(offsets) - 1, len(edges) - 1
+    bins = np.searchsorted(edges, buffer, side='right') - 1
+    inside = (bins >= 0) & (bins < n_bins)
+    cells, counts = np.unique(bins[inside] * n_units + unit_index(offsets)[inside], return_counts=True)
+    indptr = np.zeros(n_bins + 1, dtype=np.int64)
+    np.cumsum(np.bincount(cells // n_units, minlength=n_bins), out=indptr[1:])
+    return counts.astype(np.uint16), (cells % n_units).astype(np.int32), indptr
+
+
+def rebin_counts(data, indices, indptr, n_units, factor):
+    """CSR (bins x units) counts summed over groups of factor consecutive bins."""
+    n_bins = len(indptr) - 1
+    keys = np.repeat(np.arange(n_bins), np.diff(indptr)) // factor * n_units + indices
+    order = np.argsort(keys, kind='stable')
+    cells, first = np.unique(keys[order], return_index=True)
+    summed = np.add.reduceat(data[order].astype(np.int64), first) if cells.size else np.zeros(0, np.int64)
+    n_coarse = -(-n_bins // factor)
+    coarse_indptr = np.zeros(n_coarse + 1, dtype=np.int64)
+    np.cumsum(np.bincount(cells // n_units, minlength=n_coarse), out=coarse_indptr[1:])
+    return summed.astype(np.uint16 if summed.max(initial=0) < 2 ** 16 else np.uint32), \
+        (cells % n_units).astype(np.int32), coarse_indptr
@@ -0,0 +1,115 @@
+"""
+Stimulation pulse trains and the responses of packed spike trains (see
+spikes.py) to them, computed for all units at once.
+"""
+import numpy as np
+
+from . import spikes
+
+
+def expand_pulse_trains(onsets, pulse_duration, pulse_frequency=0, pulse_per_train=1):
+    """
+    Onsets and offsets (s) of every pulse of the trains starting at `onsets`.
+
+    pulse_duration in s, pulse_frequency in Hz; a train of pulse_per_train
+    pulses.  Returns (pulse_onsets, pulse_offsets, train) where train is the
+    index into onsets of each pulse.
+    """
+    onsets = np.asarray(onsets, dtype=np.float64).ravel()
+    n_pulses = max(int(pulse_per_train or 1), 1)
+    period = 1. / pulse_frequency if pulse_frequency and n_pulses > 1 else 0.
+    pulse_onsets = (onsets[:, None] + period * np.arange(n_pulses)[None, :]).ravel()
+    train = np.repeat(np.arange(onsets.size), n_pulses)
+    return pulse_onsets, pulse_onsets + pulse_duration, train
+
+
+def first_spike_latencies(buffer, offsets, onsets, window):
+    """
+    Latency (s) of the first spike of every unit within window s of every
+    onset, as a (units x onsets) array, nan where there is none.
+    """
+    onsets = np.asarray(onsets, dtype=np.float64).ravel()
+    index = spikes.window_offsets(buffer, offsets, onsets, onsets + window)
+    has_spike = index[:, :, 1] > index[:, :, 0]
+    latency = np.full(has_spike.shape, np.nan)
+    first = (index[:, :, 0] + offsets[:-1, None])[has_spike]
+    latency[has_spike] = buffer[first] - np.broadcast_to(onsets, has_spike.shape)[has_spike]
+    return latency
+
+
+def _latency_histograms(latency, window, bin_size):
+    # units x windows latencies -> units x (bins + 1) probabilities, last bin for no spike
+    n_bins = max(int(round(window / bin_size)), 1)
+    bins = np.where(np.isnan(latency), n_bins,
+                    np.minimum(np.nan_to_num(latency / bin_size).astype(np.int64), n_bins - 1))
+    n_units = latency.shape[0]
+    unit = np.repeat(np.arange(n_units), latency.shape[1])
+    hist = np.bincount(unit * (n_bins + 1) + bins.ravel(),
+                       minlength=n_units * (n_bins + 1)).reshape(n_units, n_bins + 1)
+    return hist / np.maximum(hist.sum(axis=1, keepdims=True), 1)
+
+
+def _js_divergence(p, q):
+    m = (p + q) / 2
+    with np.errstate(divide='ignore', invalid='ignore'):
+        kl_p = np.where(p > 0, p * np.log2(p / m), 0.).sum(axis=-1)
+        kl_q = np.where(q > 0, q * np.log2(q / m), 0.).sum(axis=-1)
+    return np.sqrt((kl_p + kl_q) / 2)
+
+
+def salt(buffer, offsets, pulse_onsets, train_onsets, window=0.01, baseline=1., bin_size=0.001):
+    """
+    Stimulus-associated spike latency test (Kvitsiani et al. 2013, Nature).
+
+    First-spike latency distributions after the pulses are compared to those
+    in consecutive window-long segments of the baseline s before each train.
+    Returns (p, i) per unit: p is the fraction of baseline segments at least
+    as distant from the others as the stimulated one (median Jensen-Shannon
+    distance), i the difference of that distance from the baseline mean.
+    """
+    train_onsets = np.asarray(train_onsets, dtype=np.float64).ravel()
+    n_segments = max(int(round(baseline / window)), 1)
+    segment_onsets = train_onsets[None, :] - window * np.arange(n_segments, 0, -1)[:, None]
+
+    latency = first_spike_latencies(buffer, offsets, np.concatenate([pulse_onsets, segment_onsets.ravel()]),
+                                    window)
+    n_pulses = len(pulse_onsets)
+    hists = [_latency_histograms(latency[:, :n_pulses], window, bin_size)]
+    for segment in np.split(latency[:, n_pulses:], n_segments, axis=1):
+        hists.append(_latency_histograms(segment, window, bin_size))
+    hists = np.stack(hists, axis=1)  # units x (1 + segments) x bins
+
+    # distance of every distribution to each baseline segment, excluding itself
+    distance = _js_divergence(hists[:, :, None, :], hists[:, None, 1:, :])  # units x (1 + segments) x segments
+    if n_segments > 1:
+        distance[:, 1 + np.arange(n_segments), np.arange(n_segments)] = np.nan
+    median = np.nanmedian(distance, axis=2)
+    test, null = median[:, 0], median[:, 1:]
+    p = ((null >= test[:, None]).sum(axis=1) + 1) / (n_segments + 1)
+    return p, test - null.mean(axis=1)
+
+
+def merge_intervals(starts, stops):
+    """Union of the intervals [starts, stops) as sorted, disjoint (starts, stops)."""
+    starts, stops = np.asarray(starts, dtype=np.float64).ravel(), np.asarray(stops, dtype=np.float64).ravel()
+    if not starts.size:
+        return starts, stops
+    order = np.argsort(starts, kind='stable')
+    starts, reach = starts[order], np.maximum.accumulate(stops[order])
+    new = np.r_[True, starts[1:] > reach[:-1]]
+    return starts[new], reach[np.r_[new[1:], True]]
+
+
+def in_intervals(times, starts, stops):
+    """Whether each time falls in one of the disjoint, sorted intervals [starts, stops)."""
+    bounds = np.column_stack([starts, stops]).ravel()
+    return np.searchsorted(bounds, times, side='right') % 2 == 1
+
+
+def mask_spikes(buffer, offsets, starts, stops):
+    """Packed spike trains without the spikes inside the disjoint, sorted intervals."""
+    keep = ~in_intervals(buffer, starts, stops)
+    counts = np.bincount(spikes.unit_index(offsets)[keep], minlength=len(offsets) - 1)
+    kept_offsets = np.zeros_like(offsets)
+    np.cumsum(counts, out=kept_offsets[1:])
+    return buffer[keep], kept_offsets
@@ -0,0 +1,89 @@
+"""
+Alignment of the clocks of different acquisition devices from the sync
+pulses they all record.
+
+A clock model is a set of knots: the times of the same pulses on the device
+clock and on the reference clock.  Times convert piecewise-linearly between
+knots (a single np.interp) and linearly beyond the first and last knot.
+"""
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+
+
+def _anchor(device, reference, template_length):
+    # index pair (i, j) such that device pulse i is reference pulse j, from the
+    # inter-pulse interval pattern at the start of either sequence; the median
+    # error tolerates a pulse dropped or added inside the pattern, and the pair
+    # is taken at the best matching interval, on the aligned side of such a pulse
+    device_ipi, reference_ipi = np.diff(device), np.diff(reference)
+    best = (np.inf, 0, 0)
+    for template, other, swap in ((device_ipi, reference_ipi, False), (reference_ipi, device_ipi, True)):
+        n = min(template_length, len(template), len(other))
+        if n < 1:
+            continue
+        errors = np.abs(sliding_window_view(other, n) - template[:n])
+        error = np.median(errors, axis=1)
+        lag = int(error.argmin())
+        if error[lag] < best[0]:
+            k = int(errors[lag].argmin())
+            best = (error[lag], k, lag + k) if not swap else (error[lag], lag + k, k)
+    return best[1], best[2]
+
+
+def match_pulses(device, reference, device_codes=None, reference_codes=None,
+                 tolerance=None, template_length=32, iterations=3):
+    """
+    Pairs of indices (device_index, reference_index) of the same pulses in two
+    sorted arrays of pulse times.
+
+    Pulses carrying codes (e.g. trial bitcodes) are matched by code; otherwise
+    the sequences are anchored on their inter-pulse intervals and every pulse
+    is matched to the nearest reference pulse under a linear fit of the
+    matches so far, within tolerance s (default a quarter of the median
+    inter-pulse interval).
+    """
+    device, reference = np.asarray(device, dtype=np.float64), np.asarray(reference, dtype=np.float64)
+    if device_codes is not None and reference_codes is not None:
+        _, device_index, reference_index = np.intersect1d(
+            np.asarray(device_codes), np.asarray(reference_codes), return_indices=True)
+        order = np.argsort(device_index)
+        return device_index[order], reference_index[order]
+    if len(device) < 2 or len(reference) < 2:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+
+    if tolerance is None:
+        tolerance = np.median(np.diff(reference)) / 4
+    i, j = _anchor(device, reference, template_length)
+    slope, intercept = 1., reference[j] - device[i]
+    for _ in range(iterations):
+        predicted = slope * device + intercept
+        nearest = np.clip(np.searchsorted(reference, predicted), 1, len(reference) - 1)
+        nearest -= (predicted - reference[nearest - 1]) < (reference[nearest] - predicted)
+        matched = np.abs(reference[nearest] - predicted) < tolerance
+        if matched.sum() < 2:
+            break
+        slope, intercept = np.polyfit(device[matched], reference[nearest[matched]], 1)
+    # drop outliers of the final fit (e.g. spurious pulses near a real one)
+    # and match every reference pulse at most once, to its closest device pulse
+    residual = np.abs(reference[nearest] - slope * device - intercept)
+    matched &= residual <= max(10 * np.median(residual[matched]), 1e-3)
+    candidates = np.flatnonzero(matched)
+    candidates = candidates[np.argsort(residual[candidates], kind='stable')]
+    _, first = np.unique(nearest[candidates], return_index=True)
+    device_index = np.sort(candidates[first])
+    return device_index, nearest[device_index]
+
+
+def convert(times, knots_from, knots_to):
+    """Convert times from the clock of knots_from to that of knots_to."""
+    times = np.asarray(times, dtype=np.float64)
+    knots_from, knots_to = np.asarray(knots_from, dtype=np.float64), np.asarray(knots_to, dtype=np.float64)
+    if knots_from.size == 1:
+        return times - knots_from[0] + knots_to[0]
+    converted = np.interp(times, knots_from, knots_to)
+    # beyond the knots, extrapolate at the mean rate of the whole model
+    slope = (knots_to[-1] - knots_to[0]) / (knots_from[-1] - knots_from[0])
+    before, after = times < knots_from[0], times > knots_from[-1]
+    converted[before] = knots_to[0] + slope * (times[before] - knots_from[0])
+    converted[after] = knots_to[-1] + slope * (times[after] - knots_from[-1])
+    return converted
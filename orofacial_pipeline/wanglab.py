@@ -1,6 +1,7 @@
 import datajoint as dj
+from .lazy_schema import LazySchema
 
-schema = dj.schema(dj.config.get('database.prefix', '') + 'wanglab')
+schema = LazySchema('wanglab')
 
 
 @schema
@@ -285,7 +286,7 @@ class Probe(dj.Lookup):
     probe_name: varchar(128)  # String naming probe model
     ---
     -> ProbeType
-    channel_counts: tinyint  # number of channels in the probe
+    channel_counts: smallint  # number of channels in the probe
     shank_counts: tinyint    # number of shanks in the probe
     probe_comment='' :  varchar(1000)
     """
@@ -0,0 +1,172 @@
+"""
+Batched operations on the spike waveforms of all units of a sorting, held
+as one (units x electrodes x samples) array.
+"""
+import numpy as np
+
+
+def stack(units, electrodes, waveforms):
+    """
+    Stack per-(unit, electrode) waveform rows into one array.
+
+    units, electrodes: one entry per row (electrodes as (electrode, shank_id))
+    Returns (unit_ids, electrode_ids, array) where array[i, j] is the waveform
+    of unit_ids[i] on electrode_ids[j] (zeros where a unit has no waveform).
+    """
+    return stack_packed(units, [np.reshape(e, (1, 2)) for e in electrodes],
+                        [np.reshape(w, (1, -1)) for w in waveforms])
+
+
+def stack_packed(units, electrodes, waveforms):
+    """
+    As stack, for packed rows: electrodes[i] is an (n x 2) array of
+    (electrode, shank_id) and waveforms[i] the matching (n x samples) array.
+    """
+    units = np.asarray(units).ravel()
+    electrodes = [np.asarray(e, dtype=np.int64).reshape(-1, 2) for e in electrodes]
+    unit_ids, unit_pos = np.unique(units, return_inverse=True)
+    all_electrodes = np.concatenate(electrodes) if electrodes else np.zeros((0, 2), dtype=np.int64)
+    electrode_ids, electrode_pos = np.unique(all_electrodes, axis=0, return_inverse=True)
+    electrode_pos = electrode_pos.ravel()
+    n_samples = max((np.shape(w)[-1] for w in waveforms), default=0)
+    array = np.zeros((len(unit_ids), len(electrode_ids), n_samples), dtype=np.float32)
+    start = 0
+    for i, e, w in zip(unit_pos.ravel(), electrodes, waveforms):
+        array[i, electrode_pos[start:start + len(e)], :np.shape(w)[-1]] = w
+        start += len(e)
+    return unit_ids, electrode_ids, array
+
+
+def fetch_stacked(units):
+    """
+    stack of the waveforms of every unit in the query `units` (a Unit table
+    with Waveform and PackedWaveform parts), from either representation.
+    """
+    rows = (units.Waveform & units).fetch('unit', 'electrode', 'shank_id', 'waveform')
+    packed = (units.PackedWaveform & units).fetch('unit', 'electrodes', 'shank_ids', 'waveforms')
+    return stack_packed(
+        np.concatenate([rows[0], packed[0]]),
+        [np.array([[e, s]]) for e, s in zip(rows[1], rows[2])]
+        + [np.column_stack([e, s]) for e, s in zip(packed[1], packed[2])],
+        [np.reshape(w, (1, -1)) for w in rows[3]] + list(packed[3]))
+
+
+def fetch_rows(units):
+    """
+    The waveforms of the query `units` in the per-electrode form of
+    Unit.Waveform (a list of dicts), packed waveforms included.
+    """
+    rows = (units.Waveform & units).fetch(as_dict=True)
+    for packed in (units.PackedWaveform & units).fetch(as_dict=True):
+        key = {k: v for k, v in packed.items() if k not in ('electrodes', 'shank_ids', 'waveforms')}
+        rows.extend(dict(key, electrode=e, shank_id=s, waveform=w)
+                    for e, s, w in zip(packed['electrodes'], packed['shank_ids'], packed['waveforms']))
+    return rows
+
+
+def features(array, sampling_rate, repolarization_window=0.1):
+    """
+    Features of the waveform on each unit's peak electrode.
+
+    Returns a dict of per-unit arrays: peak (electrode index), amplitude
+    (peak-to-peak), trough_to_peak (ms), asymmetry ((b - a) / (b + a) with a,
+    b the peaks before and after the trough), repolarization_slope (per ms,
+    linear fit over repolarization_window ms after the trough).
+    """
+    n_units, _, n_samples = array.shape
+    ptp = array.max(axis=2) - array.min(axis=2)
+    peak = ptp.argmax(axis=1)
+    w = array[np.arange(n_units), peak].astype(np.float64)  # units x samples
+
+    t = np.arange(n_samples)
+    trough = w.argmin(axis=1)
+    after = t[None, :] > trough[:, None]
+    peak_after = np.where(after, w, -np.inf).argmax(axis=1)
+    a = np.where(~after, w, -np.inf).max(axis=1)
+    b = w[np.arange(n_units), peak_after]
+    ms_per_sample = 1000. / sampling_rate
+
+    n_fit = max(int(round(repolarization_window / ms_per_sample)), 2)
+    window = np.minimum(trough[:, None] + np.arange(n_fit)[None, :], n_samples - 1)
+    y = np.take_along_axis(w, window, axis=1)
+    x = (window - window.mean(axis=1, keepdims=True)) * ms_per_sample
+    slope = (x * (y - y.mean(axis=1, keepdims=True))).sum(axis=1) / np.maximum((x ** 2).sum(axis=1), 1e-12)
+
+    return {'peak': peak,
+            'amplitude': ptp[np.arange(n_units), peak],
+            'trough_to_peak': np.where(trough < n_samples - 1, (peak_after - trough) * ms_per_sample, np.nan),
+            'asymmetry': (b - a) / np.where(np.abs(a + b) > 1e-12, a + b, np.nan),
+            'repolarization_slope': slope}
+
+
+def nearest_electrodes(coords, peak, n_electrodes=16):
+    """Index of the n_electrodes electrodes nearest each unit's peak electrode (units x n)."""
+    coords = np.asarray(coords, dtype=np.float64)
+    distance = np.linalg.norm(coords[np.asarray(peak)][:, None, :] - coords[None, :, :], axis=2)
+    n = min(n_electrodes, len(coords))
+    nearest = np.argpartition(distance, n - 1, axis=1)[:, :n]
+    return np.take_along_axis(nearest, np.argsort(np.take_along_axis(distance, nearest, axis=1), axis=1), axis=1)
+
+
+def center_of_mass(amplitudes, coords):
+    """Amplitude-weighted mean position; amplitudes (units x n), coords (units x n x dims)."""
+    weights = np.maximum(amplitudes, 0)
+    return (weights[:, :, None] * coords).sum(axis=1) / np.maximum(weights.sum(axis=1), 1e-12)[:, None]
+
+
+def monopolar_triangulation(amplitudes, coords, n_iterations=50, initial_z=20.):
+    """
+    Fit a point source a_i = alpha / |(x, y, z) - (x_i, y_i, 0)| to the
+    amplitudes of every unit on electrodes at coords (units x n x 2), by
+    Levenberg-Marquardt iterations run on all units at once.
+
+    Returns (position (units x 3), alpha, converged) with z >= 0 the distance
+    from the probe plane. A unit stops iterating once it converges or once its
+    damping blows up without a step that lowers the cost; the latter is not
+    converged.
+    """
+    amplitudes = np.asarray(amplitudes, dtype=np.float64)
+    coords = np.asarray(coords, dtype=np.float64)
+    n_units = len(amplitudes)
+    scale = np.maximum(amplitudes.max(axis=1, keepdims=True), 1e-12)
+    a = amplitudes / scale
+
+    com = center_of_mass(a, coords)
+    params = np.column_stack([com, np.full(n_units, initial_z), np.zeros(n_units)])
+    d = np.sqrt(((com[:, None, :] - coords) ** 2).sum(axis=2) + initial_z ** 2)
+    params[:, 3] = (a * d).max(axis=1)
+    damping = np.full(n_units, 1e-2)
+
+    def residuals(p):
+        dx = p[:, None, 0] - coords[:, :, 0]
+        dy = p[:, None, 1] - coords[:, :, 1]
+        r = np.sqrt(dx ** 2 + dy ** 2 + p[:, None, 2] ** 2)
+        return p[:, None, 3] / r - a, dx, dy, r
+
+    res, dx, dy, r = residuals(params)
+    cost = (res ** 2).sum(axis=1)
+    converged = np.zeros(n_units, dtype=bool)
+    active = np.ones(n_units, dtype=bool)
+    for _ in range(n_iterations):
+        if not active.any():
+            break
+        alpha = params[:, None, 3]
+        jacobian = np.stack([-alpha * dx / r ** 3, -alpha * dy / r ** 3,
+                             -alpha * params[:, None, 2] / r ** 3, 1 / r], axis=2)  # units x n x 4
+        jtj = np.einsum('uni,unj->uij', jacobian, jacobian)
+        jtr = np.einsum('uni,un->ui', jacobian, res)
+        jtj_damped = jtj + damping[:, None, None] * (jtj * np.eye(4)) + 1e-12 * np.eye(4)
+        step = np.linalg.solve(jtj_damped, -jtr[:, :, None])[:, :, 0]
+        trial = params + step
+        trial[:, 2] = np.abs(trial[:, 2])
+        trial_res, trial_dx, trial_dy, trial_r = residuals(trial)
+        trial_cost = (trial_res ** 2).sum(axis=1)
+        better = active & (trial_cost < cost)
+        converged |= better & (cost - trial_cost < 1e-10 * np.maximum(cost, 1e-12))
+        params[better], res[better], dx[better], dy[better], r[better], cost[better] = (
+            trial[better], trial_res[better], trial_dx[better], trial_dy[better], trial_r[better],
+            trial_cost[better])
+        damping = np.where(better, damping / 3, np.where(active, damping * 4, damping))
+        active &= ~converged & (damping <= 1e8)
+
+    return params[:, :3], params[:, 3] * scale[:, 0], converged
@@ -0,0 +1,114 @@
+"""
+Whisking kinematics from whisker angle traces.
+
+Phase and amplitude come from the analytic signal of the band-passed angle,
+midpoint from the low-passed angle.  All filters are FIR, so a trace can be
+processed in chunks overlapping by half a kernel, with memory bounded by the
+chunk size, and give the result of a whole-array computation up to floating
+point rounding: the FFT convolutions round differently for different chunk
+lengths (differences of order 1e-14, phase compared modulo 2 pi).
+"""
+import numpy as np
+
+WHISK_EVENTS = ('protraction', 'retraction', 'whisker pump')  # ActionEventType of detect_whisk_events()
+
+
+def filter_kernels(fs, band=(6., 30.), midpoint_cutoff=6., filter_length=1.):
+    """
+    FIR kernels for a frame rate fs: a complex analytic band-pass (real part:
+    band-passed angle, imaginary part: its Hilbert transform) and a low-pass.
+    """
+    from scipy import signal
+    numtaps = int(filter_length * fs) | 1
+    n = np.arange(numtaps) - numtaps // 2
+    center, half_width = (band[0] + band[1]) / 2, (band[1] - band[0]) / 2
+    analytic = 2 * signal.firwin(numtaps, half_width, fs=fs) * np.exp(2j * np.pi * center * n / fs)
+    lowpass = signal.firwin(numtaps, midpoint_cutoff, fs=fs)
+    return analytic, lowpass
+
+
+def _segment(x, start, stop, pad):
+    """x[start - pad:stop + pad] as float64, mirrored at the ends of x."""
+    lo, hi = max(start - pad, 0), min(stop + pad, len(x))
+    seg = np.asarray(x[lo:hi], dtype=np.float64)
+    return np.pad(seg, (pad - (start - lo), pad - (hi - stop)), mode='reflect')
+
+
+def kinematics(angle, frame_times, chunk_size=2 ** 20, **filter_kwargs):
+    """
+    Compute amplitude, midpoint, phase and velocity of an angle trace.
+
+    angle and frame_times may be memory maps; they are read chunk_size frames
+    at a time.  Returns a dict of float32 arrays.
+    """
+    from scipy import signal
+    n = len(angle)
+    fs = 1 / np.median(np.diff(frame_times[:min(n, 10000)]))
+    analytic, lowpass = filter_kernels(fs, **filter_kwargs)
+    pad = len(analytic) // 2
+    result = {name: np.empty(n, dtype=np.float32)
+              for name in ('amplitude', 'midpoint', 'phase', 'velocity')}
+
+    for start in range(0, n, chunk_size):
+        stop = min(start + chunk_size, n)
+        seg = _segment(angle, start, stop, pad)
+        z = signal.oaconvolve(seg, analytic, mode='valid')
+        result['amplitude'][start:stop] = np.abs(z)
+        result['phase'][start:stop] = np.angle(z)
+        result['midpoint'][start:stop] = signal.oaconvolve(seg, lowpass, mode='valid')
+
+        lo, hi = max(start - 1, 0), min(stop + 1, n)
+        velocity = np.gradient(np.asarray(angle[lo:hi], dtype=np.float64),
+                               np.asarray(frame_times[lo:hi], dtype=np.float64))
+        result['velocity'][start:stop] = velocity[start - lo:len(velocity) - (hi - stop)]
+    return result
+
+
+def detect_whisk_events(phase, amplitude, angle, frame_rate, min_amplitude=2.,
+                        pump_cutoff=60., pump_noise_factor=3., min_pump_depth=1.):
+    """
+    Frame indices of whisking events, from the phase convention where 0 is
+    maximal protraction and +/-pi maximal retraction:
+        protraction  : phase wraps from +pi to -pi
+        retraction   : phase crosses 0 upwards
+        whisker pump : the angle, low-passed at pump_cutoff Hz, turns back to
+                       protraction in the middle of a cycle, |phase| < pi/2,
+                       after retracting at least the pump threshold below the
+                       peaks on either side
+    The pump threshold is pump_noise_factor times the tracking noise left in
+    the low-passed angle (estimated from the angle above pump_cutoff), and at
+    least min_pump_depth degrees; pumps are looked for only where the
+    amplitude is at least twice the threshold, so noise on a small or slow
+    whisk is not taken for reversals.  Only frames with amplitude >=
+    min_amplitude (degrees) are considered.
+    """
+    from scipy import signal
+    phase = np.asarray(phase, dtype=np.float64)
+    amplitude = np.asarray(amplitude, dtype=np.float64)
+    whisking = amplitude[1:] >= min_amplitude
+    dphase = np.diff(phase)
+    protraction = (dphase < -np.pi) & whisking
+    retraction = (phase[:-1] < 0) & (phase[1:] >= 0) & (dphase > -np.pi) & whisking
+
+    angle = np.asarray(angle, dtype=np.float64)
+    cutoff = min(pump_cutoff, frame_rate / 4)
+    lowpass = signal.firwin(int(0.04 * frame_rate) | 1, cutoff, fs=frame_rate)
+    smooth = signal.oaconvolve(angle, lowpass, mode='same')
+    # white tracking noise: the part above the cutoff gives its level below it
+    residual = angle - smooth
+    noise = 1.4826 * np.median(np.abs(residual - np.median(residual))) * np.sqrt(
+        2 * cutoff / (frame_rate - 2 * cutoff))
+    threshold = max(min_pump_depth, pump_noise_factor * noise)
+
+    slope = np.diff(smooth)
+    troughs = np.flatnonzero((slope[:-1] < 0) & (slope[1:] >= 0)) + 1
+    peaks = np.flatnonzero((slope[:-1] > 0) & (slope[1:] <= 0)) + 1
+    after = np.searchsorted(peaks, troughs)
+    inner = (after > 0) & (after < len(peaks))
+    troughs, after = troughs[inner], after[inner]
+    depth = np.minimum(smooth[peaks[after - 1]], smooth[peaks[after]]) - smooth[troughs]
+    pump = troughs[(depth >= threshold) & (np.abs(phase[troughs]) < np.pi / 2)
+                   & (amplitude[troughs] >= max(min_amplitude, 2 * threshold))]
+    return {'protraction': np.flatnonzero(protraction) + 1,
+            'retraction': np.flatnonzero(retraction) + 1,
+            'whisker pump': pump}
@@ -1,17 +1,30 @@
+import multiprocessing as mp
+import os
+
+import numpy as np
 import datajoint as dj
 from . import wanglab as lab
 from . import reference
+from .blob_cache import CachedBlobs
+from .lazy_schema import LazySchema
+from .spike_codec import sampled_times
+from . import wl_whisker_experiment as experiment
+from . import spike_sorting
+from . import spikes
+from . import quality
+from . import waveforms
+from . import raw
 
-schema = dj.schema(dj.config.get('database.prefix', '') + 'wl_ephys')
+schema = LazySchema('wl_ephys')
 
 
 @schema
 class Ephys(dj.Manual):
     definition = """  # Ephys recording for this session
-    -> Session
+    -> experiment.Session
     -> lab.Rig
     -> lab.Probe
-    -> TargetRegion
+    -> lab.TargetRegion
     ---
     # posterior :  decimal(3,2)   # (mm) #useless
     # lateral  :  decimal(3,2)   # (mm) #useless
@@ -28,7 +41,7 @@ class Ephys(dj.Manual):
 class Phototag(dj.Manual):
     definition = """
     -> Ephys
-    -> OptoStim
+    -> experiment.PhotoStim
     ---
     responses  : varchar(30)   # Yes / No / MU / SU
     responsive_channels= null : varchar(30)  # responsive channels
@@ -40,16 +53,26 @@ class SpikeSorting(dj.Imported):
     definition = """
     -> Ephys
     -> reference.SpikeSortingMethod
+    ---
+    sampling_rate=null : double  # (Hz) sampling rate of the sorted spike times
     """
 
+    def make(self, key):
+        folder, probe = (experiment.Session * Ephys & key).fetch1('session_folder', 'probe_name')
+        if spike_sorting.find_sorting(folder, key['spike_sort_method'], hint=probe) is None:
+            return
+        sorting = spike_sorting.load_sorting(folder, key['spike_sort_method'], hint=probe)
+        self.insert1(dict(key, sampling_rate=sorting.sampling_rate))
+
 
 @schema
-class Unit(dj.Imported):
+class Unit(CachedBlobs, dj.Imported):
     definition = """  #  Resultant unit(s) from spike-sorting routine
     -> SpikeSorting
     unit  : smallint   # single unit number in recording
     ---
-    spike_times : longblob  # (s) with respect to the start-time of the Ephys recording session
+    spike_times : <sampled_times>  # (s) with respect to the start-time of the Ephys recording session
+    blobs_md5=null : char(32)  # MD5 of the serialized blobs, set on insert
     """
         
     class CellType(dj.Part):
@@ -59,10 +82,691 @@ class Unit(dj.Imported):
         -> reference.CellType
         """
         
-    class Waveform(dj.Part):
+    class Waveform(CachedBlobs, dj.Part):
         definition = """  # spike waveform of this unit manifested at a given electrode
         -> master
         -> lab.Probe.Electrode
         ---
         waveform : longblob   # uV 
+        blobs_md5=null : char(32)  # MD5 of the serialized blobs, set on insert
+        """
+
+    class PackedWaveform(CachedBlobs, dj.Part):
+        definition = """  # spike waveforms of this unit on all its electrodes, one row per unit
+        -> master
+        ---
+        electrodes : longblob  # electrode of each row of waveforms, in lab.Probe.Electrode
+        shank_ids  : longblob  # shank_id of each row of waveforms
+        waveforms  : longblob  # (electrodes x samples) float32, uV
+        blobs_md5=null : char(32)  # MD5 of the serialized blobs, set on insert
+        """
+
+    def make(self, key):
+        folder, probe = (experiment.Session * Ephys & key).fetch1('session_folder', 'probe_name')
+        sorting = spike_sorting.load_sorting(folder, key['spike_sort_method'], hint=probe)
+        electrodes = {}
+        if sorting.channels is not None:
+            sites = raw.sorting_channel_map(folder, (lab.Rig & key).fetch1('recording_system'),
+                                            sorting.folder, hint=probe)
+            if sites is None:
+                raise dj.DataJointError('No channel map for the sorting in {}'.format(sorting.folder))
+            electrodes = raw.electrode_keys(sites, (lab.Probe.Electrode & key).fetch('KEY'))
+        packed = (lab.Probe & key).fetch1('probe_type') == 'neuropixel'
+        spike_sorting.insert_units(self, key, sorting, electrodes, packed=packed)
+
+    def fetch_packed(self, samples=False, batch_size=500):
+        """
+        Spike trains of all units in this query as one contiguous buffer with
+        offsets and a key table (spikes.SpikeTrains), in float64 seconds or,
+        if samples, int64 sample indices at the sorting's sampling rate.
+        """
+        if samples:
+            return spikes.fetch_packed(self * SpikeSorting.proj('sampling_rate'),
+                                       batch_size=batch_size, rate_attribute='sampling_rate')
+        return spikes.fetch_packed(self, batch_size=batch_size)
+
+    def fetch_waveforms(self, stacked=False):
+        """
+        Waveforms of the units in this query from Waveform and PackedWaveform
+        alike: as Unit.Waveform rows (dicts), or if stacked as
+        (unit_ids, electrode_ids, units x electrodes x samples array).
+        """
+        return waveforms.fetch_stacked(self) if stacked else waveforms.fetch_rows(self)
+
+    def source_files(self, key):
+        folder, probe = (experiment.Session * Ephys & key).fetch1('session_folder', 'probe_name')
+        return spike_sorting.source_files(folder, key['spike_sort_method'], hint=probe)
+
+
+# ---- unit quality ----
+
+@schema
+class UnitQuality(dj.Computed):
+    definition = """  # quality metrics of all units of a sorting
+    -> SpikeSorting
+    ---
+    refractory_period : float  # (s) used for isi_violation
+    presence_bin_size : float  # (s) used for presence_ratio
+    """
+
+    class Metrics(dj.Part):
+        definition = """
+        -> master
+        -> Unit
+        ---
+        spike_count             : int
+        firing_rate=null        : float  # (Hz) over the span of the sorting, null if its spikes span no time
+        isi_violation           : float  # fraction of inter-spike intervals shorter than the refractory period
+        presence_ratio          : float  # fraction of presence bins with at least one spike
+        amplitude_cutoff=null   : float  # estimated fraction of spikes missed below the detection threshold
+        isolation_distance=null : float  # Mahalanobis isolation distance in PC feature space
+        """
+
+    refractory_period = 0.0015
+    presence_bin_size = 60.
+
+    def make(self, key):
+        # all metrics are computed on the packed spike trains of the whole sorting;
+        # run through populate.populate() to spread sortings over processes
+        units, trains = (Unit & key).fetch('unit', 'spike_times', order_by='unit')
+        buffer, offsets = spikes.pack(trains)
+        start, stop = (buffer.min(), buffer.max()) if buffer.size else (0., 1.)
+        counts = np.diff(offsets)
+        rates = counts / (stop - start) if stop > start else np.full(len(units), np.nan)
+        isi_violation = quality.isi_violations(buffer, offsets, self.refractory_period)
+        presence = quality.presence_ratio(buffer, offsets, start, stop, self.presence_bin_size)
+
+        # amplitudes and PC features are only kept in the sorter output
+        cutoff = isolation = np.full(len(units), np.nan)
+        folder, probe = (experiment.Session * Ephys & key).fetch1('session_folder', 'probe_name')
+        if spike_sorting.find_sorting(folder, key['spike_sort_method'], hint=probe) is not None:
+            sorting = spike_sorting.load_sorting(folder, key['spike_sort_method'], hint=probe)
+            extras, clusters = sorting.extras, sorting.spike_clusters
+            if {'amplitudes', 'spike_templates'} <= set(extras):
+                by_cluster = dict(spike_sorting.split_by_cluster(clusters))
+                amplitudes = [np.asarray(extras['amplitudes'][by_cluster[u]]).ravel()
+                              if u in by_cluster else np.zeros(0) for u in units]
+                cutoff = quality.amplitude_cutoff(*spikes.pack(amplitudes))
+                if {'pc_features', 'pc_feature_ind'} <= set(extras):
+                    isolation = quality.isolation_distances(
+                        units, clusters, extras['spike_templates'],
+                        extras['pc_features'], extras['pc_feature_ind'])
+
+        self.insert1(dict(key, refractory_period=self.refractory_period,
+                          presence_bin_size=self.presence_bin_size))
+        self.Metrics.insert(
+            dict(key, unit=unit, spike_count=counts[i], firing_rate=None if np.isnan(rates[i]) else rates[i],
+                 isi_violation=isi_violation[i], presence_ratio=presence[i],
+                 amplitude_cutoff=None if np.isnan(cutoff[i]) else cutoff[i],
+                 isolation_distance=None if np.isnan(isolation[i]) else isolation[i])
+            for i, unit in enumerate(units))
+
+
+# ---- waveform features and cell types ----
+
+@schema
+class WaveformFeatures(dj.Computed):
+    definition = """  # spike waveform features of all units of a sorting, on each unit's peak electrode
+    -> SpikeSorting
+    """
+
+    class Features(dj.Part):
+        definition = """
+        -> master
+        -> Unit
+        ---
+        -> lab.Probe.Electrode.proj(peak_electrode='electrode')
+        amplitude            : float  # (uV) peak-to-peak
+        trough_to_peak=null  : float  # (ms)
+        asymmetry=null       : float  # (b - a) / (b + a), a and b the peaks before and after the trough
+        repolarization_slope : float  # (uV/ms) after the trough
+        """
+
+    @property
+    def key_source(self):
+        return SpikeSorting & [Unit.Waveform, Unit.PackedWaveform] & 'sampling_rate is not null'
+
+    def make(self, key):
+        # all waveforms of the sorting in one query, features computed on the stacked array
+        unit_ids, electrode_ids, array = (Unit & key).fetch_waveforms(stacked=True)
+        features = waveforms.features(array, (SpikeSorting & key).fetch1('sampling_rate'))
+
+        def value(name, i):
+            return None if np.isnan(features[name][i]) else features[name][i]
+
+        self.insert1(key)
+        self.Features.insert(
+            dict(key, unit=unit,
+                 peak_electrode=electrode_ids[features['peak'][i], 0],
+                 shank_id=electrode_ids[features['peak'][i], 1],
+                 amplitude=features['amplitude'][i], trough_to_peak=value('trough_to_peak', i),
+                 asymmetry=value('asymmetry', i), repolarization_slope=features['repolarization_slope'][i])
+            for i, unit in enumerate(unit_ids))
+
+
+@schema
+class UnitPosition(dj.Computed):
+    definition = """  # position of all units of a sorting on the probe, from waveform amplitudes across electrodes
+    -> SpikeSorting
+    ---
+    n_electrodes : smallint  # electrodes nearest the peak electrode used per unit
+    """
+
+    class Position(dj.Part):
+        definition = """
+        -> master
+        -> Unit
+        ---
+        com_x         : float  # (um) amplitude-weighted center of mass, probe coordinates
+        com_y         : float  # (um)
+        x=null        : float  # (um) monopolar triangulation
+        y=null        : float  # (um) along the probe, e.g. for depth and drift maps
+        z=null        : float  # (um) distance from the probe plane
+        alpha=null    : float  # (uV um) fitted source amplitude
+        fit_converged : bool
+        """
+
+    n_electrodes = 16
+
+    @property
+    def key_source(self):
+        return (SpikeSorting & [Unit.Waveform, Unit.PackedWaveform]
+                & (lab.Probe.Electrode & 'x_coord is not null and y_coord is not null'))
+
+    def make(self, key):
+        unit_ids, electrode_ids, array = (Unit & key).fetch_waveforms(stacked=True)
+        amplitudes = (array.max(axis=2) - array.min(axis=2)).astype(np.float64)  # units x electrodes
+
+        # coordinates of the recorded electrodes only, e.g. one neuropixel bank
+        probe_electrodes = (lab.Probe.Electrode & key).fetch(order_by='electrode, shank_id')
+        row = {(e, s): i for i, (e, s) in enumerate(zip(probe_electrodes['electrode'],
+                                                       probe_electrodes['shank_id']))}
+        rows = np.array([row[tuple(e)] for e in electrode_ids.tolist()])
+        coords = np.column_stack([probe_electrodes['x_coord'][rows],
+                                  probe_electrodes['y_coord'][rows]]).astype(np.float64)
+        located = ~np.isnan(coords).any(axis=1)
+        amplitudes, coords = amplitudes[:, located], coords[located]
+
+        nearest = waveforms.nearest_electrodes(coords, amplitudes.argmax(axis=1), self.n_electrodes)
+        amplitudes = np.take_along_axis(amplitudes, nearest, axis=1)
+        com = waveforms.center_of_mass(amplitudes, coords[nearest])
+        position, alpha, converged = waveforms.monopolar_triangulation(amplitudes, coords[nearest])
+        # a source cannot be placed from fewer than 4 electrodes
+        fitted = converged & (nearest.shape[1] >= 4)
+
+        self.insert1(dict(key, n_electrodes=nearest.shape[1]))
+        self.Position.insert(
+            dict(key, unit=unit, com_x=com[i, 0], com_y=com[i, 1], fit_converged=bool(fitted[i]),
+                 **(dict(x=position[i, 0], y=position[i, 1], z=position[i, 2], alpha=alpha[i])
+                    if fitted[i] else {}))
+            for i, unit in enumerate(unit_ids))
+
+
+@schema
+class CellTypeRuleSet(dj.Lookup):
+    definition = """  # a set of waveform rules classifying units into cell types
+    rule_set : varchar(16)
+    ---
+    rule_set_description='' : varchar(1000)
+    """
+    contents = [('width', 'narrow spikes are fast spiking, broad spikes putative pyramidal')]
+
+
+@schema
+class CellTypeRule(dj.Lookup):
+    definition = """  # units matching all bounds of a rule get its cell type; rules are tried by priority
+    -> CellTypeRuleSet
+    priority : tinyint  # lower first
+    ---
+    -> reference.CellType
+    min_trough_to_peak=null : float  # (ms)
+    max_trough_to_peak=null : float  # (ms)
+    min_asymmetry=null      : float
+    max_asymmetry=null      : float
+    min_amplitude=null      : float  # (uV)
+    """
+    contents = [('width', 1, 'FS', None, 0.4, None, None, 50.),
+                ('width', 2, 'Pyr', 0.4, None, None, None, 50.)]
+
+
+@schema
+class UnitCellType(dj.Computed):
+    definition = """  # cell types of the units of a sorting by a rule set
+    -> WaveformFeatures
+    -> CellTypeRuleSet
+    """
+
+    class Assignment(dj.Part):
+        definition = """
+        -> master
+        -> Unit
+        ---
+        -> reference.CellType
+        """
+
+    bounds = (('trough_to_peak', 'min_trough_to_peak', np.greater_equal),
+              ('trough_to_peak', 'max_trough_to_peak', np.less),
+              ('asymmetry', 'min_asymmetry', np.greater_equal),
+              ('asymmetry', 'max_asymmetry', np.less),
+              ('amplitude', 'min_amplitude', np.greater_equal))
+
+    def make(self, key):
+        features = (WaveformFeatures.Features & key).fetch(order_by='unit')
+        cell_type = np.full(len(features), 'not classified', dtype=object)
+        unassigned = np.ones(len(features), dtype=bool)
+        for rule in (CellTypeRule & key).fetch(as_dict=True, order_by='priority'):
+            match = unassigned.copy()
+            for feature, bound, compare in self.bounds:
+                if rule[bound] is not None and not np.isnan(rule[bound]):
+                    values = features[feature].astype(np.float64)
+                    match &= ~np.isnan(values) & compare(values, rule[bound])
+            cell_type[match] = rule['cell_type']
+            unassigned &= ~match
+
+        self.insert1(key)
+        self.Assignment.insert(dict(key, unit=unit, cell_type=t) for unit, t in zip(features['unit'], cell_type))
+
+
+# ---- raw recordings and LFP ----
+
+def _electrode_keys(electrodes):
+    # lab.Probe.Electrode keys or (electrode, shank_id) pairs -> dicts of electrode and shank_id
+    return [{'electrode': e['electrode'], 'shank_id': e['shank_id']} if isinstance(e, dict)
+            else {'electrode': e[0], 'shank_id': e[1]} for e in electrodes]
+
+
+@schema
+class RawRecording(dj.Imported):
+    definition = """  # raw continuous recording of an Ephys session, read through a memory map
+    -> Ephys
+    ---
+    -> lab.ElectrodeConfig
+    file_path      : varchar(255)  # relative to the session folder
+    file_format    : varchar(16)   # blackrock, spikeglx or binary
+    dtype          : varchar(8)    # numpy dtype of the samples
+    n_channels     : smallint      # channels interleaved in the file
+    sampling_rate  : float         # (Hz)
+    bit_volts      : float         # (uV) per bit
+    header_bytes=0 : int           # bytes before the first sample
+    """
+
+    class Channel(dj.Part):
+        definition = """  # electrode recorded on each channel of the file
+        -> master
+        channel : smallint  # column in the file
+        ---
+        -> lab.ElectrodeConfig.Electrode
+        """
+
+    def make(self, key):
+        folder, probe = (experiment.Session * Ephys & key).fetch1('session_folder', 'probe_name')
+        recording = raw.find_raw(folder, (lab.Rig & key).fetch1('recording_system'), hint=probe)
+        if recording is None:
+            return
+        sites = raw.channel_map(recording)
+        if sites is None:
+            raise dj.DataJointError('{} has no channel map'.format(recording.path))
+        channels = sorted(sites)
+        # the smallest electrode config of the probe holding the site of every channel;
+        # a site without shank_id (Blackrock) matches its electrode on any shank
+        best = None
+        for config in (lab.ElectrodeConfig & key).fetch('KEY'):
+            config_electrodes = (lab.ElectrodeConfig.Electrode & config).fetch('KEY')
+            index = {}
+            for electrode in config_electrodes:
+                for site in ((electrode['shank_id'], electrode['electrode']), (None, electrode['electrode'])):
+                    index.setdefault(site, []).append(electrode)
+            found = [index.get(sites[channel], []) for channel in channels]
+            if all(len(f) == 1 for f in found) and (best is None or len(config_electrodes) < best[0]):
+                best = len(config_electrodes), config, [f[0] for f in found]
+        if best is None:
+            raise dj.DataJointError('No electrode config of {} holds the sites recorded in {}'.format(
+                probe, recording.path))
+        _, config, electrodes = best
+
+        self.insert1(dict(key, **config, file_path=os.path.relpath(recording.path, folder),
+                          file_format=recording.file_format, dtype=recording.dtype,
+                          n_channels=recording.n_channels, sampling_rate=recording.sampling_rate,
+                          bit_volts=recording.bit_volts, header_bytes=recording.header_bytes))
+        self.Channel.insert(dict(key, **electrode, channel=channel)
+                            for channel, electrode in zip(channels, electrodes))
+
+    def source_files(self, key):
+        folder = (experiment.Session & key).fetch1('session_folder')
+        return [os.path.join(folder, (self & key).fetch1('file_path'))] if self & key else []
+
+    def raw_file(self, key=None):
+        """The recording of `key` (default: this query, one row) as a raw.RawFile."""
+        row = (self & key if key is not None else self).fetch1()
+        folder = (experiment.Session & row).fetch1('session_folder')
+        return raw.RawFile(os.path.join(folder, row['file_path']), row['file_format'], row['dtype'],
+                           row['n_channels'], row['sampling_rate'], row['bit_volts'], row['header_bytes'])
+
+    def memmap(self, key=None):
+        """Read-only (samples x channels) memory map of the recording, in file units."""
+        return raw.open_memmap(self.raw_file(key))
+
+    def read(self, key=None, electrodes=None, start=None, stop=None, scale=True):
+        """
+        Samples of the recording between start and stop (s) on electrodes
+        (lab.Probe.Electrode keys or (electrode, shank_id) pairs, default all
+        mapped channels), as a float32 (samples x electrodes) array in uV, or
+        in file units if not scale.  Only the requested window is read from disk.
+        """
+        recording = self.raw_file(key)
+        electrodes = None if electrodes is None else _electrode_keys(electrodes)
+        channels, channel_electrodes, shank_ids = (
+            self.Channel & (self & key if key is not None else self) & (electrodes or {})).fetch(
+            'channel', 'electrode', 'shank_id', order_by='channel')
+        if electrodes is not None:
+            order = {(e, s): c for e, s, c in zip(channel_electrodes, shank_ids, channels)}
+            channels = [order[e['electrode'], e['shank_id']] for e in electrodes]
+        start, stop = (None if t is None else int(round(t * recording.sampling_rate)) for t in (start, stop))
+        return raw.read_window(recording, channels, start, stop, scale)
+
+
+@schema
+class Lfp(dj.Computed):
+    definition = """  # low-passed, downsampled LFP of every mapped channel
+    -> RawRecording
+    ---
+    lfp_sampling_rate : float  # (Hz)
+    lfp_cutoff        : float  # (Hz) of the anti-aliasing low-pass
+    n_samples         : int    # LFP samples per electrode
+    chunk_samples     : int    # LFP samples per chunk (all chunks but the last)
+    """
+
+    class Electrode(dj.Part):
+        definition = """  # LFP of one electrode in consecutive chunks
+        -> master
+        -> RawRecording.Channel
+        chunk : smallint
+        ---
+        lfp : longblob  # (uV) float32
+        """
+
+    lfp_rate = 1000.
+    cutoff = 300.
+    chunk_duration = 60.  # (s) memory per worker is about one chunk of all channels
+    processes = 4
+
+    def make(self, key):
+        recording = RawRecording().raw_file(key)
+        channels, electrodes = (RawRecording.Channel & key).fetch('channel', 'KEY', order_by='channel')
+        kernel, factor = raw.lfp_kernel(recording.sampling_rate, self.lfp_rate, self.cutoff)
+        n_samples = len(raw.open_memmap(recording)) // factor
+        chunk = int(self.chunk_duration * recording.sampling_rate / factor)
+        jobs = [(recording, channels, start, min(start + chunk, n_samples), kernel, factor)
+                for start in range(0, n_samples, chunk)]
+
+        self.insert1(dict(key, lfp_sampling_rate=recording.sampling_rate / factor, lfp_cutoff=self.cutoff,
+                          n_samples=n_samples, chunk_samples=chunk))
+        # chunks are decimated by worker processes, one wave of chunks per process at a time;
+        # inside a populate.py worker (a daemon process) they run in this process
+        processes = 1 if mp.current_process().daemon else self.processes
+        pool = mp.get_context('spawn').Pool(processes) if processes > 1 else None
+        try:
+            for wave in range(0, len(jobs), processes):
+                batch = jobs[wave:wave + processes]
+                results = pool.map(raw.decimate_job, batch) if pool else map(raw.decimate_job, batch)
+                for index, lfp in enumerate(results, wave):
+                    self.Electrode.insert(dict(electrode, chunk=index, lfp=lfp[:, i])
+                                          for i, electrode in enumerate(electrodes))
+        finally:
+            if pool:
+                pool.terminate()
+
+    def fetch_lfp(self, key, electrodes=None, start=None, stop=None):
+        """
+        LFP of the recording `key` between start and stop (s) as a float32
+        (samples x electrodes) array, reading only the chunks that overlap;
+        electrodes as in RawRecording.read.  Empty if no chunk overlaps.
+        """
+        rate, chunk = (self & key).fetch1('lfp_sampling_rate', 'chunk_samples')
+        first = 0 if start is None else int(round(start * rate))
+        last = (self & key).fetch1('n_samples') if stop is None else int(round(stop * rate))
+        chunks = 'chunk between {} and {}'.format(first // chunk, max(last - 1, first) // chunk)
+        electrodes = None if electrodes is None else _electrode_keys(electrodes)
+        rows = (self.Electrode * RawRecording.Channel & key & (electrodes or {}) & chunks).fetch(
+            'electrode', 'shank_id', 'chunk', 'lfp', order_by='chunk, channel')
+        if not len(rows[2]):
+            return np.empty((0, len(electrodes) if electrodes is not None else
+                             len(RawRecording.Channel & key)), dtype=np.float32)
+        # rows come chunk by chunk, each with the same electrodes in channel order
+        n = int(np.sum(rows[2] == rows[2][0]))
+        lfp = np.concatenate([np.stack(rows[3][i:i + n], axis=1) for i in range(0, len(rows[3]), n)])
+        if electrodes is not None:
+            column = {(e, s): i for i, (e, s) in enumerate(zip(rows[0][:n], rows[1][:n]))}
+            lfp = lfp[:, [column[e['electrode'], e['shank_id']] for e in electrodes]]
+        offset = first - first // chunk * chunk
+        return lfp[offset:offset + last - first]
+
+
+# ---- trial-aligned activity ----
+
+@schema
+class PeriodAlignment(dj.Lookup):
+    definition = """  # trial event each period is aligned to and the PSTH bin size
+    -> experiment.Period
+    ---
+    -> experiment.TrialEventType
+    psth_bin_size : float  # (s)
+    """
+    contents = [('sample', 'go', 0.05),
+                ('delay', 'go', 0.05),
+                ('response', 'go', 0.05),
+                ('prestim', 'stim', 0.01),
+                ('poststim', 'stim', 0.01)]
+
+
+@schema
+class UnitPSTH(dj.Computed):
+    definition = """  # spike counts, rates and PSTHs of all units of a sorting per period and trial condition
+    -> SpikeSorting
+    ---
+    units : longblob  # unit numbers, in the order of the rows of the arrays below
+    """
+
+    class Condition(dj.Part):
+        definition = """
+        -> master
+        -> PeriodAlignment
+        -> experiment.TrialInstruction
+        -> experiment.Outcome
+        ---
+        trial_count : int
+        bin_centers : longblob  # (s) relative to the aligned event
+        spike_count : longblob  # (units) float32 mean spike count per trial in the period
+        spike_rate  : longblob  # (units) float32 mean firing rate in the period (spikes/s)
+        psth        : longblob  # (units x bins) float32 firing rate (spikes/s)
+        """
+
+    @property
+    def key_source(self):
+        return (SpikeSorting & experiment.BehaviorTrial) - experiment.ClockModel().unsynced('ephys')
+
+    @property
+    def derived_from(self):
+        # read by make() without a foreign key; see manifest.reingest
+        return Unit, experiment.ClockModel
+
+    def make(self, key):
+        units, trains = (Unit & key).fetch('unit', 'spike_times', order_by='unit')
+        buffer, offsets = spikes.pack(trains)
+        # trials and their events are on the behavior clock
+        buffer = experiment.ClockModel().convert_synced(key, buffer, 'ephys')
+        trials, trial_starts, instructions, outcomes = (
+            experiment.SessionTrial * experiment.BehaviorTrial & key).fetch(
+            'trial', 'start_time', 'trial_instruction', 'outcome', order_by='trial')
+        trial_starts = trial_starts.astype(np.float64)
+        conditions, condition_index = np.unique(
+            np.array(list(zip(instructions, outcomes)), dtype=object).astype(str),
+            axis=0, return_inverse=True)
+        condition_index = condition_index.ravel()
+
+        self.insert1(dict(key, units=units))
+        for period in (PeriodAlignment * experiment.Period).fetch(as_dict=True):
+            event_trials, event_times = (experiment.TrialEvent & key & {
+                'trial_event_type': period['trial_event_type']}).fetch(
+                'trial', 'trial_event_time', order_by='trial, trial_event_time')
+            # first occurrence of the event in each trial, in session time
+            event_trials, first = np.unique(event_trials, return_index=True)
+            trial_pos = np.searchsorted(trials, event_trials)
+            events = trial_starts[trial_pos] + event_times[first].astype(np.float64)
+            event_conditions = condition_index[trial_pos]
+
+            start, stop, bin_size = period['period_start'], period['period_end'], period['psth_bin_size']
+            n_bins = int(np.ceil((stop - start) / bin_size - 1e-9))
+            n_conditions = len(conditions)
+            spike_index, unit, window = spikes.window_spikes(buffer, offsets, events + start, events + stop)
+            bins = np.minimum(((buffer[spike_index] - events[window] - start) / bin_size).astype(np.int64),
+                              n_bins - 1)
+            # one histogram over (unit, condition, bin) for all aligned spikes
+            counts = np.bincount((unit * n_conditions + event_conditions[window]) * n_bins + bins,
+                                 minlength=len(units) * n_conditions * n_bins
+                                 ).reshape(len(units), n_conditions, n_bins)
+            trial_counts = np.bincount(event_conditions, minlength=n_conditions)
+
+            bin_centers = start + bin_size * (np.arange(n_bins) + 0.5)
+            self.Condition.insert(
+                dict(key, period=period['period'], trial_instruction=instruction, outcome=outcome,
+                     trial_count=trial_counts[c], bin_centers=bin_centers.astype(np.float32),
+                     spike_count=(counts[:, c].sum(axis=1) / trial_counts[c]).astype(np.float32),
+                     spike_rate=(counts[:, c].sum(axis=1) / trial_counts[c] / (stop - start)).astype(np.float32),
+                     psth=(counts[:, c] / trial_counts[c] / bin_size).astype(np.float32))
+                for c, (instruction, outcome) in enumerate(conditions) if trial_counts[c])
+
+
+# ---- coupling to whisking ----
+
+@schema
+class UnitPhaseLocking(dj.Computed):
+    definition = """  # locking of the spikes of a unit to the whisking phase
+    -> Unit
+    ---
+    spike_times_md5     : char(32)  # Unit.blobs_md5 of the spike times used for this result
+    spike_count         : int       # spikes during whisker tracking
+    phase_hist          : longblob  # float32 spike counts per phase bin, from -pi to pi
+    mean_vector_length  : float
+    mean_phase          : float     # (radians) 0 is maximal protraction
+    rayleigh_z          : float
+    rayleigh_p          : float
+    """
+
+    phase_bins = 36
+
+    @property
+    def key_source(self):
+        return (Unit & experiment.WhiskerBehavior) - experiment.ClockModel().unsynced('ephys', 'video')
+
+    @property
+    def derived_from(self):
+        return experiment.WhiskerBehavior, experiment.ClockModel
+
+    @property
+    def target(self):
+        # stale results count as not populated, so populate computes them again
+        return self - self.stale.proj()
+
+    def make(self, key):
+        # compute every pending unit of the sorting at once; populate skips those done here
+        sorting = (SpikeSorting & key).fetch1('KEY')
+        pending = (self.key_source & sorting) - self.target
+        units, trains, checksums = (Unit & pending).fetch('KEY', 'spike_times', 'blobs_md5', order_by='unit')
+        phase, frame_times = (experiment.WhiskerBehavior & key).fetch1('phase', 'frame_times')
+
+        buffer, offsets = spikes.pack(trains)
+        # the phase is sampled at the video frames
+        buffer = experiment.ClockModel().convert_synced(key, buffer, 'ephys', to='video')
+        unit = spikes.unit_index(offsets)
+        tracked = (buffer >= frame_times[0]) & (buffer <= frame_times[-1])
+        unit = unit[tracked]
+        spike_phase = np.interp(buffer[tracked], frame_times, np.unwrap(np.asarray(phase, dtype=np.float64)))
+        spike_phase = (spike_phase + np.pi) % (2 * np.pi) - np.pi
+
+        n_units, n_bins = len(units), self.phase_bins
+        bins = np.minimum(((spike_phase + np.pi) / (2 * np.pi) * n_bins).astype(np.int64), n_bins - 1)
+        hist = np.bincount(unit * n_bins + bins, minlength=n_units * n_bins).reshape(n_units, n_bins)
+        n = hist.sum(axis=1)
+        vector = (np.bincount(unit, np.cos(spike_phase), n_units)
+                  + 1j * np.bincount(unit, np.sin(spike_phase), n_units))
+        length = np.abs(vector) / np.maximum(n, 1)
+        z = n * length ** 2
+        # Rayleigh test p-value (Zar, Biostatistical Analysis, eq. 27.4)
+        p = np.exp(np.sqrt(1 + 4 * n + 4 * (n ** 2 - (n * length) ** 2)) - (1 + 2 * n))
+
+        (self & pending).delete_quick()  # stale results of these units
+        self.insert((dict(unit_key, spike_times_md5=md5, spike_count=n[i],
+                          phase_hist=hist[i].astype(np.float32),
+                          mean_vector_length=length[i], mean_phase=np.angle(vector[i]),
+                          rayleigh_z=z[i], rayleigh_p=min(p[i], 1.))
+                     for i, (unit_key, md5) in enumerate(zip(units, checksums))),
+                    skip_duplicates=True)
+
+    @property
+    def stale(self):
+        """Results whose unit's spike_times changed since they were computed."""
+        return self & (self * Unit.proj('blobs_md5') & 'blobs_md5 != spike_times_md5').proj()
+
+
+@schema
+class FrameSpikeCounts(dj.Computed):
+    definition = """  # spike counts of all units of a sorting in every video frame, sparse (frames x units) CSR
+    -> SpikeSorting
+    ---
+    units    : longblob  # unit numbers, the columns of the matrix
+    n_frames : int
+    data     : longblob  # uint16 spike counts of the stored entries
+    indices  : longblob  # int32 column (unit index) of each entry
+    indptr   : longblob  # int64 (frames + 1) row offsets into data and indices
+    """
+
+    class Rebinned(dj.Part):
+        definition = """  # counts over bin_frames consecutive frames, added on first request
+        -> master
+        bin_frames : smallint
+        ---
+        data    : longblob
+        indices : longblob
+        indptr  : longblob
+        """
+
+    @property
+    def key_source(self):
+        return (SpikeSorting & experiment.WhiskerBehavior) - experiment.ClockModel().unsynced('ephys', 'video')
+
+    @property
+    def derived_from(self):
+        return Unit, experiment.WhiskerBehavior, experiment.ClockModel
+
+    def make(self, key):
+        units, trains = (Unit & key).fetch('unit', 'spike_times', order_by='unit')
+        buffer, offsets = spikes.pack(trains)
+        frame_times = np.asarray((experiment.WhiskerBehavior & key).fetch1('frame_times'), dtype=np.float64)
+        buffer = experiment.ClockModel().convert_synced(key, buffer, 'ephys', to='video')
+        # frame i spans [frame_times[i], frame_times[i + 1]), the last one a median frame interval
+        edges = np.append(frame_times, frame_times[-1] + np.median(np.diff(frame_times)))
+        data, indices, indptr = spikes.bin_counts(buffer, offsets, edges)
+        self.insert1(dict(key, units=units, n_frames=len(frame_times),
+                          data=data, indices=indices, indptr=indptr))
+
+    def get_matrix(self, key, bin_frames=1):
+        """
+        The (bins x units) spike count matrix of the sorting `key` as a
+        scipy.sparse.csr_matrix, with the unit numbers of its columns.  Coarser
+        bins of bin_frames frames are computed from the frame counts and stored
+        on first request.
         """
+        from scipy.sparse import csr_matrix
+        units, n_frames, data, indices, indptr = (self & key).fetch1(
+            'units', 'n_frames', 'data', 'indices', 'indptr')
+        key = (self & key).fetch1('KEY')
+        if bin_frames > 1:
+            rebinned = self.Rebinned & key & {'bin_frames': bin_frames}
+            if rebinned:
+                data, indices, indptr = rebinned.fetch1('data', 'indices', 'indptr')
+            else:
+                data, indices, indptr = spikes.rebin_counts(data, indices, indptr, len(units), bin_frames)
+                self.Rebinned.insert1(dict(key, bin_frames=bin_frames, data=data,
+                                           indices=indices, indptr=indptr), skip_duplicates=True)
+        return csr_matrix((data, indices, indptr), shape=(len(indptr) - 1, len(units))), units
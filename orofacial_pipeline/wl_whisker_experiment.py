@@ -1,8 +1,26 @@
+import os
+import glob
+
+import numpy as np
 import datajoint as dj
 from . import wanglab as lab # this has to be done locally (or add remote location to python path)
 from . import reference # same
+from .blob_cache import CachedBlobs
+from .lazy_schema import LazySchema
+from . import whisker
+from . import spikes
+from . import stimulation
+from . import sync
+
+schema = LazySchema('wl_whisker_experiment')
+
+
+def _find_file(folder, pattern):
+    found = sorted(glob.glob(os.path.join(folder, '**', pattern), recursive=True))
+    if len(found) != 1:
+        raise FileNotFoundError('Expected one {} in {}, found {}'.format(pattern, folder, len(found)))
+    return found[0]
 
-schema = dj.schema(dj.config.get('database.prefix', '') + 'wl_whisker_experiment')
 
 @schema
 class Session(dj.Manual):
@@ -23,7 +41,6 @@ class Session(dj.Manual):
 @schema
 class CueType(dj.Lookup):
     definition = """
-    -> Session
     cue_type : varchar(20)  
     """
     contents = zip(['cuetip', 'whiskerstim', 'piezo_deflection',
@@ -32,7 +49,7 @@ class CueType(dj.Lookup):
 
 
 @schema
-class WhiskerBehavior(dj.Imported):
+class WhiskerBehavior(CachedBlobs, dj.Imported):
     definition = """
     -> Session
     ---
@@ -42,8 +59,22 @@ class WhiskerBehavior(dj.Imported):
     phase         : longblob   # (radians)   
     velocity      : longblob   # (degrees/s)
     frame_times   : longblob   # (s)
+    blobs_md5=null : char(32)  # MD5 of the serialized blobs, set on insert
     """
 
+    def make(self, key):
+        angle_file, frame_times_file = self.source_files(key)
+        angle = np.load(angle_file, mmap_mode='r')
+        frame_times = np.load(frame_times_file, mmap_mode='r')
+        self.insert1(dict(key, **whisker.kinematics(angle, frame_times),
+                          angle=np.asarray(angle, dtype=np.float32),
+                          frame_times=np.asarray(frame_times, dtype=np.float64)))
+
+    def source_files(self, key):
+        # raw traces exported by the whisker tracker, one value per video frame
+        folder = (Session & key).fetch1('session_folder')
+        return [_find_file(folder, '*whisker_angle*.npy'), _find_file(folder, '*frame_times*.npy')]
+
     #retract_times   : longblob  # (s)    
     #protract_times  : longblob  # (s)
 
@@ -85,7 +116,7 @@ class PhotoStim(dj.Manual):
     -> Session
     photo_stim :  smallint 
     ---
-    -> lab.PhotostimDevice
+    -> lab.PhotoStimDevice
     -> BrainLocation
     ml_location=null: float # um from ref ; right is positive; based on manipulator coordinates/reconstructed track
     ap_location=null: float # um from ref; anterior is positive; based on manipulator coordinates/reconstructed track
@@ -94,7 +125,7 @@ class PhotoStim(dj.Manual):
     ap_angle=null: float # Angle between the manipulator/reconstructed track and the Anterior-Posterior axis. An anterior tilt is positive.
     """
 
-    class PhotoStimParam(dj.Part):
+    class PhotoStimParam(CachedBlobs, dj.Part):
         definition = """  # Optogenetic stimulation parameters
         -> master
         ---
@@ -102,6 +133,7 @@ class PhotoStim(dj.Manual):
         pulse_frequency : decimal(6,3) # Hz
         pulse_per_train : smallint #
         waveform=null:  longblob       # normalized to maximal power. The value of the maximal power is specified for each PhotostimTrialEvent individually
+        blobs_md5=null : char(32)  # MD5 of the serialized blobs, set on insert
         """
 
 @schema
@@ -309,6 +341,57 @@ class ActionEvent(dj.Imported):
     action_event_time : decimal(8,4)  # (s) from trial start
     """
 
+    @property
+    def key_source(self):
+        return (Session & WhiskerBehavior & BehaviorTrial) - ClockModel().unsynced('video')
+
+    @property
+    def derived_from(self):
+        # read by make() without a foreign key; see manifest.reingest
+        return WhiskerBehavior, ClockModel
+
+    @property
+    def target(self):
+        # licks and other events are ingested with the trials: a session is
+        # populated once it has whisking events
+        return self & [{'action_event_type': t} for t in whisker.WHISK_EVENTS]
+
+    def make(self, key):
+        # whisking events of the whole session, assigned to trials in one pass
+        phase, amplitude, angle, frame_times = (WhiskerBehavior & key).fetch1(
+            'phase', 'amplitude', 'angle', 'frame_times')
+        frame_times = np.asarray(frame_times, dtype=np.float64)
+        trials, start_times, stop_times = (SessionTrial & BehaviorTrial & key).fetch(
+            'trial', 'start_time', 'stop_time', order_by='trial')
+        start_times, stop_times = start_times.astype(np.float64), stop_times.astype(np.float64)
+
+        detected = whisker.detect_whisk_events(phase, amplitude, angle, 1 / np.median(np.diff(frame_times)))
+        frames = np.concatenate(list(detected.values()))
+        types = np.repeat(list(detected), [len(f) for f in detected.values()])
+        order = np.argsort(frames, kind='stable')
+        # frames are timed on the video clock, trials on the behavior clock
+        times = ClockModel().convert_synced(key, frame_times[frames[order]], 'video')
+        types = types[order]
+
+        index, _, trial_index = spikes.window_spikes(times, np.array([0, len(times)]),
+                                                     start_times, stop_times)
+        # events come out grouped by trial and sorted in time: number them within
+        # trials, after the events already there (e.g. licks)
+        last = dict(zip(*(BehaviorTrial & key).aggr(ActionEvent & key, last='max(action_event_id)').fetch(
+            'trial', 'last')))
+        first_ids = np.array([last.get(trial, 0) for trial in trials.tolist()], dtype=np.int64)
+        event_ids = (np.arange(len(index)) - np.searchsorted(trial_index, trial_index) + 1
+                     + first_ids[trial_index])
+        event_times = times[index] - start_times[trial_index]
+
+        for start in range(0, len(index), 10000):
+            batch = slice(start, start + 10000)
+            self.insert(dict(key, trial=trial, action_event_id=event_id,
+                             action_event_type=event_type, action_event_time=round(event_time, 4))
+                        for trial, event_id, event_type, event_time in zip(
+                            trials[trial_index[batch]].tolist(), event_ids[batch].tolist(),
+                            types[index[batch]].tolist(), event_times[batch].tolist()))
+
 # ---- Photostim trials ----
 
 @schema
@@ -350,3 +433,306 @@ class ElectricalStimTrialEvent(dj.Imported):
     """
 
 
+# ---- stimulation pulses ----
+
+@schema
+class StimPulses(dj.Computed):
+    definition = """  # every photo- and electrical stimulation pulse of the session, in session time
+    -> Session
+    ---
+    pulse_count     : int
+    epoch_starts    : longblob  # (s) merged stimulation epochs of all pulses of the session
+    epoch_stops     : longblob  # (s)
+    """
+
+    class PhotoStimPulses(dj.Part):
+        definition = """
+        -> master
+        -> PhotoStim
+        ---
+        onsets  : longblob  # (s) float64 pulse onsets
+        offsets : longblob  # (s) float64 pulse offsets
+        power   : longblob  # (mW) float32 maximal power of the train of each pulse
+        """
+
+    class ElecStimPulses(dj.Part):
+        definition = """
+        -> master
+        -> ElectricalStim
+        ---
+        onsets  : longblob  # (s) float64 pulse onsets
+        offsets : longblob  # (s) float64 pulse offsets
+        current : longblob  # (uA) float32 maximal current of the train of each pulse
+        """
+
+    @property
+    def key_source(self):
+        return Session & [PhotostimEvent, ElectricalStimTrialEvent]
+
+    def make(self, key):
+        parts = []
+        for part, events, param, stim, time, level in (
+                (self.PhotoStimPulses, PhotostimEvent, PhotoStim.PhotoStimParam,
+                 'photo_stim', 'photostim_event_time', 'power'),
+                (self.ElecStimPulses, ElectricalStimTrialEvent, ElectricalStim.ElecStimParam,
+                 'elec_stim', 'elecstim_event_time', 'current')):
+            stims, onsets, levels = (events * SessionTrial & key).proj(
+                stim, level, onset='start_time + {}'.format(time)).fetch(stim, 'onset', level)
+            # a stimulus without parameters is a single pulse per event
+            trains = {s: (float(duration or 0), float(frequency), int(count))
+                      for s, duration, frequency, count in zip(*(param & key).fetch(
+                          stim, 'pulse_duration', 'pulse_frequency', 'pulse_per_train'))}
+            for s in np.unique(stims):
+                this = stims == s
+                order = np.argsort(onsets[this].astype(np.float64), kind='stable')
+                pulse_onsets, pulse_offsets, train = stimulation.expand_pulse_trains(
+                    onsets[this].astype(np.float64)[order], *trains.get(s, (0., 0., 1)))
+                parts.append((part, dict(key, **{stim: s}, onsets=pulse_onsets, offsets=pulse_offsets,
+                                         **{level: levels[this].astype(np.float32)[order][train]})))
+
+        starts, stops = stimulation.merge_intervals(
+            np.concatenate([row['onsets'] for _, row in parts]),
+            np.concatenate([row['offsets'] for _, row in parts]))
+        self.insert1(dict(key, pulse_count=sum(len(row['onsets']) for _, row in parts),
+                          epoch_starts=starts, epoch_stops=stops))
+        for part, row in parts:
+            part.insert1(row)
+
+    def fetch_pulses(self, key):
+        """All pulses of a session: (onsets, offsets) in session time, sorted by onset."""
+        onsets, offsets = [np.zeros(0)], [np.zeros(0)]
+        for part in (self.PhotoStimPulses, self.ElecStimPulses):
+            part_onsets, part_offsets = (part & key).fetch('onsets', 'offsets')
+            onsets.extend(part_onsets)
+            offsets.extend(part_offsets)
+        onsets, offsets = np.concatenate(onsets), np.concatenate(offsets)
+        order = np.argsort(onsets, kind='stable')
+        return onsets[order], offsets[order]
+
+    def mask_artifacts(self, key, buffer, offsets, before=0.0005, after=0.002, device='ephys'):
+        """
+        Remove the spikes within before s of any pulse onset to after s past
+        its offset from the packed spike trains (buffer, offsets) of the
+        session `key`, all units in one pass.  The spike times are on the
+        clock of device, to which the pulses are converted from the behavior
+        clock.  Returns the new (buffer, offsets).
+        """
+        onsets, pulse_offsets = self.fetch_pulses(key)
+        onsets, pulse_offsets = (ClockModel().convert_synced(key, times, ClockModel.reference, to=device)
+                                 for times in (onsets, pulse_offsets))
+        starts, stops = stimulation.merge_intervals(onsets - before, pulse_offsets + after)
+        return stimulation.mask_spikes(buffer, offsets, starts, stops)
+
+
+# ---- clock synchronization ----
+
+@schema
+class ClockDevice(dj.Lookup):
+    definition = """  # acquisition device with its own clock
+    clock_device : varchar(16)
+    ---
+    clock_device_description='' : varchar(255)
+    """
+    contents = [('behavior', 'behavior controller: SessionTrial, TrialEvent, ActionEvent, stimulation events'),
+                ('ephys', 'ephys acquisition: spike times'),
+                ('video', 'high-speed camera: WhiskerBehavior.frame_times')]
+
+
+@schema
+class SyncPulses(dj.Imported):
+    definition = """  # sync pulses recorded by a device during the session
+    -> Session
+    -> ClockDevice
+    ---
+    pulse_times      : longblob  # (s) on the device clock
+    pulse_codes=null : longblob  # code of each pulse (e.g. trial bitcode), if recorded
+    """
+
+    def make(self, key):
+        if key['clock_device'] == ClockModel.reference:
+            # the behavior controller emits a pulse at every trial start
+            trials, times = (SessionTrial & key).fetch('trial', 'start_time', order_by='trial')
+            notes = dict(zip(*(TrialNote & key & {'trial_note_type': 'bitcode'}).fetch('trial', 'trial_note')))
+            codes = np.array([notes.get(t, '') for t in trials]) if notes else None
+            self.insert1(dict(key, pulse_times=times.astype(np.float64), pulse_codes=codes))
+            return
+        try:
+            files = self.source_files(key)
+        except FileNotFoundError:
+            return
+        self.insert1(dict(key, pulse_times=np.load(files[0]).astype(np.float64).ravel(),
+                          pulse_codes=np.load(files[1]).ravel() if len(files) > 1 else None))
+
+    def source_files(self, key):
+        # pulse times (s, device clock) exported per device, optionally with the decoded bitcodes
+        if key['clock_device'] == ClockModel.reference:
+            return []
+        folder = (Session & key).fetch1('session_folder')
+        files = [_find_file(folder, '*{}_sync*.npy'.format(key['clock_device']))]
+        try:
+            files.append(_find_file(folder, '*{}_bitcode*.npy'.format(key['clock_device'])))
+        except FileNotFoundError:
+            pass
+        return files
+
+
+@schema
+class ClockModel(dj.Computed):
+    definition = """  # piecewise-linear map from a device clock to the behavior clock
+    -> SyncPulses
+    ---
+    knots         : longblob  # (2 x knots) matched pulse times on the device (row 0) and behavior clock (row 1)
+    matched_count : int
+    rms_residual  : float     # (s) of the matched pulses about a linear fit
+    """
+
+    reference = 'behavior'
+
+    @property
+    def key_source(self):
+        return (SyncPulses & 'clock_device != "{}"'.format(self.reference)
+                & (Session & (SyncPulses & {'clock_device': self.reference})))
+
+    def make(self, key):
+        device, device_codes = (SyncPulses & key).fetch1('pulse_times', 'pulse_codes')
+        reference, reference_codes = (SyncPulses & dict(key, clock_device=self.reference)).fetch1(
+            'pulse_times', 'pulse_codes')
+        device_index, reference_index = sync.match_pulses(device, reference, device_codes, reference_codes)
+        if not device_index.size:
+            raise dj.DataJointError('No matching sync pulses for {}'.format(key))
+        knots = np.vstack([device[device_index], reference[reference_index]])
+        residual = knots[1] - np.polyval(np.polyfit(*knots, 1), knots[0]) if device_index.size > 1 else [0.]
+        self.insert1(dict(key, knots=knots, matched_count=device_index.size,
+                          rms_residual=np.sqrt(np.mean(np.square(residual)))))
+
+    def convert(self, key, times, device, to=None):
+        """Convert times of session `key` from the clock of device to that of `to` (default behavior)."""
+        to = to or self.reference
+        times = np.asarray(times, dtype=np.float64)
+        if device != self.reference:
+            knots = (self & key & {'clock_device': device}).fetch1('knots')
+            times = sync.convert(times, knots[0], knots[1])
+        if to != self.reference:
+            knots = (self & key & {'clock_device': to}).fetch1('knots')
+            times = sync.convert(times, knots[1], knots[0])
+        return times
+
+    def unsynced(self, *devices):
+        """Sessions with sync pulses of any of devices but no clock model for them yet."""
+        return Session & ((SyncPulses & [{'clock_device': d} for d in devices]) - self).proj()
+
+    def convert_synced(self, key, times, device, to=None):
+        """
+        convert(), with devices that have no clock model in session `key`
+        taken to share the behavior clock.
+        """
+        synced = set((self & key).fetch('clock_device')) | {self.reference}
+        to = to or self.reference
+        return self.convert(key, times, device if device in synced else self.reference,
+                            to if to in synced else self.reference)
+
+    def fetch_synced(self, query, *attributes, device, to=None):
+        """
+        query.fetch(*attributes) with every value, times on the clock of
+        device, converted to the clock of `to` (default behavior), e.g.
+            ClockModel().fetch_synced(wl_ephys.Unit & key, 'spike_times', device='ephys')
+        All values of a session are converted in one call.
+        """
+        keys, *values = query.fetch('KEY', *attributes)
+        sessions = [tuple(k[a] for a in Session.primary_key) for k in keys]
+        values = [np.array(v, dtype=object) if v.dtype == object else v.astype(np.float64) for v in values]
+        for session in set(sessions):
+            rows = np.flatnonzero([s == session for s in sessions])
+            session_key = dict(zip(Session.primary_key, session))
+            for column in values:
+                chunks = [np.asarray(column[r], dtype=np.float64) for r in rows]
+                converted = self.convert(session_key, np.concatenate([np.ravel(c) for c in chunks]), device, to)
+                split = np.split(converted, np.cumsum([c.size for c in chunks])[:-1])
+                for r, c, v in zip(rows, chunks, split):
+                    column[r] = v[0] if c.ndim == 0 else v.reshape(c.shape)
+        return values[0] if len(values) == 1 else tuple(values)
+
+
+# ---- columnar event store ----
+
+@schema
+class SessionEvents(dj.Manual):
+    definition = """  # events of one session and event table, packed column-wise
+    -> Session
+    event_table : varchar(32)   # row-wise table holding the same events, e.g. ActionEvent
+    ---
+    event_count : int
+    columns     : longblob      # dict: attribute -> packed array (int16/int32 codes and ids, float64 values)
+    categories  : longblob      # dict: coded attribute -> list of labels
+    """
+
+    @staticmethod
+    def _attributes(event_table):
+        return [a for a in event_table.heading.names if a not in Session.primary_key]
+
+    def insert_events(self, session_key, event_table, events):
+        """
+        Insert the events of one session in a single row.
+
+        events: rows of event_table (dicts, without the session attributes)
+        or a dict of columns.
+        """
+        event_table = EVENT_TABLES[event_table] if isinstance(event_table, str) else event_table
+        session_key = (Session & session_key).fetch1('KEY')
+        if not isinstance(events, dict):
+            events = list(events)
+            events = {a: [e[a] for e in events] for a in self._attributes(event_table)}
+        columns, categories = {}, {}
+        for name in self._attributes(event_table):
+            attr, values = event_table.heading[name], np.asarray(events[name])
+            if attr.string:
+                categories[name], codes = np.unique(values.astype(str), return_inverse=True)
+                categories[name] = categories[name].tolist()
+                columns[name] = codes.ravel().astype(np.int16)
+            elif attr.type.startswith(('tinyint', 'smallint')):
+                columns[name] = values.astype(np.int16)
+            elif 'int' in attr.type:
+                columns[name] = values.astype(np.int32)
+            else:
+                # float64 holds decimal(8,4) times of any session length to their 4 places
+                columns[name] = values.astype(np.float64)
+        count = len(next(iter(columns.values()))) if columns else 0
+        self.insert1(dict(session_key, event_table=event_table.__name__, event_count=count,
+                          columns=columns, categories=categories), replace=True)
+
+    def pack(self, session_key, event_table):
+        """Copy the events of a session from the row-wise event_table."""
+        event_table = EVENT_TABLES[event_table] if isinstance(event_table, str) else event_table
+        events = (event_table & session_key).fetch(*self._attributes(event_table), as_dict=True)
+        self.insert_events(session_key, event_table, events)
+
+    def fetch_events(self, session_key, event_table, as_dict=True, **restriction):
+        """
+        Events of one session with the attributes of the row-wise table,
+        restricted by equality on any attribute, e.g.
+            SessionEvents().fetch_events(key, 'ActionEvent', action_event_type='protraction')
+        Returns a list of dicts like event_table.fetch(as_dict=True), or a dict
+        of column arrays if as_dict is False.
+        """
+        name = event_table if isinstance(event_table, str) else event_table.__name__
+        session_key, columns, categories = (self & session_key & {'event_table': name}).fetch1(
+            'KEY', 'columns', 'categories')
+        mask = np.ones(len(next(iter(columns.values()))), dtype=bool) if columns else np.zeros(0, bool)
+        for attr, value in restriction.items():
+            if attr in categories:
+                labels = categories[attr]
+                mask &= columns[attr] == (labels.index(value) if value in labels else -1)
+            elif columns[attr].dtype.kind == 'f':
+                mask &= columns[attr] == float(value)
+            else:
+                mask &= columns[attr] == value
+        result = {attr: np.asarray(categories[attr], dtype=object)[column[mask]] if attr in categories
+                  else column[mask] for attr, column in columns.items()}
+        if not as_dict:
+            return result
+        session_key = {k: session_key[k] for k in Session.primary_key}
+        return [dict(session_key, **dict(zip(result, values))) for values in zip(*result.values())]
+
+
+EVENT_TABLES = {table.__name__: table for table in
+                (TrialEvent, ActionEvent, PhotostimEvent, ElectricalStimTrialEvent)}
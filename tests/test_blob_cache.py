@@ -0,0 +1,90 @@
+import hashlib
+
+import datajoint as dj
+import numpy as np
+import pytest
+from datajoint.heading import Heading, default_attribute_properties
+
+from orofacial_pipeline import blob_cache, spike_codec
+
+HEADING = Heading([dict(default_attribute_properties, name=name, type=sql_type, in_key=in_key, adapter=adapter,
+                        is_blob=sql_type == 'longblob', numeric=sql_type == 'int', string=sql_type == 'char(32)')
+                   for name, sql_type, in_key, adapter in (
+                       ('unit', 'int', True, None),
+                       ('spike_times', 'longblob', False, spike_codec.sampled_times),
+                       ('waveform', 'longblob', False, None),
+                       ('extra', 'longblob', False, None),
+                       ('blobs_md5', 'char(32)', False, None))])
+
+
+class Table:
+    """Stores rows as datajoint's insert does: adapter, then blob serialization."""
+    heading = HEADING
+    primary_key = ['unit']
+
+    def __init__(self):
+        self.stored = []
+
+    def insert(self, rows, **kwargs):
+        for row in rows:
+            self.stored.append({name: dj.blob.pack(self.heading[name].adapter.put(value)
+                                                   if self.heading[name].adapter else value)
+                                if self.heading[name].is_blob and value is not None else value
+                                for name, value in row.items()})
+            if row['unit'] < 0:
+                raise dj.DataJointError('duplicate entry')
+
+
+class CachedTable(blob_cache.CachedBlobs, Table):
+    pass
+
+
+def rows():
+    rng = np.random.default_rng(0)
+    return [dict(unit=u, spike_times=spike_codec.SampledSpikeTimes(np.sort(rng.integers(0, 10 ** 6, 1000)), 3e4),
+                 waveform=rng.normal(size=(30, 4)).astype(np.float32), extra=None if u else {'a': 1})
+            for u in range(3)]
+
+
+def test_blobs_are_serialized_once_per_insert(monkeypatch):
+    packs = []
+    pack = dj.blob.Blob.pack
+
+    def counted(self, obj, **kwargs):
+        packs.append(1)
+        return pack(self, obj, **kwargs)
+
+    monkeypatch.setattr(dj.blob.Blob, 'pack', counted)
+    table = CachedTable()
+    table.insert(rows())
+    assert len(packs) == 7  # two blobs of every row and the first row's extra
+    assert not dj.blob.bypass_serialization
+
+    plain = Table()
+    plain.insert(rows())
+    for stored, expected, row in zip(table.stored, plain.stored, rows()):
+        assert stored.pop('blobs_md5') == blob_cache.blob_hash(HEADING, row)
+        assert stored.keys() == expected.keys()
+        assert all(stored[name] == expected[name] for name in expected)
+        np.testing.assert_array_equal(spike_codec.sampled_times.get(dj.blob.unpack(stored['spike_times'])),
+                                      row['spike_times'].samples / 3e4)
+
+
+def test_checksum_is_the_backfill_formula():
+    # migrate.add_blob_hashes: MD5(CONCAT("spike_times", COALESCE(`spike_times`, ""), ...)) on the server
+    table = CachedTable()
+    table.insert(rows())
+    for stored in table.stored:
+        server = hashlib.md5(b''.join(name.encode() + (stored[name] or b'')
+                                      for name in ('spike_times', 'waveform', 'extra'))).hexdigest()
+        assert stored['blobs_md5'] == server
+
+
+def test_bypass_is_reset_after_a_failed_insert():
+    with pytest.raises(dj.DataJointError):
+        CachedTable().insert([dict(rows()[0], unit=-1)])
+    assert not dj.blob.bypass_serialization
+    given = dict(rows()[1], blobs_md5='0' * 32)
+    table = CachedTable()
+    table.insert([given])
+    assert table.stored[0]['blobs_md5'] == '0' * 32
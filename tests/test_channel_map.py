@@ -0,0 +1,69 @@
+import numpy as np
+
+from orofacial_pipeline import raw, spike_sorting
+
+ELECTRODES = [dict(probe_name='np', electrode=e, shank_id=0) for e in range(768)]
+
+
+def write_phy(folder, channel_map, n_samples=20):
+    folder.mkdir()
+    np.save(folder / 'spike_times.npy', np.array([10, 20, 30]))
+    np.save(folder / 'spike_clusters.npy', np.array([0, 1, 0]))
+    np.save(folder / 'templates.npy', np.ones((2, n_samples, len(channel_map)), np.float32)
+            * np.arange(len(channel_map), dtype=np.float32))
+    np.save(folder / 'channel_map.npy', np.asarray(channel_map, np.int32))
+    (folder / 'params.py').write_text("dat_path = 'recording.ap.bin'\nn_channels_dat = 4\n"
+                                      "dtype = 'int16'\noffset = 0\nsample_rate = 30000.\n")
+
+
+def test_phy_channel_map_is_by_recording_channel(tmp_path):
+    # a channel dropped by the sorter: rows of the templates are no longer channel numbers
+    write_phy(tmp_path / 'sorting', [0, 2, 3])
+    assert raw.phy_channel_map(str(tmp_path / 'sorting')) == {0: (0, 0), 2: (0, 2), 3: (0, 3)}
+
+
+def test_sorting_channels_map_to_the_sites_of_the_recording(tmp_path):
+    # a Neuropixels 1.0 recording with channel 1 on bank 1 (electrode 385)
+    (tmp_path / 'rec.ap.meta').write_text(
+        'typeThis=imec\nimSampRate=30000\nnSavedChans=3\nsnsApLfSy=2,0,1\nsnsSaveChanSubset=all\n'
+        '~imroTbl=(0,2)(0 0 0 500 250)(1 1 0 500 250)\n')
+    write_phy(tmp_path / 'sorting', [0, 1])
+    sites = raw.sorting_channel_map(str(tmp_path), 'SpikeGLX', str(tmp_path / 'sorting'))
+    assert sites == {0: (0, 0), 1: (0, 385)}
+    electrodes = raw.electrode_keys(sites, ELECTRODES)
+
+    sorting = spike_sorting.load_phy(str(tmp_path / 'sorting'))
+    table = FakeUnitTable()
+    spike_sorting.insert_units(table, dict(session=1), sorting, electrodes)
+    assert [(w['unit'], w['electrode'], w['waveform'][0]) for w in table.Waveform.rows] == [
+        (0, 0, 0.), (0, 385, 1.), (1, 0, 0.), (1, 385, 1.)]
+
+
+def test_sites_without_shank_match_a_single_shank():
+    electrodes = [dict(electrode=e, shank_id=s) for s in (0, 1) for e in range(2)] + [dict(electrode=5, shank_id=1)]
+    assert raw.electrode_keys({0: (None, 5), 1: (None, 0), 2: (1, 0)}, electrodes) == {
+        0: dict(electrode=5, shank_id=1), 2: dict(electrode=0, shank_id=1)}
+
+
+def test_sorting_without_channels_has_no_waveforms(tmp_path):
+    write_phy(tmp_path / 'sorting', [0, 1])
+    (tmp_path / 'sorting' / 'channel_map.npy').unlink()
+    sorting = spike_sorting.load_phy(str(tmp_path / 'sorting'))
+    for packed in (False, True):
+        table = FakeUnitTable()
+        spike_sorting.insert_units(table, dict(session=1), sorting, {}, packed=packed)
+        assert len(table.rows) == 2 and not table.Waveform.rows and not table.PackedWaveform.rows
+
+
+class FakeTable:
+    def __init__(self):
+        self.rows = []
+
+    def insert(self, rows):
+        self.rows.extend(rows)
+
+
+class FakeUnitTable(FakeTable):
+    def __init__(self):
+        super().__init__()
+        self.CellType, self.Waveform, self.PackedWaveform = FakeTable(), FakeTable(), FakeTable()
@@ -0,0 +1,61 @@
+import os
+import uuid
+
+import datajoint as dj
+import numpy as np
+import pytest
+
+from orofacial_pipeline import manifest, wl_ephys as ephys, wl_whisker_experiment as experiment
+from orofacial_pipeline.benchmarks import ingest, synthetic
+from orofacial_pipeline.benchmarks.run import reset
+from orofacial_pipeline.lazy_schema import activate
+
+DOWNSTREAM = (ephys.UnitQuality, ephys.WaveformFeatures, ephys.UnitPosition, ephys.UnitCellType,
+              ephys.UnitPSTH, ephys.UnitPhaseLocking, ephys.FrameSpikeCounts)
+
+
+@pytest.fixture
+def prefix():
+    try:
+        dj.conn()
+    except Exception as error:
+        pytest.skip('no database server: {}'.format(error))
+    prefix = 'test_manifest_{}_'.format(uuid.uuid4().hex[:8])
+    activate(prefix)
+    try:
+        yield prefix
+    finally:
+        reset(prefix)
+
+
+def test_reingest_unit_repopulates_downstream_tables(prefix, tmp_path):
+    rng = np.random.default_rng(0)
+    folder = str(tmp_path / 'session')
+    ingest.insert_fixtures(1)
+    key = ingest.insert_session(1, 1, 'bench0', folder)
+    starts, stops = synthetic.trial_times(20, 4., 1., rng)
+    ingest.write_session_files(folder, stops[-1] + 1., 5, 100., rng)
+    for _, _, run in ingest.session_stages(key, starts, stops, rng):
+        run()
+    sorting = dict(key, spike_sort_method='KS')
+    for table in DOWNSTREAM:
+        table.populate(sorting)
+    counts = {table.__name__: len(table & sorting) for table in DOWNSTREAM}
+    assert counts['UnitQuality'] and counts['UnitPhaseLocking'] and counts['FrameSpikeCounts']
+    assert manifest.scan(ephys.Unit) == ([], [])
+
+    # the spike sorting is redone: every other spike is dropped
+    for name in ('spike_times', 'spike_clusters', 'spike_templates', 'amplitudes'):
+        path = os.path.join(folder, 'sorting', name + '.npy')
+        np.save(path, np.load(path)[::2])
+    changed, missing = manifest.scan(ephys.Unit)
+    assert changed == [sorting] and not missing
+
+    manifest.reingest(ephys.Unit, changed)
+    assert manifest.scan(ephys.Unit) == ([], [])
+    assert {table.__name__: len(table & sorting) for table in DOWNSTREAM} == counts
+    clusters = np.load(os.path.join(folder, 'sorting', 'spike_clusters.npy'))
+    for unit, spike_times in zip(*(ephys.Unit & sorting).fetch('unit', 'spike_times')):
+        assert len(spike_times) == np.count_nonzero(clusters == unit)
+    # whisking events are untouched by a re-ingest of the units
+    assert len(experiment.ActionEvent().target & key)
@@ -0,0 +1,40 @@
+import datetime
+
+import numpy as np
+import pytest
+
+pynwb = pytest.importorskip('pynwb')
+
+from orofacial_pipeline import nwb_export
+
+
+def test_round_trip_of_trials_and_spike_times(tmp_path):
+    rng = np.random.default_rng(0)
+    trials = [dict(trial=t + 1, start_time=5. * t + 0.1234, stop_time=5. * t + 4.1234, trial_type='go',
+                   outcome='hit' if t % 3 else 'miss') for t in range(40)]
+    keys = [dict(subject_id=1, session=1, spike_sort_method='KS', unit=u) for u in range(5)]
+    # an empty and a single spike train among them
+    trains = [np.sort(rng.uniform(0., 200., n)) for n in (1000, 0, 1, 20000, 37)]
+
+    nwbfile = pynwb.NWBFile(session_description='synthetic session', identifier='sub-1_ses-1',
+                            session_start_time=datetime.datetime(2020, 1, 1).astimezone())
+    nwb_export._add_trials(nwbfile, trials)
+    # the temporary spike times file goes to tmp_path, removed by pytest
+    spike_file = nwb_export._write_spike_times(keys, iter(trains), str(tmp_path))
+    nwb_export._add_units(nwbfile, spike_file, {('KS', 3): 'FS'})
+    path = str(tmp_path / nwb_export.session_file_name(keys[0]))
+    with pynwb.NWBHDF5IO(path, 'w') as io:
+        io.write(nwbfile)
+
+    with pynwb.NWBHDF5IO(path, 'r') as io:
+        exported = io.read()
+        for column in ('start_time', 'stop_time', 'trial'):
+            np.testing.assert_array_equal(exported.trials[column][:], [t[column] for t in trials])
+        assert list(exported.trials['outcome'][:]) == [t['outcome'] for t in trials]
+        assert list(exported.trials['early_response'][:]) == [''] * len(trials)
+
+        assert len(exported.units) == len(keys)
+        assert list(exported.units['unit'][:]) == [k['unit'] for k in keys]
+        assert list(exported.units['cell_type'][:]) == ['', '', '', 'FS', '']
+        for i, train in enumerate(trains):
+            np.testing.assert_array_equal(exported.units['spike_times'][i], train)
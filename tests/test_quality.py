@@ -0,0 +1,28 @@
+import numpy as np
+
+from orofacial_pipeline import quality, spikes
+
+
+def test_isi_violations():
+    trains = [[0., 0.001, 0.01, 0.0105], [], [5.], np.arange(0., 10., 0.01)]
+    np.testing.assert_allclose(quality.isi_violations(*spikes.pack(trains), refractory_period=0.0015),
+                               [2 / 3, 0., 0., 0.])
+
+
+def test_presence_ratio():
+    rng = np.random.default_rng(0)
+    trains = [np.sort(rng.uniform(0., 300., 1000)), np.sort(rng.uniform(0., 120., 100)), [], [300.]]
+    np.testing.assert_allclose(quality.presence_ratio(*spikes.pack(trains), 0., 300., bin_size=60.),
+                               [1., 0.4, 0., 0.2])
+
+
+def test_amplitude_cutoff():
+    # gaussian amplitudes cut at the detection threshold below their mean
+    amplitudes = np.random.default_rng(0).normal(10., 1., 200000)
+    trains = [amplitudes, amplitudes[amplitudes > 9.], amplitudes[amplitudes > 11.], []]
+    cutoff = quality.amplitude_cutoff(*spikes.pack(trains))
+    assert cutoff[0] < 0.01
+    # missing below mean - 1 sd: 0.1587 of all spikes, 0.189 of those detected
+    assert abs(cutoff[1] - 0.1587 / 0.8413) < 0.03
+    assert cutoff[2] == 0.5
+    assert np.isnan(cutoff[3])
@@ -0,0 +1,128 @@
+import json
+import os
+
+import numpy as np
+import pytest
+from datajoint.heading import Heading, default_attribute_properties
+
+pytest.importorskip('pyarrow')
+
+from orofacial_pipeline import snapshot
+
+KEY = [('subject_id', 'smallint'), ('session', 'smallint'), ('spike_sort_method', 'varchar(16)'),
+       ('unit', 'smallint')]
+
+
+def heading(primary, secondary):
+    specs = []
+    for in_key, attributes in ((True, primary), (False, secondary)):
+        for name, sql_type in attributes:
+            blob, string = sql_type == 'longblob', sql_type.startswith('varchar')
+            dtype = object if blob or string else np.float64 if sql_type == 'double' else np.int64
+            specs.append(dict(default_attribute_properties, name=name, type=sql_type, in_key=in_key,
+                              numeric=not blob and not string, string=string, is_blob=blob, dtype=dtype))
+    return Heading(specs)
+
+
+class Rows:
+    """The query interface dump reads, over a list of dicts."""
+
+    def __init__(self, heading, rows):
+        self.heading, self.rows = heading, rows
+        self.primary_key = heading.primary_key
+
+    def __and__(self, restriction):
+        return Rows(self.heading, [r for r in self.rows if all(r[k] == v for k, v in restriction.items())])
+
+    def fetch(self, order_by, limit, offset):
+        rows = sorted(self.rows, key=lambda r: [r[a] for a in order_by])[offset:offset + limit]
+        result = np.empty(len(rows), dtype=[(n, a.dtype) for n, a in self.heading.attributes.items()])
+        for i, row in enumerate(rows):
+            for name in self.heading.names:
+                result[name][i] = row[name]
+        return result
+
+
+@pytest.fixture(scope='module')
+def tables():
+    rng = np.random.default_rng(0)
+    units = [dict(subject_id=s, session=e, spike_sort_method=m, unit=u,
+                  spike_times=np.sort(rng.uniform(0, 100, rng.integers(0, 50))))
+             for s in (1, 2) for e in (1, 2) for m in ('JRC', 'KS') for u in range(3)]
+    metrics = [dict({k: unit[k] for k, _ in KEY}, firing_rate=float(len(unit['spike_times'])) / 100,
+                    waveform=rng.normal(size=(4, 30)).astype(np.float32))
+               for unit in units if unit['unit'] != 1]
+    return {'wl_ephys.Unit': Rows(heading(KEY, [('spike_times', 'longblob')]), units),
+            'wl_ephys.UnitQuality.Metrics': Rows(
+                heading(KEY, [('firing_rate', 'double'), ('waveform', 'longblob')]), metrics)}
+
+
+@pytest.fixture(scope='module', params=['arrow', 'parquet'])
+def snap(request, tables, tmp_path_factory):
+    # what dump() writes, for each session of the tables
+    folder = str(tmp_path_factory.mktemp(request.param))
+    manifest = {'tables': {}}
+    for name, rows in tables.items():
+        path = os.path.join(*name.split('.', 1))
+        sessions = sorted({(r['subject_id'], r['session']) for r in rows.rows})
+        for values in sessions:
+            snapshot._write_partition(rows & dict(zip(snapshot.PARTITION_BY, values)),
+                                      snapshot._partition_folder(os.path.join(folder, path), snapshot.PARTITION_BY,
+                                                                 values),
+                                      request.param, batch_rows=5)
+        manifest['tables'][name] = dict(path=path, full_table_name=name, primary_key=rows.primary_key,
+                                        attributes=rows.heading.names, partition_by=list(snapshot.PARTITION_BY),
+                                        blobs=[n for n, a in rows.heading.attributes.items() if a.is_blob],
+                                        partitions=sessions)
+    with open(os.path.join(folder, 'manifest.json'), 'w') as f:
+        json.dump(manifest, f)
+    return snapshot.Snapshot(folder)
+
+
+def assert_rows_equal(fetched, expected):
+    assert len(fetched) == len(expected)
+    for row, expected_row in zip(fetched, expected):
+        assert row.keys() == expected_row.keys()
+        for name, value in expected_row.items():
+            np.testing.assert_array_equal(row[name], value)
+            assert np.asarray(row[name]).dtype == np.asarray(value).dtype
+
+
+def key(row):
+    return [row[k] for k, _ in KEY]
+
+
+def test_round_trip(snap, tables):
+    for name, rows in tables.items():
+        assert_rows_equal(snap[name].fetch(as_dict=True, order_by='KEY'), sorted(rows.rows, key=key))
+
+
+def test_restrict(snap, tables):
+    units = tables['wl_ephys.Unit'].rows
+    query = snap.wl_ephys.Unit & {'subject_id': 2} & [{'session': 1}, {'unit': 2}]
+    assert_rows_equal(query.fetch(as_dict=True, order_by='KEY'), sorted(
+        (u for u in units if u['subject_id'] == 2 and (u['session'] == 1 or u['unit'] == 2)), key=key))
+    assert len(snap.wl_ephys.Unit - {'spike_sort_method': 'KS'}) == len(units) / 2
+    # restricted by a query: units with metrics
+    with_metrics = snap.wl_ephys.Unit & snap['wl_ephys.UnitQuality.Metrics']
+    assert with_metrics.fetch('KEY', order_by='KEY') == [{k: u[k] for k, _ in KEY}
+                                                         for u in sorted(units, key=key) if u['unit'] != 1]
+
+
+def test_join_proj_fetch(snap, tables):
+    units = {tuple(key(u)): u for u in tables['wl_ephys.Unit'].rows}
+    metrics = sorted(tables['wl_ephys.UnitQuality.Metrics'].rows, key=key)
+    restriction = {'subject_id': 1, 'spike_sort_method': 'KS'}
+    joined = (snap.wl_ephys.Unit * snap['wl_ephys.UnitQuality.Metrics'] & restriction).proj(
+        'spike_times', rate='firing_rate')
+    expected = [dict({k: m[k] for k, _ in KEY}, rate=m['firing_rate'],
+                     spike_times=units[tuple(key(m))]['spike_times'])
+                for m in metrics if m['subject_id'] == 1 and m['spike_sort_method'] == 'KS']
+    assert_rows_equal([{n: row[n] for n in expected[0]} for row in joined.fetch(as_dict=True, order_by='KEY')],
+                      expected)
+
+    metric_key = {k: metrics[0][k] for k, _ in KEY}
+    waveform, rate = (snap['wl_ephys.UnitQuality.Metrics'] & metric_key).fetch1('waveform', 'firing_rate')
+    np.testing.assert_array_equal(waveform, metrics[0]['waveform'])
+    assert rate == metrics[0]['firing_rate']
+    assert joined.fetch('KEY', order_by='KEY') == [{k: e[k] for k, _ in KEY} for e in expected]
@@ -0,0 +1,33 @@
+import datajoint as dj
+import numpy as np
+import pytest
+
+from orofacial_pipeline import spike_codec
+
+
+@pytest.mark.parametrize('samples', [
+    [], [7], [0, 1, 2, 300, 70000, 70001],
+    [5, 3, 2 ** 40, 2 ** 40 + 1],  # negative and 64-bit deltas
+    np.cumsum(np.random.default_rng(0).geometric(1e-3, 100000)),
+])
+def test_round_trip_is_exact(samples):
+    samples = np.asarray(samples, dtype=np.int64)
+    value = spike_codec.encode(samples, 30000.)
+    np.testing.assert_array_equal(spike_codec.decode_samples(value), samples)
+
+    # through the adapter and the blob serialization of an insert and fetch
+    stored = dj.blob.unpack(dj.blob.pack(spike_codec.sampled_times.put(
+        spike_codec.SampledSpikeTimes(samples, 30000.))))
+    times = spike_codec.sampled_times.get(stored)
+    assert times.dtype == np.float64
+    np.testing.assert_array_equal(times, samples / 30000.)
+
+
+def test_narrow_deltas_and_plain_arrays():
+    value = spike_codec.encode([10, 20, 275], 30000.)
+    assert value['deltas'].dtype == np.uint8 and value['first'] == 10
+    assert spike_codec.encode(np.arange(0, 3 * 70000, 70000), 1.)['deltas'].dtype == np.uint32
+
+    times = np.array([0.5, 1.25, 3.])
+    assert spike_codec.sampled_times.put(times) is times
+    np.testing.assert_array_equal(spike_codec.sampled_times.get(dj.blob.unpack(dj.blob.pack(times))), times)
@@ -0,0 +1,27 @@
+import numpy as np
+
+from orofacial_pipeline import spikes
+
+
+def expected_offsets(trains, lo, hi):
+    return np.array([[[np.sum(np.asarray(t) < l), np.sum(np.asarray(t) < h)] for l, h in zip(lo, hi)]
+                     for t in trains])
+
+
+def test_window_offsets_include_lo_and_exclude_hi():
+    trains = [[0., 1., 1.5, 2., 3.], [], [2.], [1., 1., 4.]]
+    buffer, offsets = spikes.pack(trains)
+    for lo, hi in (([1., 0., 2., 3.], [2., 1., 3., 3.]),  # abutting windows, given out of order, one empty
+                   ([0., 1., 1.5], [2., 3., 1.5])):  # overlapping windows are searched unit by unit
+        index = spikes.window_offsets(buffer, offsets, lo, hi)
+        np.testing.assert_array_equal(index, expected_offsets(trains, lo, hi))
+
+    index = spikes.window_offsets(buffer, offsets, [1., 0.], [2., 1.])
+    assert buffer[offsets[0]:][index[0, 0, 0]:index[0, 0, 1]].tolist() == [1., 1.5]
+    assert buffer[offsets[3]:][index[3, 1, 0]:index[3, 1, 1]].tolist() == []
+
+
+def test_window_spikes_list_a_spike_once_per_window():
+    buffer, offsets = spikes.pack([[0.5, 1., 2.]])
+    spike_index, units, windows = spikes.window_spikes(buffer, offsets, [0., 1., 0.5], [1., 2., 2.5])
+    assert list(zip(spike_index, units, windows)) == [(0, 0, 0), (1, 0, 1), (0, 0, 2), (1, 0, 2), (2, 0, 2)]
@@ -0,0 +1,41 @@
+import numpy as np
+
+from orofacial_pipeline import spikes, stimulation, sync, wl_whisker_experiment as experiment
+
+
+def test_artifacts_are_masked_on_the_spike_clock(monkeypatch):
+    # the ephys clock runs 3 s ahead of the behavior clock
+    knots = np.array([[3., 103.], [0., 100.]])
+    onsets = np.array([10., 20.])
+    monkeypatch.setattr(experiment.StimPulses, 'fetch_pulses', lambda self, key: (onsets, onsets + 0.001))
+    monkeypatch.setattr(experiment.ClockModel, 'convert_synced',
+                        lambda self, key, times, device, to=None: (
+                            sync.convert(times, knots[1], knots[0]) if (device, to) == ('behavior', 'ephys')
+                            else times))
+
+    artifacts = onsets + 3.0005
+    behavior_times = onsets + 0.0005  # the pulses, but on the wrong clock
+    buffer, offsets = spikes.pack([np.sort(np.concatenate([artifacts, behavior_times])), artifacts[:1]])
+    buffer, offsets = experiment.StimPulses().mask_artifacts(dict(subject_id=1, session=1), buffer, offsets)
+    np.testing.assert_array_equal(buffer, behavior_times)
+    np.testing.assert_array_equal(offsets, [0, 2, 2])
+
+
+def test_first_spike_latencies():
+    buffer, offsets = spikes.pack([[1.002, 1.004, 2.01, 3.], []])
+    latency = stimulation.first_spike_latencies(buffer, offsets, [1., 2., 3.], window=0.01)
+    np.testing.assert_allclose(latency, [[0.002, np.nan, 0.], [np.nan, np.nan, np.nan]])
+
+
+def test_salt_tells_a_tagged_unit_from_an_untagged_one():
+    rng = np.random.default_rng(0)
+    train_onsets = 10. + 2. * np.arange(50)
+    pulse_onsets = (train_onsets[:, None] + 0.1 * np.arange(5)).ravel()
+    background = [np.sort(rng.uniform(0., 120., 600)) for _ in range(2)]
+    evoked = pulse_onsets[rng.random(pulse_onsets.size) < 0.9]
+    evoked = evoked + rng.normal(0.003, 0.0003, evoked.size)
+    buffer, offsets = spikes.pack([np.sort(np.concatenate([background[0], evoked])), background[1]])
+
+    p, i = stimulation.salt(buffer, offsets, pulse_onsets, train_onsets)
+    assert p[0] == 1 / 101 and i[0] > 0.5
+    assert p[1] > 0.05 and abs(i[1]) < 0.1
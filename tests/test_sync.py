@@ -0,0 +1,45 @@
+import numpy as np
+
+from orofacial_pipeline import sync
+
+
+def pulses():
+    # reference pulses at irregular intervals; the device clock runs 3.2 s behind and 20 ppm fast,
+    # starts 10 pulses late and drops a few
+    rng = np.random.default_rng(0)
+    reference = np.cumsum(rng.uniform(0.5, 1.5, 200))
+    kept = np.setdiff1d(np.arange(10, 200), [15, 60, 61, 150])
+    device = (reference[kept] - 3.2) * (1 + 20e-6) + rng.normal(0, 1e-4, kept.size)
+    return device, reference, kept
+
+
+def test_match_pulses_with_dropped_pulses_and_an_offset():
+    device, reference, kept = pulses()
+    device_index, reference_index = sync.match_pulses(device, reference)
+    np.testing.assert_array_equal(device_index, np.arange(kept.size))
+    np.testing.assert_array_equal(reference_index, kept)
+
+    # a spurious device pulse next to a real one is left unmatched
+    spurious = np.sort(np.append(device, device[30] + 0.05))
+    device_index, reference_index = sync.match_pulses(spurious, reference)
+    np.testing.assert_array_equal(reference_index, kept)
+    assert 31 not in device_index
+
+
+def test_match_pulses_by_code():
+    device_index, reference_index = sync.match_pulses([1., 2., 3.], [5., 6., 7., 8.], device_codes=[7, 3, 9],
+                                                      reference_codes=[3, 4, 7, 9])
+    np.testing.assert_array_equal(device_index, [0, 1, 2])
+    np.testing.assert_array_equal(reference_index, [2, 0, 3])
+
+
+def test_convert_through_matched_knots():
+    device, reference, kept = pulses()
+    device_index, reference_index = sync.match_pulses(device, reference)
+    knots_from, knots_to = device[device_index], reference[reference_index]
+    # inside the knots, between them and beyond them on either side
+    truth = np.array([reference[0], reference[15], reference[100] + 0.3, reference[-1] + 5.])
+    converted = sync.convert((truth - 3.2) * (1 + 20e-6), knots_from, knots_to)
+    np.testing.assert_allclose(converted, truth, atol=1e-3)
+    np.testing.assert_allclose(sync.convert(knots_from, knots_from, knots_to), knots_to)
+    np.testing.assert_array_equal(sync.convert([1., 2.], [10.], [13.]), [4., 5.])
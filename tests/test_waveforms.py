@@ -0,0 +1,17 @@
+import numpy as np
+
+from orofacial_pipeline import waveforms
+
+
+def test_triangulation_failures_are_not_converged():
+    coords = np.array([[x, y] for y in (0., 20., 40., 60.) for x in (0., 32.)])
+    source = np.array([10., 30., 15.])
+    amplitudes = 100. / np.sqrt(((coords - source[:2]) ** 2).sum(axis=1) + source[2] ** 2)
+    # the second unit has no signal: no step ever lowers its cost and its damping blows up
+    position, alpha, converged = waveforms.monopolar_triangulation(
+        np.stack([amplitudes, np.zeros(len(coords))]), np.stack([coords, coords]))
+    np.testing.assert_allclose(position[0], source, atol=1e-3)
+    np.testing.assert_allclose(alpha[0], 100., rtol=1e-4)
+    np.testing.assert_array_equal(converged, [True, False])
+    # and it stopped where it started
+    np.testing.assert_array_equal(position[1], [0., 0., 20.])
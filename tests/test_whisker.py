@@ -0,0 +1,40 @@
+import numpy as np
+
+from orofacial_pipeline import whisker
+from orofacial_pipeline.benchmarks import synthetic
+
+
+def test_chunked_kinematics_match_whole_trace():
+    frame_times, angle = synthetic.whisker_angle(60., 500., np.random.default_rng(0))
+    whole = whisker.kinematics(angle, frame_times, chunk_size=len(angle))
+    chunked = whisker.kinematics(angle, frame_times, chunk_size=4099)
+    for name in ('amplitude', 'midpoint', 'velocity'):
+        np.testing.assert_allclose(chunked[name], whole[name], rtol=1e-6, atol=1e-5)
+    phase_difference = np.angle(np.exp(1j * (chunked['phase'].astype(np.float64) - whole['phase'])))
+    np.testing.assert_allclose(phase_difference, 0., atol=1e-5)
+
+
+def _pumps(angle, frame_rate):
+    frame_times = np.arange(len(angle)) / frame_rate
+    kinematics = whisker.kinematics(angle, frame_times)
+    return whisker.detect_whisk_events(kinematics['phase'], kinematics['amplitude'], angle,
+                                       frame_rate)['whisker pump']
+
+
+def test_no_pumps_on_noisy_sinusoid():
+    frame_rate = 500.
+    t = np.arange(int(400 * frame_rate)) / frame_rate  # 4000 cycles at 10 Hz
+    for noise in (0.3, 1.):
+        angle = 80. + 10. * np.cos(2 * np.pi * 10. * t) + np.random.default_rng(0).normal(0., noise, t.size)
+        assert len(_pumps(angle, frame_rate)) == 0
+
+
+def test_pumps_at_reversals():
+    frame_rate = 500.
+    t = np.arange(int(100 * frame_rate)) / frame_rate
+    pump_times = np.arange(0.5, 99., 1.)  # at maximal protraction, where the angle dips and recovers
+    angle = 80. + 10. * np.cos(2 * np.pi * 10. * t) + np.random.default_rng(0).normal(0., 0.3, t.size)
+    angle -= 8. * np.exp(-0.5 * ((t[:, None] - pump_times) / 0.008) ** 2).sum(axis=1)
+    detected = t[_pumps(angle, frame_rate)]
+    assert len(detected) == len(pump_times)
+    np.testing.assert_allclose(detected, pump_times, atol=0.01)